@@ -0,0 +1,40 @@
+import os, sys, time, types, resource, subprocess
+
+# Shared bits of the benchmark scripts
+# Run them from the root of the repo, like python benchmarks/copy_load.py
+# proj/__init__.py builds the whole app (config, database), so proj gets registered as a plain package like in tests/conftest.py
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if 'proj' not in sys.modules:
+    proj = types.ModuleType('proj')
+    proj.__path__ = [os.path.join(ROOT, 'proj')]
+    sys.modules['proj'] = proj
+
+
+def peak_mb():
+    # peak resident memory of this process so far
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Timer:
+    def __enter__(self):
+        self.base_mb = peak_mb()
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall = time.perf_counter() - self.wall_start
+        self.cpu = time.process_time() - self.cpu_start
+        self.peak_mb = peak_mb() - self.base_mb
+
+
+def run_each(script, modes, *args):
+    '''
+    runs the script once per mode, each in a process of its own, so the peak memory of one does not hide the other
+    (the process that calls this should not use much memory itself, its peak carries over to the processes it starts)
+    the script reads the mode as its first argument
+    '''
+    for mode in modes:
+        subprocess.run([sys.executable, script, mode, *[str(a) for a in args]], check = True)
@@ -0,0 +1,66 @@
+import sys
+import csv
+import numpy as np
+import pandas as pd
+from pandas import isnull
+
+import common
+from proj.utils.db import copy_csv, sde_function, COPY_CHUNKSIZE
+
+# to_geodb - the one big INSERT statement it used to build, against the csv chunks it sends through COPY now
+# Only the building of what gets sent to postgres is timed, since there is no database here
+# (The INSERT also had to be parsed by postgres in one go, which is not counted)
+#
+#   python benchmarks/copy_load.py [rows]
+
+
+def make_table(n):
+    rs = np.random.RandomState(0)
+    return pd.DataFrame({
+        "stationid"    : rs.choice(['B23-12000', 'B23-12321', "O'Brien"], n),
+        "sampledate"   : pd.Timestamp('2023-07-01') + pd.to_timedelta(rs.randint(0, 90, n), unit = 'D'),
+        "analytename"  : rs.choice(['Lead', 'Copper', 'PCB 153'], n),
+        "result"       : rs.rand(n) * 100,
+        "mdl"          : np.where(rs.rand(n) < .2, np.nan, rs.rand(n)),
+        "qualifier"    : rs.choice(['none', '', ' = ', '<'], n),
+        "labreplicate" : rs.randint(1, 3, n),
+        "comments"     : rs.choice(['', None, '50% recovery, "ok"'], n),
+        "objectid"     : "sde.next_rowid('sde','tbl_chemresults')",
+        "globalid"     : "sde.next_globalid()",
+    })
+
+
+def old_insert(df):
+    cols = list(df.columns)
+    return "INSERT INTO {} \n({}) \nVALUES {}".format(
+        'tbl_chemresults',
+        ', '.join(cols),
+        ',\n'.join(
+            "({})".format(', '.join([
+                'NULL' if ((str(v).strip() == '') or isnull(v))
+                else str(v).strip() if ("sde.next_" in str(v))
+                else "'{}'".format(str(v).strip().replace("'", "''"))
+                for v in x
+            ]))
+            for x in list(zip(*[df[c] for c in cols]))
+        )
+    ).replace("%", "%%")
+
+
+def new_copy(df):
+    datacols = [c for c in df.columns if sde_function(df[c]) is None]
+    size = 0
+    for start in range(0, len(df), COPY_CHUNKSIZE):
+        size += len(copy_csv(df.iloc[start:start + COPY_CHUNKSIZE], datacols).getvalue())
+    return size
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] in ('old', 'new'):
+        mode, n = sys.argv[1], int(sys.argv[2])
+        df = make_table(n)
+        with common.Timer() as t:
+            size = len(old_insert(df)) if mode == 'old' else new_copy(df)
+        print(f"{mode:4} {n:>8} rows  wall {t.wall:7.2f}s  cpu {t.cpu:7.2f}s  peak +{t.peak_mb:6.0f}MB  sent {size / 1e6:7.1f}MB")
+    else:
+        common.run_each(__file__, ('old', 'new'), int(sys.argv[1]) if len(sys.argv) > 1 else 300000)
@@ -0,0 +1,69 @@
+import os, sys, tempfile
+import numpy as np
+import pandas as pd
+
+import common
+from proj.core.metadata import checkDataTypes
+
+sys.path.insert(0, os.path.join(common.ROOT, 'tests'))
+from test_dtypes import reference_checkDataTypes
+
+# checkDataTypes - the old version (convert_dtype on every cell, through its lru_cache) against invalid_dtype_mask (a whole column at a time)
+# The numeric columns are object columns with a mix of ints, floats, numeric strings, junk and blanks, like what comes out of a messy submission
+#
+#   python benchmarks/dtypes.py [rows]
+
+
+def make_submission(n):
+    rs = np.random.RandomState(0)
+    # mostly distinct values, so the lru_cache of convert_dtype does not get to help much
+    mixed = np.empty(n, dtype = object)
+    kind = rs.randint(0, 6, n)
+    ints = rs.randint(-100000, 100000, n)
+    floats = rs.rand(n) * 1000
+    mixed[kind == 0] = ints[kind == 0]
+    mixed[kind == 1] = floats[kind == 1]
+    mixed[kind == 2] = [str(i) for i in ints[kind == 2]]
+    mixed[kind == 3] = [f"{f:.3f}" for f in floats[kind == 3]]
+    mixed[kind == 4] = rs.choice(['abc', 'ND', '<0.5', '1,000', ' 3 '], (kind == 4).sum())
+    mixed[kind == 5] = None
+
+    df = pd.DataFrame({
+        "stationid"  : [f"B23-{i}" for i in range(n)],
+        "sampledate" : np.where(rs.rand(n) < 0.9, (pd.Timestamp('2023-07-01') + pd.to_timedelta(rs.randint(0, 10 ** 6, n), unit = 's')).astype(str), '7/1/2023'),
+        "replicate"  : mixed,
+        "result"     : mixed.copy(),
+        "depth"      : floats,
+        "labbatch"   : ints,
+        "objectid"   : np.arange(n),
+    })
+    meta = pd.DataFrame({
+        "column_name" : ["stationid", "sampledate", "replicate", "result", "depth", "labbatch", "objectid"],
+        "dtype"       : [str, pd.Timestamp, int, float, float, int, int],
+        "data_type"   : ["character varying", "timestamp without time zone", "integer", "numeric", "numeric", "integer", "integer"],
+    })
+    return df, meta
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'setup':
+        # the frame gets made in a process of its own, since the peak memory of a process carries over to the ones it starts
+        tmpdir, n = sys.argv[2], int(sys.argv[3])
+        pd.to_pickle(make_submission(n), os.path.join(tmpdir, 'submission.pkl'))
+    elif len(sys.argv) > 1 and sys.argv[1] in ('old', 'new'):
+        mode, tmpdir = sys.argv[1], sys.argv[2]
+        df, meta = pd.read_pickle(os.path.join(tmpdir, 'submission.pkl'))
+        system_fields = ["objectid"]
+
+        with common.Timer() as t:
+            if mode == 'old':
+                ret = reference_checkDataTypes(df, "tbl_test", meta, system_fields)
+            else:
+                ret = checkDataTypes(df, "tbl_test", None, meta, context = {"system_fields": system_fields})
+        flagged = sum(len(r.get('rows', [])) for r in ret)
+        print(f"{mode:4} {len(df):>8} rows  {flagged:>8} flagged cells  wall {t.wall:7.2f}s  cpu {t.cpu:7.2f}s  peak +{t.peak_mb:6.0f}MB")
+    else:
+        n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+        with tempfile.TemporaryDirectory() as tmpdir:
+            common.run_each(__file__, ('setup',), tmpdir, n)
+            common.run_each(__file__, ('old', 'new'), tmpdir)
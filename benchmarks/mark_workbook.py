@@ -0,0 +1,67 @@
+import os, sys, tempfile
+import numpy as np
+import pandas as pd
+from flask import Flask, session
+
+import common
+from proj.utils.excel import mark_workbook
+
+sys.path.insert(0, os.path.join(common.ROOT, 'tests'))
+from test_mark_workbook import old_mark_workbook
+
+# mark_workbook - the old openpyxl version (load the whole workbook, set each flagged cell) against the streaming xlsxwriter one
+#
+#   python benchmarks/mark_workbook.py [rows]
+
+
+def make_submission(path, n):
+    df = pd.DataFrame({
+        "stationid"  : [f"B23-{i}" for i in range(n)],
+        "sampledate" : pd.Timestamp('2023-07-01'),
+        "result"     : np.random.RandomState(0).rand(n),
+        "qualifier"  : [None] * n,
+        "units"      : 'ng/g dw',
+        "labbatch"   : np.arange(n),
+    })
+    with pd.ExcelWriter(path, engine = 'xlsxwriter') as writer:
+        df.to_excel(writer, sheet_name = 'tbl_chemresults', index = False)
+    with pd.ExcelWriter(path, engine = 'openpyxl', mode = 'a') as writer:
+        pd.DataFrame({"analyte": ['Lead', 'Copper'], "mean": [1.5, 2.25]}).to_excel(writer, sheet_name = 'tox_summary_results', index = False)
+
+    rows = [i + 2 for i in range(n)]
+    errs = [
+        {"table": "tbl_chemresults", "rows": rows, "columns": "result", "error_message": "bad result"},
+        {"table": "tbl_chemresults", "rows": rows[:n // 2], "columns": "qualifier,units", "error_message": "missing"},
+        {"table": "tbl_chemresults", "rows": rows[:1000], "columns": "result", "error_message": "second"},
+    ]
+    warnings = [{"table": "tbl_chemresults", "rows": rows[:100], "columns": "result", "error_message": "warn"}]
+    return {"tbl_chemresults": df}, errs, warnings
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'setup':
+        # the submission gets made in a process of its own too, since the peak memory of a process carries over to the ones it starts
+        tmpdir, n = sys.argv[2], int(sys.argv[3])
+        pd.to_pickle(make_submission(os.path.join(tmpdir, 'submission.xlsx'), n), os.path.join(tmpdir, 'flags.pkl'))
+    elif len(sys.argv) > 1 and sys.argv[1] in ('old', 'new'):
+        mode, tmpdir = sys.argv[1], sys.argv[2]
+        path = os.path.join(tmpdir, 'submission.xlsx')
+        all_dfs, errs, warnings = pd.read_pickle(os.path.join(tmpdir, 'flags.pkl'))
+        flagged = sum(len(e['rows']) * len(e['columns'].split(',')) for e in errs + warnings)
+
+        app = Flask('benchmark')
+        app.secret_key = 'benchmark'
+        os.makedirs(os.path.join(tmpdir, mode))
+        with app.test_request_context():
+            session['submission_dir'] = os.path.join(tmpdir, mode)
+            with common.Timer() as t:
+                if mode == 'old':
+                    old_mark_workbook(all_dfs, path, errs, warnings)
+                else:
+                    mark_workbook(all_dfs, path, errs, warnings)
+        print(f"{mode:4} {len(all_dfs['tbl_chemresults']):>8} rows  {flagged:>8} flagged cells  wall {t.wall:7.2f}s  cpu {t.cpu:7.2f}s  peak +{t.peak_mb:6.0f}MB")
+    else:
+        n = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+        with tempfile.TemporaryDirectory() as tmpdir:
+            common.run_each(__file__, ('setup',), tmpdir, n)
+            common.run_each(__file__, ('old', 'new'), tmpdir)
@@ -0,0 +1,61 @@
+import os, sys, tempfile
+import numpy as np
+import pandas as pd
+
+import common
+from proj.utils.excel import read_workbook
+
+# Reading the submitted workbook - pd.read_excel once per sheet (which opens and parses the whole xlsx every time) like the upload routine used to,
+# against read_workbook, which opens it once and reads each sheet out of it
+#
+#   python benchmarks/read_workbook.py [rows per sheet] [sheets]
+
+
+def make_workbook(path, n, sheets):
+    rs = np.random.RandomState(0)
+    with pd.ExcelWriter(path, engine = 'xlsxwriter') as writer:
+        for s in range(sheets):
+            pd.DataFrame({
+                "stationid"  : rs.choice(['B23-12000', 'B23-12321', 'B23-12177'], n),
+                "sampledate" : pd.Timestamp('2023-07-01') + pd.to_timedelta(rs.randint(0, 90, n), unit = 'D'),
+                "analytename": rs.choice(['Lead', 'Copper', 'PCB 153'], n),
+                "result"     : rs.rand(n) * 100,
+                "qualifier"  : rs.choice(['none', '', '<'], n),
+                "comments"   : rs.choice(['', 'ok'], n),
+            }).to_excel(writer, sheet_name = f"tbl_sheet{s}", index = False)
+        # the lookup list tabs of the template get skipped either way
+        pd.DataFrame({"stationid": ['B23-12000']}).to_excel(writer, sheet_name = 'lu_stations', index = False)
+
+
+def old_read(path):
+    return {
+        sheet: pd.read_excel(path, sheet_name = sheet, skiprows = 0, keep_default_na = False, na_values = [''])
+        for sheet in pd.ExcelFile(path).sheet_names
+        if not sheet.startswith('lu_')
+    }
+
+
+def new_read(path):
+    return dict(read_workbook(path, skiprows = 0))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'setup':
+        make_workbook(os.path.join(sys.argv[2], 'submission.xlsx'), int(sys.argv[3]), int(sys.argv[4]))
+    elif len(sys.argv) > 1 and sys.argv[1] in ('old', 'new'):
+        mode, path = sys.argv[1], os.path.join(sys.argv[2], 'submission.xlsx')
+        with common.Timer() as t:
+            all_dfs = old_read(path) if mode == 'old' else new_read(path)
+        print(f"{mode:4} {len(all_dfs)} sheets {sum(len(df) for df in all_dfs.values()):>8} rows  wall {t.wall:7.2f}s  cpu {t.cpu:7.2f}s  peak +{t.peak_mb:6.0f}MB")
+
+        # same frames either way
+        other = new_read(path) if mode == 'old' else old_read(path)
+        assert all_dfs.keys() == other.keys()
+        for sheet in all_dfs:
+            pd.testing.assert_frame_equal(all_dfs[sheet], other[sheet])
+    else:
+        n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+        sheets = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+        with tempfile.TemporaryDirectory() as tmpdir:
+            common.run_each(__file__, ('setup',), tmpdir, n, sheets)
+            common.run_each(__file__, ('old', 'new'), tmpdir)
@@ -1,7 +1,10 @@
 import os, json
+import multiprocessing
 from flask import Flask, g
 from flask_cors import CORS
-from sqlalchemy import create_engine
+from .utils.db import get_engine, pool_options
+from .utils.prepare import prepare_schema, prepare_enabled
+from .utils.outbox import outbox_enabled, start_sender
 
 
 # import blueprints to register them
@@ -55,17 +58,18 @@ if 'ALLOW_EMPTY_TABLES' in CONFIG.keys():
 
 # set the database connection string, database, and type of database we are going to point our application at
 #app.eng = create_engine(os.environ.get("DB_CONNECTION_STRING"))
+# connect_db gives back the pooled engine of this process (see get_engine in utils/db.py), it does not make a new one every time
+# So the engine is not disposed of at the end of the request anymore, the connections go back to the pool
+# Pool settings: DB_POOL_SIZE, DB_POOL_MAX_OVERFLOW, DB_POOL_RECYCLE, DB_POOL_TIMEOUT in the config
 def connect_db():
-    return create_engine(os.environ.get("DB_CONNECTION_STRING"))
+    return get_engine(os.environ.get("DB_CONNECTION_STRING"), **pool_options(app.config))
 
 @app.before_request
 def before_request():
     g.eng = connect_db()
-
-@app.teardown_request
-def teardown_request(exception):
-    if hasattr(g, 'eng'):
-        g.eng.dispose()
+    # the mail sender thread of this worker, so whatever is left in the outbox gets sent even if nothing new is put in it (see utils/outbox.py)
+    if outbox_enabled():
+        start_sender()
 
 # Project name
 app.project_name = CONFIG.get("PROJECTNAME")
@@ -104,52 +108,77 @@ app.global_login_form = CONFIG.get('GLOBAL_LOGIN_FORM') # may be a nonetype obje
 print("Be sure not to prefix the login fields with 'login' in the datasets.json config file")
 
 
-# Add system fields to system fields table
-try:
-    print("Create temporary db connection")
-    tmpeng = connect_db()
-    print("Done creating temporary db connection")
-
-    print("Creating system fields table")
-    tmpeng.execute(
-        """
-        CREATE TABLE IF NOT EXISTS "sde"."system_fields" (
-            "fieldname" varchar(255) COLLATE "pg_catalog"."default" NOT NULL PRIMARY KEY
-        );
-        """
-    )
-    print("Done creating system fields table")
-    system_fields_tuple_string = "('{}')" \
-        .format(
-            "'), ('".join([str(x).strip().replace(';','').replace("'","").replace('"','') for x in app.system_fields])
-        )
-    system_fields_delete_tuple_string = "('{}')" \
-        .format(
-            "', '".join([str(x).strip().replace(';','').replace("'","").replace('"','') for x in app.system_fields])
+# The database setup the app does when it starts up
+# The core check pool spawns worker processes, and each one of them imports proj to get at the checks (see core/pool.py)
+#   so this only runs in the process that starts the app, not every time a worker starts
+def setup_database():
+    # Add system fields to system fields table
+    try:
+        print("Create temporary db connection")
+        tmpeng = connect_db()
+        print("Done creating temporary db connection")
+
+        print("Creating system fields table")
+        tmpeng.execute(
+            """
+            CREATE TABLE IF NOT EXISTS "sde"."system_fields" (
+                "fieldname" varchar(255) COLLATE "pg_catalog"."default" NOT NULL PRIMARY KEY
+            );
+            """
         )
-
-    system_fields_command = f"""
-        INSERT INTO sde.system_fields (fieldname) VALUES {system_fields_tuple_string} 
-        ON CONFLICT ON CONSTRAINT system_fields_pkey DO NOTHING
-    """
-    print("Inserting system fields")
-    print(system_fields_command)
-    tmpeng.execute(system_fields_command)
-    print("DONE inserting system fields")
-
-    print("Remove fields that are no longer there")
-    tmpeng.execute(f"DELETE FROM system_fields WHERE fieldname NOT IN {system_fields_delete_tuple_string}")
-    print("Done removing fields that are no longer there")
-
-    print("Dispose temprary engine/connection")
-    tmpeng.dispose()
-    print("Done disposing temprary engine/connection")
-
-
-except Exception as e:
-    print("WARNING: Unable to create and insert system fields into the system fields table")
-    print("Here is the error message")
-    print(e)
+        print("Done creating system fields table")
+        system_fields_tuple_string = "('{}')" \
+            .format(
+                "'), ('".join([str(x).strip().replace(';','').replace("'","").replace('"','') for x in app.system_fields])
+            )
+        system_fields_delete_tuple_string = "('{}')" \
+            .format(
+                "', '".join([str(x).strip().replace(';','').replace("'","").replace('"','') for x in app.system_fields])
+            )
+
+        system_fields_command = f"""
+            INSERT INTO sde.system_fields (fieldname) VALUES {system_fields_tuple_string} 
+            ON CONFLICT ON CONSTRAINT system_fields_pkey DO NOTHING
+        """
+        print("Inserting system fields")
+        print(system_fields_command)
+        tmpeng.execute(system_fields_command)
+        print("DONE inserting system fields")
+
+        print("Remove fields that are no longer there")
+        tmpeng.execute(f"DELETE FROM system_fields WHERE fieldname NOT IN {system_fields_delete_tuple_string}")
+        print("Done removing fields that are no longer there")
+
+        # Close the connections this opened, so no open connections get carried over when uwsgi forks the workers
+        print("Dispose temprary engine/connection")
+        tmpeng.dispose()
+        print("Done disposing temprary engine/connection")
+
+
+    except Exception as e:
+        print("WARNING: Unable to create and insert system fields into the system fields table")
+        print("Here is the error message")
+        print(e)
+
+
+    # Put the system columns and defaults on the tables of the datasets, so the final submit does not have to (see utils/prepare.py)
+    # Same as above, this runs before uwsgi forks the workers
+    if prepare_enabled(app.config):
+        try:
+            print("Preparing the dataset tables for loading data")
+            tmpeng = connect_db()
+            prepared = prepare_schema(tmpeng, app.datasets)
+            print({tbl: result.get('status') for tbl, result in prepared.items()})
+            tmpeng.dispose()
+            print("Done preparing the dataset tables")
+        except Exception as e:
+            print("WARNING: Unable to prepare the dataset tables, they can be prepared later at /schema/prepare")
+            print("Here is the error message")
+            print(e)
+
+
+if multiprocessing.parent_process() is None:
+    setup_database()
 
 
 # This we can use for adding the login columns
@@ -10,6 +10,12 @@ from sqlalchemy import text
 from sqlalchemy.exc import ProgrammingError
 
 from .utils.db import metadata_summary
+from .utils.timing import read_timings
+from .utils.schema import invalidate_catalog
+from .utils.prepare import prepare_schema, SCHEMA_VERSION
+from .utils.lookups import lookup_cache
+from .utils.db import engine_stats
+from .utils.outbox import outbox_stats
 
 admin = Blueprint('admin', __name__)
 
@@ -368,6 +374,104 @@ def column_order():
 
 
 
+@admin.route('/schema/refresh', methods = ['GET','POST'])
+def refresh_schema():
+    # The checker caches the database schema (utils/schema.py)
+    # After tables or columns get changed, this clears the cache so the next upload sees the changes right away, rather than waiting for it to expire
+    # Each uwsgi worker has its own cache, but invalidate_catalog leaves a marker file that tells the others to reload theirs
+    authorized = session.get("AUTHORIZED_FOR_ADMIN_FUNCTIONS")
+    if not authorized:
+        return render_template('admin_password.html', redirect_route='schema/refresh')
+
+    invalidate_catalog()
+    return jsonify(message = "Schema cache cleared")
+
+
+@admin.route('/schema/prepare', methods = ['GET','POST'])
+def prepare_tables():
+    # Puts the system columns and the objectid/globalid defaults on the tables of all the datasets (see utils/prepare.py)
+    # The app does this when it starts up, this is for when a table got added or rebuilt since then
+    authorized = session.get("AUTHORIZED_FOR_ADMIN_FUNCTIONS")
+    if not authorized:
+        return render_template('admin_password.html', redirect_route='schema/prepare')
+
+    return jsonify(version = SCHEMA_VERSION, tables = prepare_schema(g.eng, current_app.datasets))
+
+
+@admin.route('/lookup-cache', methods = ['GET'])
+def lookup_cache_stats():
+    # hit/miss counts of the lookup list cache (utils/lookups.py) of the process that receives the request
+    # ?clear=true empties it
+    authorized = session.get("AUTHORIZED_FOR_ADMIN_FUNCTIONS")
+    if not authorized:
+        return render_template('admin_password.html', redirect_route='lookup-cache')
+
+    if str(request.args.get("clear")).strip().lower() == 'true':
+        lookup_cache.clear()
+
+    return jsonify(**lookup_cache.stats())
+
+
+@admin.route('/db-pool', methods = ['GET'])
+def db_pool_stats():
+    # connection pool statistics of the process that receives the request (see get_engine in utils/db.py)
+    authorized = session.get("AUTHORIZED_FOR_ADMIN_FUNCTIONS")
+    if not authorized:
+        return render_template('admin_password.html', redirect_route='db-pool')
+
+    return jsonify(engines = engine_stats())
+
+
+@admin.route('/outbox', methods = ['GET'])
+def outbox():
+    # how many emails are waiting to be sent, being sent, and failed (see utils/outbox.py)
+    authorized = session.get("AUTHORIZED_FOR_ADMIN_FUNCTIONS")
+    if not authorized:
+        return render_template('admin_password.html', redirect_route='outbox')
+
+    return jsonify(**outbox_stats())
+
+
+@admin.route('/timings', methods = ['GET'])
+def timings():
+    # Aggregates the timings.json files of all submissions, to see which datatypes and checks take the most time
+    # Optional query string args:
+    #   datatype - only that datatype
+    #   groupby - comma separated columns to group by (default datatype,name)
+    authorized = session.get("AUTHORIZED_FOR_ADMIN_FUNCTIONS")
+    if not authorized:
+        return render_template('admin_password.html', redirect_route='timings')
+
+    spans = pd.DataFrame(read_timings(os.path.join(os.getcwd(), "files")))
+    if spans.empty:
+        return jsonify(timings = [], submissions = 0)
+
+    datatype = request.args.get("datatype")
+    if datatype is not None:
+        spans = spans[spans.datatype == datatype]
+
+    groupby = [c.strip() for c in str(request.args.get("groupby", "datatype,name")).split(',')]
+    assert all([c in ('datatype', 'name', 'table') for c in groupby]), "groupby can only be datatype, name and/or table"
+
+    summary = spans.fillna({c: '' for c in groupby}).groupby(groupby).agg(
+        count        = ('wall', 'count'),
+        wall_total   = ('wall', 'sum'),
+        wall_mean    = ('wall', 'mean'),
+        wall_p95     = ('wall', lambda x: x.quantile(0.95)),
+        wall_max     = ('wall', 'max'),
+        cpu_mean     = ('cpu', 'mean'),
+        peak_mb_max  = ('peak_mb', 'max'),
+        rows_mean    = ('rows', 'mean')
+    ).reset_index().sort_values('wall_total', ascending = False)
+
+    summary = summary.round(4).astype(object).where(pd.notnull(summary), None)
+
+    return jsonify(
+        timings = summary.to_dict('records'),
+        submissions = int(spans.submissionid.nunique())
+    )
+
+
 @admin.route('/adminauth', methods = ['GET','POST'])
 def adminauth():
 
@@ -1,61 +1,151 @@
-import multiprocessing as mp
 import pandas as pd
 import time
 from itertools import chain
+from concurrent.futures.process import BrokenProcessPool
+from flask import current_app, session
 from .dupes import checkDuplicatesInSession, checkDuplicatesInProduction
 from .lookups import checkLookUpLists
-from .metadata import checkNotNull, checkPrecision, checkScale, checkLength, checkDataTypes, checkIntegers
-from .functions import fetch_meta, multitask
+from .metadata import checkNotNull, checkPrecision, checkScale, checkLength, checkDataTypes, checkIntegers, column_shapes
+from .functions import fetch_meta, core_context
+from .pool import get_pool, reset_pool, python_executable, SharedTable, run_check
+from .incremental import incremental_enabled, read_state, save_state, plan, finish
+from ..utils.timing import span, add_span
+from ..utils.resultcache import rules_version
 
 
-# goal here is to take in all_dfs as an argument and assemble the CoreChecker processes
-def core(all_dfs, eng, all_meta, debug = False):
+CORE_CHECKS = (
+    checkDataTypes,
+    checkDuplicatesInSession,
+    checkDuplicatesInProduction,
+    checkLookUpLists,
+    checkNotNull,
+    checkIntegers,
+    checkPrecision,
+    checkScale,
+    checkLength
+)
+
+
+# runs one core check on one table inside a timing span
+# (the checks in the pool processes do not have the app context, they give back their times and run_pool records them)
+def timed_check(check, df, tbl, eng, meta, **kwargs):
+    with span(check.__name__, table = tbl, rows = len(df)):
+        return check(df, tbl, eng, meta, **kwargs)
+
+
+# A task is one check on one table, and the dataframe it runs on might be just part of the table (see incremental.py)
+# The tasks that run on the same dataframe share its column shapes (and its block of shared memory in the pool)
 
+def run_serial(tasks, eng, all_meta, context):
     errs = []
+    shapes = dict()
+    for task in tasks:
+        tbl, df = task['table'], task['dataframe']
+        if df is None:
+            errs.append([])
+            continue
+
+        # precision, scale and length all work off the same analysis of the column values, so it is done once here
+        if id(df) not in shapes:
+            print(tbl)
+            with span("column_shapes", table = tbl, rows = len(df)):
+                shapes[id(df)] = column_shapes(df, all_meta[tbl], context['system_fields'])
+
+        errs.append(timed_check(task['check'], df, tbl, eng, all_meta[tbl], shapes = shapes[id(df)], context = context))
+    return errs
+
+
+def run_pool(tasks, eng, all_meta, context):
+    # every check of every table goes to the pool at once (see pool.py)
+    pool = get_pool(
+        int(current_app.config.get('CORE_CHECK_WORKERS', 4)),
+        python_executable(current_app.config)
+    )
+
+    shared = dict()
+    try:
+        futures = []
+        for task in tasks:
+            tbl, df = task['table'], task['dataframe']
+            if df is None:
+                futures.append(None)
+                continue
+            if id(df) not in shared:
+                with span("share_table", table = tbl, rows = len(df)):
+                    shared[id(df)] = SharedTable(
+                        dataframe = df,
+                        shapes = column_shapes(df, all_meta[tbl], context['system_fields'])
+                    )
+            futures.append(pool.submit(run_check, task['check'], shared[id(df)].block, tbl, eng.url, all_meta[tbl], context))
+
+        # same order as running them one at a time
+        with span("core_pool", rows = sum(len(t['dataframe']) for t in tasks if t['dataframe'] is not None)):
+            errs = []
+            for task, f in zip(tasks, futures):
+                if f is None:
+                    errs.append([])
+                    continue
+                result, wall, cpu = f.result()
+                add_span(task['check'].__name__, wall, cpu, table = task['table'], rows = len(task['dataframe']), worker = True)
+                errs.append(result)
+            return errs
+    finally:
+        for table in shared.values():
+            table.unlink()
+
+
+# goal here is to take in all_dfs as an argument and run the core checks on all of them
+# debug = True runs the checks one at a time in this process, which gives more useful logs, and timings for each check
+def core(all_dfs, eng, all_meta, debug = False):
+
+    context = core_context()
     warnings = []
-    for tbl, df in all_dfs.items():
-        print(tbl)
-        errs.extend(
-            [
-                checkDataTypes(df, tbl, eng, all_meta[tbl]),
-                checkDuplicatesInSession(df, tbl, eng, all_meta[tbl]),
-                checkDuplicatesInProduction(df, tbl, eng, all_meta[tbl]),
-                checkLookUpLists(df, tbl, eng, all_meta[tbl]),
-                checkNotNull(df, tbl, eng, all_meta[tbl]),
-                checkIntegers(df, tbl, eng, all_meta[tbl]),
-                checkPrecision(df, tbl, eng, all_meta[tbl]),
-                checkScale(df, tbl, eng, all_meta[tbl]),
-                checkLength(df, tbl, eng, all_meta[tbl])
-            ]
-            
-            if debug 
-            else
-            
-            multitask(
-                [
-                    checkDuplicatesInSession,
-                    checkDuplicatesInProduction,
-                    checkLookUpLists,
-                    checkNotNull,
-                    checkIntegers,
-                    checkPrecision,
-                    checkScale,
-                    checkLength,
-                    checkDataTypes
-                ],
-                df,
-                tbl,
-                eng,
-                all_meta[tbl]
-            )
-        )
-
-        # warnings.extend(
-        #     [checkScale(df, tbl, eng, all_meta[tbl])]
-        #     if debug 
-        #     else
-        #     multitask([checkScale], df, tbl, eng, all_meta[tbl])
-        # )
+
+    # If the same submission was uploaded before, the checks only run on what changed since then (see incremental.py)
+    state, version = None, None
+    if incremental_enabled(current_app.config):
+        with span("core_diff", rows = sum(len(df) for df in all_dfs.values())) as s:
+            try:
+                # the context is part of it since checkDuplicatesInProduction only runs for final submit
+                version = f"{rules_version(eng, current_app, session.get('login_info'))}:{context.get('final_submit_requested')}:{','.join(c.__name__ for c in CORE_CHECKS)}"
+                state = read_state(session['submission_dir'], version)
+            except Exception as e:
+                print("Unable to read the state of the last upload, running the core checks on everything")
+                print(e)
+                version = None
+            s['incremental'] = state is not None
+            tasks, frames = plan(all_dfs, eng, context, CORE_CHECKS, state)
+    else:
+        tasks, frames = plan(all_dfs, eng, context, CORE_CHECKS, None)
+
+    if debug or int(current_app.config.get('CORE_CHECK_WORKERS', 4)) == 0:
+        results = run_serial(tasks, eng, all_meta, context)
+    else:
+        try:
+            results = run_pool(tasks, eng, all_meta, context)
+        except BrokenProcessPool as e:
+            # a worker died (or could not start) - start a fresh pool next time, and just run them one at a time for now
+            print("WARNING: core check pool is broken, running the core checks one at a time")
+            print(e)
+            reset_pool()
+            results = run_serial(tasks, eng, all_meta, context)
+
+    errs = [finish(task, result) for task, result in zip(tasks, results)]
+
+    # the results get kept for the next upload of this submission
+    if version is not None:
+        for task, result in zip(tasks, errs):
+            if task['table'] in frames:
+                frames[task['table']].setdefault('results', dict())[task['check'].__name__] = result
+        try:
+            save_state(session['submission_dir'], version, frames)
+        except Exception as e:
+            print("Unable to save the state of the core checks, the next upload will run them on everything")
+            print(e)
+
+    # warnings.extend(
+    #     [checkScale(df, tbl, eng, all_meta[tbl])]
+    # )
 
     # flatten the lists
     # bug: 'ascii' codec can't encode character '\xb0' in position 2344: ordinal not in range(128) - app crashes here -- likely occuring when printing errs
@@ -67,4 +157,3 @@ def core(all_dfs, eng, all_meta, debug = False):
         "core_errors": [e for sublist in errs for e in sublist if ( e != dict() and e != set() )],
         "core_warnings": [w for sublist in warnings for w in sublist if ( w != dict() and w != set() )]
     }
-    
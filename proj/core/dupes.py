@@ -1,24 +1,30 @@
-import re
+import re, csv
 import pandas as pd
+from io import StringIO
+from uuid import uuid4
 from pandas import isnull, read_sql, concat
-from .functions import checkData, get_primary_key
-from flask import current_app, session
+from .functions import checkData, get_primary_key, core_context, check_scope
+from ..utils.schema import get_catalog
 
 # All the functions for the Core Checks should have the dataframe and the datatype as the two main arguments
-# This is to allow the multiprocessing to work, so it can pass in the same args to all the functions
-# Of course it would be possible to do it otherwise, but the mutlitask function we wrote in utils assumes 
-# the case that all of the functions have the same arguments
+# This is so core can call all of them the same way, whether they run one at a time or in the core check pool (see pool.py)
+# They also should not use current_app or session directly, whatever they need from those comes in the context (see core_context)
+# the columns the duplicates within the submission are checked on
+def session_pkey(tablename, eng, context):
+    # For duplicates within session, dataprovider is not necessary to check
+    # Since it is assumed that all records within the submission are from the same dataprovider
+    return [col for col in get_primary_key(tablename, eng) if col not in context['system_fields']]
+
+
+@check_scope('group', keys = session_pkey)
 def checkDuplicatesInSession(dataframe, tablename, eng, *args, output = None, **kwargs):
     """
     check for duplicates in session only
     """
     print("BEGIN function - checkDuplicatesInSession")
+    context = kwargs.get('context') or core_context()
     
-    pkey = get_primary_key(tablename, eng)
-
-    # For duplicates within session, dataprovider is not necessary to check
-    # Since it is assumed that all records within the submission are from the same dataprovider
-    pkey = [col for col in pkey if col not in current_app.system_fields]
+    pkey = session_pkey(tablename, eng, context)
 
     # initialize return value
     ret = []
@@ -52,13 +58,16 @@ def checkDuplicatesInSession(dataframe, tablename, eng, *args, output = None, **
     return ret
 
 
+# each row is checked against what is already in the database, not against the other rows
+@check_scope('row')
 def checkDuplicatesInProduction(dataframe, tablename, eng, *args, output = None, **kwargs):
     """
     check for duplicates in Production only
     """
     print("BEGIN function - checkDuplicatesInProduction")
+    context = kwargs.get('context') or core_context()
     
-    if session.get("final_submit_requested") == False:
+    if context.get("final_submit_requested") == False:
         return []
 
     pkey = get_primary_key(tablename, eng)
@@ -71,70 +80,154 @@ def checkDuplicatesInProduction(dataframe, tablename, eng, *args, output = None,
         print("No Primary Key")
         return ret
 
-   
-    current_recs = read_sql(f"SELECT DISTINCT {','.join(pkey)} FROM {tablename}", eng)
-    
-    import time
-    print("are there current_recs in the database?")
-    print(not current_recs.empty)
-    time.sleep(1)
-    if not current_recs.empty:
-
-    
-        for dt in list(zip(current_recs.dtypes.index, current_recs.dtypes)):
-            col = dt[0]
-            typ = dt[1]
-            assert len(dt) > 1, "Error in dupes - some item in current_recs.dtypes didnt have a length greater than 1"
-            assert col in dataframe.columns, f"supposed primary key column {col} not found in columns of the dataframe that was matched with {tablename}"
+    positions = existing_keys(dataframe, tablename, pkey, eng)
+    if positions is None:
+        # the key values didnt fit the datatypes of the table, in which case the datatypes check should have caught it
+        if output:
+            output.put(ret)
+        return ret
 
-            try:
-                # Coerce datatypes of primary key columns to match so that the two dataframes can merge 
-                if typ == 'object':
-                    dataframe[col] = dataframe[col].astype(typ).apply(lambda x: str(x).strip())
-                    current_recs[col] = current_recs[col].astype(typ).apply(lambda x: str(x).strip())
-                else:
-                    dataframe[col] = dataframe[col].astype(typ)
-            except Exception as e:
-                # An exception should only occur if the column was not able to be coerced to the correct datatype, in which case the datatypes check should have caught it
-                print(e)
-                if output:
-                    output.put(ret)
-                return ret
-                
+    # existing_keys gives back positions, the errors need the index labels
+    #   they are the same thing for a whole table read from the excel file, but not for the changed rows of an incremental run
+    badrows = dataframe.index[positions].tolist()
 
-        # tack on a column to identify records that have been prviously submitted
-        current_recs = current_recs.assign(already_in_db = True)
+    print("badrows")
+    print(badrows)
 
-        # merge current recs with a left merge and tack on that "already_in_db" column
-        dataframe = dataframe.merge(current_recs, on = pkey, how = 'left')
+    ret = [
+        checkData(
+            dataframe = dataframe,
+            tablename = tablename,
+            badrows = badrows,
+            badcolumn = ','.join([col for col in pkey if col not in context['system_fields']]),
+            error_type = "Duplicate",
+            is_core_error = True,
+            error_message = "This is a record which already exists in the database"
+        )
+    ]
 
-        badrows = dataframe[dataframe.already_in_db == True].index.tolist()
-
-        print("badrows")
-        print(badrows)
-        
-        print("tablename")
-        print(tablename)
-        
-        time.sleep(1)
-
-        ret = [
-            checkData(
-                dataframe = dataframe,
-                tablename = tablename,
-                badrows = badrows,
-                badcolumn = ','.join([col for col in pkey if col not in current_app.system_fields]),
-                error_type = "Duplicate",
-                is_core_error = True,
-                error_message = "This is a record which already exists in the database"
-            )
-        ]
-
-        if output:
-            output.put(ret)
+    if output:
+        output.put(ret)
 
         
     print("END function - checkDuplicatesInProduction")
     return ret
 
 
+# This used to pull every primary key of the table out of the database (SELECT DISTINCT pkey FROM table) and merge it with the submission in pandas
+# Tables like tbl_chemresults keep growing through the cycle, so that kept getting slower
+# Now the keys of the submission get copied into a temp table, and the join happens in the database where it can use the primary key index
+# Only the row numbers of the submission rows that are already in the table come back
+def existing_keys(dataframe, tablename, pkey, eng):
+    '''
+    row numbers (positions) of the rows of the dataframe that have a primary key which is already in the table
+    returns None if the key values can not be put in columns of the same datatypes as the table
+    '''
+    udt_names = get_catalog(eng).columns(tablename).set_index('column_name').udt_name
+
+    keys = pd.DataFrame({"checker_rownum": range(len(dataframe))})
+    for col in pkey:
+        assert col in dataframe.columns, f"supposed primary key column {col} not found in columns of the dataframe that was matched with {tablename}"
+        values = dataframe[col].reset_index(drop = True)
+
+        if udt_names[col].startswith('int'):
+            # an integer column might come in as 1.0, which postgres wont take for an integer
+            try:
+                values = pd.to_numeric(values)
+            except Exception as e:
+                print(e)
+                return None
+            if not (values.dropna() % 1 == 0).all():
+                return None
+            values = values.astype('Int64')
+        elif values.dtype == object:
+            # the values used to get stripped before being compared
+            values = values.where(isnull(values), values.astype(str).str.strip())
+
+        keys[col] = values
+
+    temptable = f"tmp_dupes_{uuid4().hex}"
+    buffer = keys_csv(keys)
+
+    conn = eng.raw_connection()
+    try:
+        cursor = conn.cursor()
+
+        # the temp table goes away at the end of the transaction, which we roll back at the end either way
+        # the key columns get the same types as the table, so the join can use the primary key index
+        cursor.execute(
+            f"""
+            CREATE TEMP TABLE {temptable} (
+                checker_rownum INTEGER,
+                {', '.join([f'"{col}" {udt_names[col]}' for col in pkey])}
+            ) ON COMMIT DROP;
+            """
+        )
+        try:
+            cursor.copy_expert(
+                f"""COPY {temptable} FROM STDIN WITH (FORMAT csv, FORCE_NULL ({', '.join([f'"{col}"' for col in pkey])}))""",
+                buffer
+            )
+        except Exception as e:
+            # COPY fails if a value does not fit the datatype of the column, but that should not mean there are no duplicates
+            #   so it goes back to comparing the keys the old way
+            print("Unable to copy the keys to a temp table, checking for duplicates with the keys of the whole table instead")
+            print(e)
+            conn.rollback()
+            return existing_keys_by_query(dataframe, tablename, pkey, eng)
+
+        cursor.execute(f"ANALYZE {temptable};")
+        cursor.execute(
+            f"""
+            SELECT t.checker_rownum FROM {temptable} t
+            WHERE EXISTS (
+                SELECT 1 FROM "{tablename}" p WHERE {' AND '.join([f'p."{col}" = t."{col}"' for col in pkey])}
+            )
+            ORDER BY t.checker_rownum;
+            """
+        )
+        badrows = [r[0] for r in cursor.fetchall()]
+        conn.rollback()
+    finally:
+        conn.close()
+
+    return badrows
+
+
+def keys_csv(keys):
+    '''
+    the keys as csv for COPY, in a buffer that is ready to be read
+    every value gets quoted like copy_csv in utils/db.py, since to_csv leaves a value with a carriage return in it unquoted, and COPY fails on it
+    an empty quoted value is NULL (FORCE_NULL)
+    '''
+    buffer = StringIO()
+    keys.to_csv(buffer, index = False, header = False, quoting = csv.QUOTE_ALL, lineterminator = '\n')
+    buffer.seek(0)
+    return buffer
+
+
+def existing_keys_by_query(dataframe, tablename, pkey, eng):
+    '''
+    The way it used to be done - every primary key of the table, merged with the submission in pandas
+    row numbers (positions) like existing_keys, or None if the key values can not be made the same datatypes as the ones in the table
+    '''
+    current_recs = read_sql(f"SELECT DISTINCT {','.join(pkey)} FROM {tablename}", eng)
+    if current_recs.empty:
+        return []
+
+    keys = dataframe[pkey].reset_index(drop = True)
+    for col, typ in current_recs.dtypes.items():
+        try:
+            # Coerce datatypes of primary key columns to match so that the two dataframes can merge
+            if typ == 'object':
+                keys[col] = keys[col].astype(typ).apply(lambda x: str(x).strip())
+                current_recs[col] = current_recs[col].astype(typ).apply(lambda x: str(x).strip())
+            else:
+                keys[col] = keys[col].astype(typ)
+        except Exception as e:
+            # An exception should only occur if the column was not able to be coerced to the correct datatype, in which case the datatypes check should have caught it
+            print(e)
+            return None
+
+    keys = keys.assign(checker_rownum = range(len(keys))).merge(current_recs.drop_duplicates().assign(already_in_db = True), on = pkey, how = 'left')
+    return keys[keys.already_in_db == True].checker_rownum.tolist()
@@ -1,9 +1,12 @@
 import pandas as pd
-import multiprocessing as mp
+import numpy as np
 import re, time
 from math import log10
 from functools import lru_cache
 import datetime
+from flask import current_app, session
+
+from ..utils.schema import get_catalog
 
 def checkData(dataframe, tablename, badrows, badcolumn, error_type, is_core_error = True, error_message = "Error", errors_list = [], q = None):
     if len(badrows) > 0:
@@ -31,31 +34,31 @@ def checkData(dataframe, tablename, badrows, badcolumn, error_type, is_core_erro
         
       
 
-# For the sake of checking the data in multiple ways at the same time
-def multitask(functions: list, *args):
-    '''funcs is a list of functions that will be turned into processes'''
-    output = mp.Queue()
-    processes = [
-        mp.Process(target = function, args = (*args,), kwargs = {'output': output}) 
-        for function in functions
-    ]
-
-    starttime = time.time()
-    for p in processes:
-        print("starting a process")
-        p.start()
-        
-    for p in processes:
-        print("joining processes")
-        p.join()
-
-    finaloutput = []
-    while output.qsize() > 0:
-        finaloutput.append(output.get())
-    print("output from the multitask/mutliprocessing function")
-    print("did this print the finaloutput")
-    print(finaloutput)
-    return finaloutput
+# The parts of the app configuration and the session that the core checks use
+# The checks get this passed in as context, so they also work in the core check pool where there is no app or session (see pool.py)
+# If a check gets called without it (from a custom check for example) it builds it from the app and session itself
+def core_context():
+    return {
+        "system_fields"          : list(current_app.system_fields),
+        "script_root"            : current_app.script_root,
+        "final_submit_requested" : session.get("final_submit_requested")
+    }
+
+
+# Declares what the result of a check for a row depends on, which is what lets the checks run on only the rows that changed (see incremental.py)
+#   'row'   - just the values in that row (and the reference data, lookup lists etc)
+#   'group' - the other rows with the same values in the keys columns
+#             keys is a function of (tablename, eng, context) that gives the columns, since it is usually the primary key
+#   'table' - all of the rows, so the check always runs on the whole table
+# A check without a declaration is treated as 'table'
+def check_scope(scope, keys = None):
+    assert scope in ('row', 'group', 'table'), f"check_scope - unknown scope {scope}"
+    assert (scope != 'group') or (keys is not None), "check_scope - a group scoped check needs the keys of the groups"
+    def decorator(func):
+        func.scope = scope
+        func.scope_keys = keys
+        return func
+    return decorator
 
 
 
@@ -97,145 +100,253 @@ def convert_dtype(t, x):
         
         return False
 
-@lru_cache(maxsize=128, typed=True)
-def check_precision(x, precision):
 
-    try:
-        int(x)
-    except Exception as e:
-        # if you cant call int on it, its not numeric
-        # Meaning it is not valid to check precision
-        # thus we return true.
-        # if its the wrong datatype it should get picked up by that check
-        return True
+# Column at a time version of convert_dtype, for checkDataTypes
+# Applying convert_dtype to every cell was most of the time spent on core checks for the bigger chemistry submissions,
+#   and the lru_cache doesnt help when there are hundreds of thousands of distinct values
+# This flags exactly the same values as convert_dtype does
+#   the common cases (numbers, plain number strings, timestamps) are done with vectorized masks
+#   anything else falls back to convert_dtype itself, so the odd values still get the same answer they always did
+TIMESTAMP_PATTERN = re.compile(r"\d{4}-\d{1,2}-\d{1,2}\s*(\d{1,2}:\d{1,2}:\d{2}(\.\d+){0,1}){0,1}$")
+
+# Strings that float() will definitely accept. Strings that dont match this go to convert_dtype (float accepts things like " 1_000 " and "inf" too)
+FLOAT_STRING_PATTERN = re.compile(r"[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?")
+
+# int(x) works and the string is only digits, with an optional minus sign in front.
+# \d is the same set of digits that int() accepts
+INT_STRING_PATTERN = re.compile(r"-?\d+")
+
+# str() of floats at or above this switches to scientific notation, which convert_dtype does not consider an integer
+MAX_PLAIN_FLOAT = 1e16
+
+def invalid_dtype_mask(series, t):
+    '''
+    Boolean series, True where the value is not valid for the python datatype t (the dtype column of the meta dataframe)
+    Same as series.apply(lambda x: not convert_dtype(t, x)), just faster
+    '''
+    if t == str:
+        # anything can be turned into a string
+        return pd.Series(False, index = series.index)
+
+    if t not in (int, float, pd.Timestamp):
+        # convert_dtype can only call t(x) and fail for these (the None datatypes of fetch_meta)
+        return series.apply(lambda x: not convert_dtype.__wrapped__(t, x)).astype(bool)
+
+    if t == pd.Timestamp:
+        # convert_dtype comes down to whether str(x) matches the postgres timestamp pattern, whether or not pd.Timestamp(x) works
+        if pd.api.types.is_datetime64_dtype(series):
+            # tz naive timestamps always print as YYYY-MM-DD HH:MM:SS[.fff], and NaT prints as NaT
+            return series.isnull()
+        return ~series.map(str).str.match(TIMESTAMP_PATTERN).astype(bool)
+
+    # int and float
+    if pd.api.types.is_bool_dtype(series):
+        # float(True) works, but str(True) is not digits
+        return pd.Series(t == int, index = series.index)
+    if pd.api.types.is_integer_dtype(series):
+        # only the nullable Int64 columns can have nulls - float(pd.NA) does not work, int gets a pass for nulls
+        return series.isnull() if t == float else pd.Series(False, index = series.index)
+    if pd.api.types.is_float_dtype(series) and series.dtype == 'float64':
+        if t == float:
+            return pd.Series(False, index = series.index)
+        return ~_integral_float_mask(series)
+
+    if series.dtype != object:
+        return series.apply(lambda x: not convert_dtype.__wrapped__(t, x)).astype(bool)
+
+    # object columns have a mix of types, so split them up by type
+    # (plain numpy masks here, since the index of the dataframe is not guaranteed to be unique)
+    types = series.map(type).to_numpy()
+    values = series.to_numpy()
+    valid = np.zeros(len(series), dtype = bool)
+    decided = np.zeros(len(series), dtype = bool)
+
+    # ints - str(x) is all digits so both int and float accept them
+    ints = pd.Series(types).isin([int, np.int64, np.int32, np.int16, np.int8]).to_numpy()
+    valid[ints] = True
+    decided[ints] = True
+
+    floats = pd.Series(types).isin([float, np.float64]).to_numpy()
+    if t == float:
+        # NaN included, float(nan) works
+        valid[floats] = True
+    else:
+        valid[floats] = _integral_float_mask(pd.Series(values[floats], dtype = 'float64')).to_numpy()
+    decided[floats] = True
+
+    strings = (types == str)
+    if strings.any():
+        pattern = FLOAT_STRING_PATTERN if t == float else INT_STRING_PATTERN
+        matched = pd.Series(values[strings], dtype = object).str.fullmatch(pattern).astype(bool).to_numpy()
+        valid[strings] = matched
+        if t == float:
+            # the ones that dont match might still be accepted by float(), those go to the fallback
+            decided[np.flatnonzero(strings)[matched]] = True
+        else:
+            decided[strings] = True
 
-    if pd.isnull(precision):
-        return True
+    # None, bools, Timestamps, odd strings and whatever else is left
+    rest = ~decided
+    if rest.any():
+        valid[rest] = [convert_dtype.__wrapped__(t, x) for x in values[rest]]
 
-    try:
-        if not isinstance(x, (int, float)):
-            x = float(str(x))
-    except Exception as e:
-        # If an exception occurs here, their data must be really messed up and we'll have to trust that checkDataTypes will flag it
-        return True
-    
+    return pd.Series(~valid, index = series.index)
 
-    x = abs(x)
-    
-    if 0 < x < 1:
-        # if x is a fraction, it doesnt matter. it should be able to go into a numeric field regardless
-        return True
-    left = int(log10(x)) + 1 if x > 0 else 1
-    if 'e-' in str(x):
-        # The idea is if the number comes in in scientific notation
-        # it will look like 7e11 or something like that
-        # We dont care if it is to a positive power of 10 since that doesnt affect the digits to the right
-        # we care if it's a negative power, which looks like 7.23e-5 (.0000723)
-        powerof10 = int(str(x).split('e-')[-1])
-        
-        # search for the digits to the right of the decimal place
-        rightdigits = re.search("\.(\d+)",str(x).split('e-')[0])
-        
-        if rightdigits: # if its not a NoneType, it found a match
-            rightdigits = rightdigits.groups()[0]
-            right = powerof10 + len(rightdigits)
-        else:
-            right = 0
-    else:
-        # frac part is zero if there is no decimal place, or if it came in with scientific notation
-        # because this else block represents the case where the power was positive
-        
-        frac_part = abs(int(re.sub("\d*\.","",str(x)))) if ( '.' in str(x) ) and ('e' not in str(x)) else 0
-        
-        # remove trailing zeros (or zeroes?)
-        if frac_part > 0:
-            while (frac_part % 10 == 0):
-                frac_part = int(frac_part / 10)
 
-        right = len(str(frac_part)) if frac_part > 0 else 0
-    return True if left + right <= precision else False
+def _integral_float_mask(series):
+    # For float64 values, True where convert_dtype(int, x) is True
+    # nulls are fine, otherwise the value must be a whole number that str() doesnt write in scientific notation
+    values = series.to_numpy(dtype = 'float64')
+    with np.errstate(invalid = 'ignore'):
+        whole = np.isfinite(values) & (np.floor(values) == values) & (np.abs(values) < MAX_PLAIN_FLOAT)
+    return pd.Series(np.isnan(values) | whole, index = series.index)
 
-@lru_cache(maxsize=128, typed=True)
-def check_scale(x, scale):
+
+# Numeric shape of a whole column, for checkPrecision and checkScale
+# Those checks used to call check_precision and check_scale on every value (str(x), re.sub, log10 and a while loop for each one)
+#   and the lru_cache in front of them was no help with so many distinct values
+# numeric_shape works out the same numbers for the whole column at once:
+#   checked  - False where the value is skipped because int(x) doesnt work on it (nan, None, "1.5" etc) - checkDataTypes deals with those
+#   fraction - 0 < abs(x) < 1, which checkPrecision lets through
+#   left     - digits to the left of the decimal place
+#   right    - digits to the right of it, counted from str(x) with trailing zeros dropped, and 7.2e-05 counts as 6
+#              Same as check_scale did, leading zeros after the decimal get dropped too, so 0.05 counts as 1
+# The common types are done with numpy and the string methods, anything else goes through _numeric_shape_scalar
+#   which is the old check_precision/check_scale code for one value
+
+# strings that int() accepts, that are short enough that turning them into a float is exact
+ASCII_INT_PATTERN = re.compile(r"[-+]?[0-9]{1,15}")
+
+MAX_FLOAT_INT = 10**300
+
+def _numeric_shape_scalar(x):
     try:
         int(x)
     except Exception as e:
-        # if you cant call int on it, its not numeric
-        # Meaning it is not valid to check precision
-        # thus we return true.
-        # if its the wrong datatype it should get picked up by that check
-        return True
-    if pd.isnull(scale):
-        return True
-    
+        return (False, False, 0, 0)
     try:
         if not isinstance(x, (int, float)):
             x = float(str(x))
     except Exception as e:
-        # If an exception occurs here, their data must be really messed up and we'll have to trust that checkDataTypes will flag it
-        return True
-    
+        return (False, False, 0, 0)
+
     x = abs(x)
+    left = int(log10(x)) + 1 if x >= 1 else 1
     if 'e-' in str(x):
-        # The idea is if the number comes in in scientific notation
-        # it will look like 7e11 or something like that
-        # We dont care if it is to a positive power of 10 since that doesnt affect the digits to the right
-        # we care if it's a negative power, which looks like 7.23e-5 (.0000723)
         powerof10 = int(str(x).split('e-')[-1])
-        
-        # search for the digits to the right of the decimal place
-        rightdigits = re.search("\.(\d+)",str(x).split('e-')[0])
-        
-        if rightdigits: # if its not a NoneType, it found a match
-            rightdigits = rightdigits.groups()[0]
-            right = powerof10 + len(rightdigits)
-        else:
-            right = 0
+        rightdigits = re.search(r"\.(\d+)", str(x).split('e-')[0])
+        right = powerof10 + len(rightdigits.groups()[0]) if rightdigits else 0
     else:
-        # frac part is zero if there is no decimal place, or if it came in with scientific notation
-        # because this else block represents the case where the power was positive
-        #print('HERE')
-        #print(x)
-        #print(str(x))
-        frac_part = abs(int(re.sub("\d*\.","",str(x)))) if ( '.' in str(x) ) and ('e' not in str(x)) else 0
-        #print('NO')
-        
-        # remove trailing zeros (or zeroes?)
-        if frac_part > 0:
-            while (frac_part % 10 == 0):
-                frac_part = int(frac_part / 10)
-
-        right = len(str(frac_part)) if frac_part > 0 else 0
-    return True if right <= scale else False
-
-@lru_cache(maxsize=128, typed=True)
-def check_length(x, maxlength):
-    if pd.isnull(maxlength):
-        return True
-    return True if len(str(x)) <= int(maxlength) else False
+        frac_part = abs(int(re.sub(r"\d*\.", "", str(x)))) if ('.' in str(x)) and ('e' not in str(x)) else 0
+        right = len(str(frac_part).rstrip('0')) if frac_part > 0 else 0
+    return (True, 0 < x < 1, left, right)
+
+
+def _right_digits(r):
+    # digits to the right of the decimal place of str(abs(x))
+    mantissa, e, power = r.partition('e')
+    frac_part = mantissa.partition('.')[2]
+    if power.startswith('-'):
+        # 7.23e-05 is .0000723
+        return int(power[1:]) + len(frac_part) if frac_part else 0
+    if e:
+        return 0
+    return len(frac_part.strip('0'))
+
+
+def _float_shape(values):
+    # shape of a float64 array, same as _numeric_shape_scalar would give for each value
+    values = np.abs(values.astype('float64'))
+    checked = np.isfinite(values)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        left = np.where(checked & (values >= 1), np.floor(np.log10(values)) + 1, 1)
+
+    right = np.zeros(len(values), dtype = 'int64')
+    if checked.any():
+        # str() is the only way to know how many decimal places python would show for the float
+        right[checked] = [_right_digits(r) for r in map(str, values[checked].tolist())]
+
+    return pd.DataFrame({
+        "checked"  : checked,
+        "fraction" : checked & (values > 0) & (values < 1),
+        "left"     : left.astype('int64'),
+        "right"    : right
+    })
+
+
+def numeric_shape(series):
+    '''
+    DataFrame with the columns checked, fraction, left and right (see above) for every value of the series, with the same index
+    '''
+    if pd.api.types.is_bool_dtype(series) or pd.api.types.is_integer_dtype(series) or (series.dtype == 'float64'):
+        shape = _float_shape(series.to_numpy(dtype = 'float64'))
+        shape.index = series.index
+        return shape
+
+    values = series.to_numpy(dtype = object)
+    types = pd.Series(series.map(type).to_numpy())
+    shape = pd.DataFrame({
+        "checked"  : np.zeros(len(values), dtype = bool),
+        "fraction" : np.zeros(len(values), dtype = bool),
+        "left"     : np.ones(len(values), dtype = 'int64'),
+        "right"    : np.zeros(len(values), dtype = 'int64')
+    })
+    decided = np.zeros(len(values), dtype = bool)
+
+    # python and numpy numbers (bool is an int, so True is checked like a 1)
+    numbers = types.isin([int, bool, float, np.int64, np.float64]).to_numpy()
+    if numbers.any():
+        # except for ints too big for a float, those go through the slow way
+        numbers[numbers] = [(type(x) is not int) or (abs(x) < MAX_FLOAT_INT) for x in values[numbers]]
+        positions = np.flatnonzero(numbers)
+        shape.loc[positions] = _float_shape(values[numbers].astype('float64')).set_index(positions)
+        decided[positions] = True
+
+    strings = (types == str).to_numpy()
+    if strings.any():
+        strvalues = pd.Series(values[strings], dtype = object)
+
+        # int() doesnt accept anything with a decimal point or an exponent, so those are skipped like before
+        not_int = strvalues.str.contains(r"[.eE]").to_numpy()
+        decided[np.flatnonzero(strings)[not_int]] = True
+
+        plain_int = strvalues.str.fullmatch(ASCII_INT_PATTERN).to_numpy(dtype = bool)
+        if plain_int.any():
+            positions = np.flatnonzero(strings)[plain_int]
+            shape.loc[positions] = _float_shape(strvalues[plain_int].astype('float64').to_numpy()).set_index(positions)
+            decided[positions] = True
+
+    # None, Timestamps, numpy bools, strings with spaces or underscores etc
+    rest = np.flatnonzero(~decided)
+    if len(rest) > 0:
+        shape.loc[rest] = pd.DataFrame([_numeric_shape_scalar(x) for x in values[rest]], columns = shape.columns, index = rest)
+
+    shape = shape.astype({"checked": bool, "fraction": bool, "left": 'int64', "right": 'int64'})
+    shape.index = series.index
+    return shape
+
+
+def text_length(series):
+    '''length of str(x) for every value of the series, NaN where the value is null'''
+    return series.astype(str).str.len().where(~pd.isnull(series))
 
 
 
 def fetch_meta(tablename, eng, return_converters = False, string_converter_dict_name = "string_converters", timestamp_converter_dict_name = "timestamp_converters"):
 
-    meta = pd.read_sql(
-            f"""
-            SELECT 
-                table_name, 
-                column_name, 
-                is_nullable, 
-                data_type,
-                udt_name, 
-                character_maximum_length, 
-                numeric_precision, 
-                numeric_scale 
-            FROM 
-                information_schema.columns 
-            WHERE 
-                table_name = '{tablename}';
-            """, 
-            eng
-        )
+    # The column information comes from the schema catalog rather than querying information_schema every time (see utils/schema.py)
+    meta = get_catalog(eng).columns(tablename)[
+        [
+            'table_name', 
+            'column_name', 
+            'is_nullable', 
+            'data_type',
+            'udt_name', 
+            'character_maximum_length', 
+            'numeric_precision', 
+            'numeric_scale' 
+        ]
+    ]
 
     meta['dtype'] = meta \
         .udt_name \
@@ -270,22 +381,6 @@ def fetch_meta(tablename, eng, return_converters = False, string_converter_dict_
 # This function allows you to put in a table name and get back the primary key fields of the table
 def get_primary_key(tablename, eng):
     # eng is a sqlalchemy database connection
-
-    # This query gets us the primary keys of a table. Not in a python friendly format
-    # Copy paste to Navicat, pgadmin, or do a pd.read_sql to see what it gives
-    pkey_query = f"""
-        SELECT 
-            c.column_name, 
-            c.data_type
-        FROM information_schema.table_constraints tc 
-        JOIN information_schema.constraint_column_usage AS ccu USING (constraint_schema, constraint_name) 
-        JOIN information_schema.columns AS c ON c.table_schema = tc.constraint_schema
-            AND tc.table_name = c.table_name AND ccu.column_name = c.column_name
-        WHERE constraint_type = 'PRIMARY KEY' and tc.table_name = '{tablename}';
-    """
-    pkey_df = pd.read_sql(pkey_query, eng)
-    
-    pkey = pkey_df.column_name.tolist() if not pkey_df.empty else []
-    
-    return pkey
+    # The primary keys of all the tables get loaded at once in the schema catalog (see utils/schema.py)
+    return get_catalog(eng).primary_key(tablename)
 
@@ -0,0 +1,185 @@
+import os, pickle
+import pandas as pd
+from pandas.util import hash_pandas_object
+
+from .functions import get_primary_key
+
+# Incremental core checks
+# The usual way it goes is someone uploads, fixes the 30 cells that got flagged, uploads again, and waits for all of the checks again
+# After the core checks run, the row hashes of each table (keyed by the primary key) and the results of each check are kept in the submission directory
+# On the next upload, each table gets compared to that by its primary key, and a row is "changed" if its key is new, or the hash of the row is different
+#   - 'row' checks only run on the changed rows. The results of the rows that did not change come from the last upload
+#   - 'group' checks run on the rows in the groups that have a changed (or removed) row in them, the rest comes from the last upload
+#   - 'table' checks (and any check without a declaration) run on the whole table like always
+# see check_scope in functions.py for how a check declares which of those it is
+#
+# The state is only used if the rules version is the same as when it was saved (same code, config, login and reference data, see utils/resultcache.py)
+#   and only for tables with the same columns as last time, and a primary key
+# Rows with a key that shows up more than once can not be matched up with the last upload, so they always count as changed
+#
+# Config: INCREMENTAL_CORE_CHECKS ("True" by default, "False" always runs the checks on everything)
+
+STATE_FILENAME = 'core_state.pkl'
+HASH_COLUMN = '_row_hash'
+INDEX_COLUMN = '_row_index'
+
+
+def incremental_enabled(config):
+    return str(config.get('INCREMENTAL_CORE_CHECKS', 'True')) == 'True'
+
+
+def read_state(submission_dir, version):
+    path = os.path.join(submission_dir, STATE_FILENAME)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+    except Exception as e:
+        print("Unable to read the core check state of the last upload")
+        print(e)
+        return None
+    if state.get('version') != version:
+        print("The rules changed since the last upload, running the core checks on everything")
+        return None
+    return state
+
+
+def save_state(submission_dir, version, tables):
+    path = os.path.join(submission_dir, STATE_FILENAME)
+    with open(f"{path}.tmp", 'wb') as f:
+        pickle.dump({"version": version, "tables": tables}, f, protocol = pickle.HIGHEST_PROTOCOL)
+    os.replace(f"{path}.tmp", path)
+
+
+def row_hashes(dataframe):
+    '''
+    One hash per row, of the values and their types
+    The types matter since the checks treat 1 and "1" differently, and for object columns pandas hashes everything as a string
+    '''
+    parts = dict()
+    for col in dataframe.columns:
+        parts[col] = dataframe[col]
+        if dataframe[col].dtype == object:
+            parts[f"{col} type"] = dataframe[col].map(type).astype(str)
+    return hash_pandas_object(pd.DataFrame(parts, index = dataframe.index), index = False)
+
+
+def key_frame(dataframe, keys):
+    # the keys as strings, so the ones from the last upload match up even if the dtype came out different
+    frame = dataframe[keys].astype(str)
+    frame[HASH_COLUMN] = row_hashes(dataframe).values
+    frame[INDEX_COLUMN] = dataframe.index
+    return frame.reset_index(drop = True)
+
+
+class TableDiff:
+    '''
+    How the table compares to the same table in the last upload
+    mapping is a Series with the index of the unchanged rows in the last upload, and their index in this upload as the values
+    changed is the index of the rows that are new or different
+    '''
+    def __init__(self, dataframe, keys, previous):
+        self.keys = keys
+        self.rows = key_frame(dataframe, keys)
+
+        unique = self.rows[~self.rows.duplicated(keys, keep = False)]
+        prev = previous[~previous.duplicated(keys, keep = False)]
+        matched = unique.merge(prev, on = keys, how = 'inner', suffixes = ('', '_prev'))
+        same = matched[matched[HASH_COLUMN] == matched[f"{HASH_COLUMN}_prev"]]
+
+        self.mapping = pd.Series(same[INDEX_COLUMN].values, index = same[f"{INDEX_COLUMN}_prev"].values)
+        self.changed = dataframe.index[~dataframe.index.isin(same[INDEX_COLUMN].values)]
+
+        # the rows of the last upload that are gone or changed, for the group checks
+        self.previous_changed = previous[~previous[INDEX_COLUMN].isin(self.mapping.index)]
+
+    def group_rows(self, dataframe, group_keys):
+        '''index of the rows in the groups (same values in group_keys) that have a changed row in them, in this upload or the last one'''
+        if not set(group_keys).issubset(self.keys):
+            # only the key columns are kept from the last upload
+            return None
+        touched = pd.MultiIndex.from_frame(
+            pd.concat([
+                self.rows[self.rows[INDEX_COLUMN].isin(self.changed)][group_keys],
+                self.previous_changed[group_keys]
+            ])
+        )
+        inside = pd.MultiIndex.from_frame(self.rows[group_keys]).isin(touched)
+        return pd.Index(self.rows[INDEX_COLUMN].values[inside])
+
+
+def plan(all_dfs, eng, context, checks, state):
+    '''
+    One task per table per check, in the same order they always ran in
+    A task has the dataframe the check should run on (None if there is nothing for it to check),
+    and if part of the result comes from the last upload, the results of the last upload and the rows they carry over to
+    Also gives back the key frames of the tables, to save after the checks run
+    '''
+    tasks = []
+    frames = dict()
+    for tbl, df in all_dfs.items():
+        keys = [c for c in get_primary_key(tbl, eng) if (c in df.columns) and (c not in context['system_fields'])]
+        previous = (state or dict()).get('tables', dict()).get(tbl)
+
+        diff = None
+        # the rows are matched up by the index, so it has to be unique (it always is for a table read from the excel file)
+        if not df.index.is_unique:
+            keys = []
+
+        if (len(keys) > 0) and (previous is not None) and (previous.get('columns') == list(df.columns)) and (previous.get('keys') == keys):
+            diff = TableDiff(df, keys, previous.get('rows'))
+            print(f"{tbl} - {len(diff.changed)} of {len(df)} rows changed since the last upload")
+            frames[tbl] = {"columns": list(df.columns), "keys": keys, "rows": diff.rows}
+        elif len(keys) > 0:
+            frames[tbl] = {"columns": list(df.columns), "keys": keys, "rows": key_frame(df, keys)}
+
+        # one subset per set of rows, the checks that run on the same rows get the same frame
+        #   (the pool shares each frame with the workers once, see run_pool in core.py)
+        subsets = dict()
+        for check in checks:
+            scope = getattr(check, 'scope', 'table')
+            task = {"table": tbl, "check": check, "dataframe": df, "previous": None}
+            if (diff is not None) and (check.__name__ in previous.get('results')):
+                if scope == 'row':
+                    rows = diff.changed
+                elif scope == 'group':
+                    rows = diff.group_rows(df, check.scope_keys(tbl, eng, context))
+                else:
+                    rows = None
+
+                if rows is not None:
+                    if len(rows) > 0 and tuple(rows) not in subsets:
+                        subsets[tuple(rows)] = df.loc[rows]
+                    task['dataframe'] = subsets[tuple(rows)] if len(rows) > 0 else None
+                    task['previous'] = previous.get('results').get(check.__name__)
+                    task['mapping'] = diff.mapping[~diff.mapping.isin(rows)]
+            tasks.append(task)
+
+    return tasks, frames
+
+
+def finish(task, result):
+    '''
+    Puts the results from the last upload (moved to where those rows are now) together with the result of running the check on the changed rows
+    Errors with the same columns, type and message become one error again, so it looks the same as if the check ran on the whole table
+    '''
+    if task.get('previous') is None:
+        return result
+
+    mapping = task.get('mapping')
+    merged = dict()
+    for e, carried in [(e, True) for e in task.get('previous')] + [(e, False) for e in result]:
+        if len(e) == 0:
+            continue
+        rows = mapping.reindex(e['rows']).dropna().astype(int).tolist() if carried else list(e['rows'])
+        if len(rows) == 0:
+            continue
+        key = (e.get('table'), e.get('columns'), e.get('error_type'), e.get('is_core_error'), e.get('error_message'))
+        if key not in merged:
+            merged[key] = {**e, "rows": []}
+        merged[key]['rows'].extend(rows)
+
+    for e in merged.values():
+        e['rows'] = sorted(set(e['rows']))
+    return list(merged.values())
@@ -1,39 +1,25 @@
 import pandas as pd
-from .functions import checkData
-from flask import current_app
+from .functions import checkData, core_context, check_scope
+from ..utils.schema import get_catalog
+from ..utils.lookups import lookup_cache
 
-# q is a multiprocessing.Queue()
-# pass it in in the case that this is done with multiprocessing
-# multitask function passes in a multiprocessing Queue() as the last argument for each function that gets passed into it
-# therefore to pass a function to the multitask function we would need to allow for that queue to be passed into it
+# output is an optional queue, if it is passed in the result gets put in it as well as being returned
+@check_scope('row')
 def checkLookUpLists(dataframe, tablename, eng, *args, output = None, **kwargs):
     print("BEGIN checkLookupLists")
     #assert dtype in tbl_tablenames.keys(), "Invalid Datatype in checkLookUpCodes function call"
     
-    lu_list_script_root = current_app.script_root
+    context = kwargs.get('context') or core_context()
+    lu_list_script_root = context['script_root']
 
-    lookup_sql = f"""
-        SELECT
-            kcu.column_name, 
-            ccu.table_name AS foreign_table_name,
-            ccu.column_name AS foreign_column_name 
-        FROM 
-            information_schema.table_constraints AS tc 
-            JOIN information_schema.key_column_usage AS kcu
-            ON tc.constraint_name = kcu.constraint_name
-            AND tc.table_schema = kcu.table_schema
-            JOIN information_schema.constraint_column_usage AS ccu
-            ON ccu.constraint_name = tc.constraint_name
-            AND ccu.table_schema = tc.table_schema
-        WHERE tc.constraint_type = 'FOREIGN KEY' 
-        AND tc.table_name='{tablename}'
-        AND ccu.table_name LIKE 'lu_%%';
-    """
-
-    # fkeys = foreign keys
-    fkeys = pd.read_sql(lookup_sql, eng)
+    # fkeys = foreign keys (to lookup lists) - from the schema catalog
+    fkeys = get_catalog(eng).foreign_keys(tablename)
     # dont check lookup lists for columns that are not in unified table
     fkeys = fkeys[fkeys.column_name.isin(dataframe.columns)]
+
+    # The lookup list values come from the lookup cache (utils/lookups.py)
+    # prefetch checks if any of the lookup lists changed, all in one query, so the loop below does not hit the database
+    lookup_cache.prefetch(list(zip(fkeys.foreign_table_name, fkeys.foreign_column_name)), eng)
     # print("fkeys")
     # print(fkeys)
     # print("lookup_sql")
@@ -62,14 +48,13 @@ def checkLookUpLists(dataframe, tablename, eng, *args, output = None, **kwargs):
         for val in 
         dataframe[
             ~dataframe[col].isin(
-                pd.read_sql(
-                    (
-                        f"SELECT {fkeys[fkeys.column_name == col].foreign_column_name.values[0]} "
-                        f"FROM {fkeys[fkeys.column_name == col].foreign_table_name.values[0]};"
-                    ),
-                    eng
-                )[fkeys[fkeys.column_name == col].foreign_column_name.values[0]] \
-                .values
+                list(
+                    lookup_cache.lookup_values(
+                        fkeys[fkeys.column_name == col].foreign_table_name.values[0],
+                        fkeys[fkeys.column_name == col].foreign_column_name.values[0],
+                        eng
+                    )
+                )
             )
         ][col] \
         .unique()
@@ -1,15 +1,16 @@
 import pandas as pd
 import re
 from math import log10
-from .functions import checkData, convert_dtype, fetch_meta, check_precision, check_length, check_scale
-from flask import current_app
+from .functions import checkData, convert_dtype, invalid_dtype_mask, fetch_meta, numeric_shape, text_length, core_context, check_scope
 
 
+@check_scope('row')
 def checkDataTypes(dataframe, tablename, eng, meta, *args, output = None, **kwargs):
     print("BEGIN checkDataTypes")
+    context = kwargs.get('context') or core_context()
     ret = []
     for col in dataframe.columns: 
-        if col not in current_app.system_fields:
+        if col not in context['system_fields']:
             # using the meta dataframe we can get the python datatype
             dtype = meta.iloc[
                 meta[
@@ -31,14 +32,8 @@ def checkDataTypes(dataframe, tablename, eng, meta, *args, output = None, **kwar
                 checkData(
                     dataframe = dataframe,
                     tablename = tablename,
-                    badrows = dataframe[
-                            dataframe[col].apply(
-                                lambda x:
-                                # function returns True if it successfully converted
-                                # We negate to get the cases where it was not successfully converted
-                                not convert_dtype(dtype, x)
-                            )
-                        ].index.tolist(),
+                    # True where the value can not be converted to the datatype (whole column at once - see invalid_dtype_mask)
+                    badrows = dataframe[invalid_dtype_mask(dataframe[col], dtype).values].index.tolist(),
                     badcolumn = col,
                     error_type = "Invalid Datatype",
                     is_core_error = True,
@@ -59,13 +54,35 @@ def checkDataTypes(dataframe, tablename, eng, meta, *args, output = None, **kwar
     return ret
     
 
+def column_shapes(dataframe, meta, system_fields):
+    '''
+    The numeric shape (see numeric_shape) of each numeric column and the text length of each column with a character limit
+    core works this out once per table and hands it to checkPrecision, checkScale and checkLength, rather than each of them going through the values on its own
+    '''
+    numeric_columns = meta[meta.udt_name == 'numeric'].column_name.values
+    text_columns = meta[~pd.isnull(meta.character_maximum_length)].column_name.values
+    shapes = dict()
+    for col in dataframe.columns:
+        if col in system_fields:
+            continue
+        if col in numeric_columns:
+            shapes[col] = numeric_shape(dataframe[col])
+        elif col in text_columns:
+            shapes[col] = text_length(dataframe[col])
+    return shapes
+
+
+@check_scope('row')
 def checkPrecision(dataframe, tablename, eng, meta, *args, output = None, **kwargs):
     print("BEGIN checkPrecision")
+    context = kwargs.get('context') or core_context()
+    # core passes in the shapes of the columns, computed once for all three of these checks (see column_shapes)
+    shapes = kwargs.get('shapes') or dict()
     ret = []
     for col in dataframe.columns:
         if (
             (col in meta[meta.udt_name == 'numeric'].column_name.values)
-            and (col not in current_app.system_fields)
+            and (col not in context['system_fields'])
         ):
             
             prec = int(
@@ -78,15 +95,14 @@ def checkPrecision(dataframe, tablename, eng, meta, *args, output = None, **kwar
                 .values[0]
             )
 
+            shape = shapes[col] if col in shapes else numeric_shape(dataframe[col])
             ret.append(
                 checkData(
                     dataframe = dataframe,
                     tablename = tablename,
+                    # values that int() doesnt work on, and fractions, are left alone like they always were
                     badrows = dataframe[
-                        dataframe[col].apply(
-                            lambda x:
-                            not check_precision(x,prec)
-                        )
+                        (shape.checked & ~shape.fraction & (shape.left + shape.right > prec)).values
                     ].index.tolist(),
                     badcolumn = col,
                     error_type = "Value too long",
@@ -100,13 +116,16 @@ def checkPrecision(dataframe, tablename, eng, meta, *args, output = None, **kwar
     print("END checkPrecision")
     return ret
 
+@check_scope('row')
 def checkScale(dataframe, tablename, eng, meta, *args, output = None, **kwargs):
     print("BEGIN checkScale")
+    context = kwargs.get('context') or core_context()
+    shapes = kwargs.get('shapes') or dict()
     ret = []
     for col in dataframe.columns:
         if (
             (col in meta[meta.udt_name == 'numeric'].column_name.values)
-            and (col not in current_app.system_fields)
+            and (col not in context['system_fields'])
         ):
             scale = int(
                 meta.iloc[
@@ -118,16 +137,12 @@ def checkScale(dataframe, tablename, eng, meta, *args, output = None, **kwargs):
                 .values[0]
             )
 
+            shape = shapes[col] if col in shapes else numeric_shape(dataframe[col])
             ret.append(
                 checkData(
                     dataframe = dataframe,
                     tablename = tablename,
-                    badrows = dataframe[
-                        dataframe[col].apply(
-                            lambda x:
-                            not check_scale(x,scale)
-                        )
-                    ].index.tolist(),
+                    badrows = dataframe[(shape.checked & (shape.right > scale)).values].index.tolist(),
                     badcolumn = col,
                     error_type = "Value too long",
                     is_core_error = True,
@@ -146,15 +161,18 @@ def checkScale(dataframe, tablename, eng, meta, *args, output = None, **kwargs):
     return ret
 
 
+@check_scope('row')
 def checkLength(dataframe, tablename, eng, meta, *args, output = None, **kwargs):
     print("BEGIN checkLength")
+    context = kwargs.get('context') or core_context()
+    shapes = kwargs.get('shapes') or dict()
 
     # ret for return, or the item that will be returned
     ret = []
     for col in dataframe.columns:
         if (
             (col in meta[~pd.isnull(meta.character_maximum_length)].column_name.values)
-            and (col not in current_app.system_fields)
+            and (col not in context['system_fields'])
         ):
             maxlen = int(
                 meta.iloc[
@@ -166,11 +184,13 @@ def checkLength(dataframe, tablename, eng, meta, *args, output = None, **kwargs)
                 .values[0]
             )
 
+            length = shapes[col] if col in shapes else text_length(dataframe[col])
             ret.append(
                 checkData(
                     dataframe = dataframe,
                     tablename = tablename,
-                    badrows = dataframe[(~pd.isnull(dataframe[col])) & (dataframe[col].astype(str).str.len() > maxlen)].index.tolist(),
+                    # length is NaN for the empty values, so those never count as too long
+                    badrows = dataframe[(length > maxlen).values].index.tolist(),
                     badcolumn = col,
                     error_type = "Value too long",
                     is_core_error = True,
@@ -186,8 +206,10 @@ def checkLength(dataframe, tablename, eng, meta, *args, output = None, **kwargs)
 
 
 
+@check_scope('row')
 def checkNotNull(dataframe, tablename, eng, meta, *args, output = None, **kwargs):
     print("BEGIN checkNotNULL")
+    context = kwargs.get('context') or core_context()
 
     if 'sampleid' in dataframe.columns:
         print(dataframe.sampleid)
@@ -212,7 +234,7 @@ def checkNotNull(dataframe, tablename, eng, meta, *args, output = None, **kwargs
         for col in dataframe.columns 
         if (
             (col in meta[meta.is_nullable == 'NO'].column_name.values)
-            and (col not in current_app.system_fields)
+            and (col not in context['system_fields'])
         )
     ]
 
@@ -224,13 +246,16 @@ def checkNotNull(dataframe, tablename, eng, meta, *args, output = None, **kwargs
 
 
 
+# whether a column gets checked at all depends on every value in it being an integer, so it has to look at the whole table
+@check_scope('table')
 def checkIntegers(dataframe, tablename, eng, meta, *args, output = None, **kwargs):
     print("BEGIN checkIntegers")
+    context = kwargs.get('context') or core_context()
     ret = []
     for col in dataframe.columns:
         if (
                 (col in meta[meta.udt_name.isin(['int2','int4','int8'])].column_name.values)
-                and (col not in current_app.system_fields)
+                and (col not in context['system_fields'])
         ):
             udt_name = meta.iloc[meta[meta.column_name == col].index, meta.columns.get_loc("udt_name")].values[0]
 
@@ -0,0 +1,121 @@
+import os, sys, time, pickle, shutil
+import multiprocessing as mp
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+from ..utils.db import get_engine
+
+# Core check pool
+# multitask used to start a new process for every core check of every table, which got a forked copy of the flask app,
+#   and the results came back through a Queue that was drained with qsize() (which is not reliable)
+# The checks also read current_app and session, which are not really there in a forked process, so core always ran with debug = True (one check at a time)
+#
+# Now there is one pool of worker processes per uwsgi worker, started the first time it is needed and kept around after that
+#   - The checks get what they need from the app and the session passed in as context (see core_context in functions.py)
+#   - Each table is pickled once into a shared memory block, instead of it being pickled again for every check
+#     That block is still a pickle, not the columns themselves - each worker unpickles its own copy of the table
+#     the first time it gets a check on it, and keeps it for the next checks on that table (see read_shared)
+#     So what is left is one pickle of each table in the parent, and one unpickle of it (and one copy in memory) in each worker that runs a check on it
+#     The checks only read the dataframe, they must not change it, since the next check in that worker gets the same one
+#   - The workers make their own database engine from the url of the app's engine
+#   - The results come back through the futures, along with how long the check took (wall and cpu seconds)
+#     so the check job can record a timing span for each check on each table, like it does when they run one at a time
+#
+# The workers are started with spawn rather than fork. The uwsgi worker has threads running (the check jobs)
+#   and forking a process with threads in it can leave locks held in the child that nobody will ever release
+# Spawned workers import the app once when they start up, so the first core check run after a restart takes a little longer
+#   (the database setup in __init__.py is skipped in the workers)
+#
+# Config: CORE_CHECK_WORKERS (default 4, 0 means the checks run one at a time in the check job like before)
+#         CORE_CHECK_PYTHON - path of the python interpreter for the workers.
+#           Under uwsgi sys.executable is the uwsgi binary, so by default we look for python3 on the PATH in that case
+
+_pool = None
+_pool_pid = None
+
+
+def python_executable(config):
+    if config.get('CORE_CHECK_PYTHON') is not None:
+        return config.get('CORE_CHECK_PYTHON')
+    if os.path.basename(sys.executable or '').startswith('python'):
+        return sys.executable
+    return shutil.which('python3') or sys.executable
+
+
+def get_pool(max_workers = 4, executable = None):
+    global _pool, _pool_pid
+    if (_pool is None) or (_pool_pid != os.getpid()):
+        context = mp.get_context('spawn')
+        if executable is not None:
+            context.set_executable(executable)
+        _pool = ProcessPoolExecutor(max_workers = max_workers, mp_context = context)
+        _pool_pid = os.getpid()
+    return _pool
+
+
+def reset_pool():
+    # after a worker dies the pool is broken for good, so the next call to get_pool starts a new one
+    global _pool
+    if (_pool is not None) and (_pool_pid == os.getpid()):
+        _pool.shutdown(wait = False, cancel_futures = True)
+    _pool = None
+
+
+class SharedTable:
+    '''
+    A table (and anything else the checks need along with it) pickled into a shared memory block
+    The parent creates it, the workers open it with read_shared, and the parent unlinks it once all the checks on it are done
+    '''
+    def __init__(self, **contents):
+        data = pickle.dumps(contents, protocol = pickle.HIGHEST_PROTOCOL)
+        self.size = len(data)
+        self.shm = SharedMemory(create = True, size = max(self.size, 1))
+        self.shm.buf[:self.size] = data
+
+    @property
+    def block(self):
+        # what gets sent to the worker - just the name and the size of the block
+        return (self.shm.name, self.size)
+
+    def unlink(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+# The tables this worker has unpickled, keyed by block, most recently used last
+# The checks get submitted table by table, so a worker rarely needs more than the last couple
+_shared_cache = OrderedDict()
+SHARED_CACHE_SIZE = 2
+
+
+def read_shared(block):
+    if block in _shared_cache:
+        _shared_cache.move_to_end(block)
+        return _shared_cache[block]
+
+    name, size = block
+    shm = SharedMemory(name = name)
+    try:
+        with shm.buf[:size] as data:
+            contents = pickle.loads(data)
+    finally:
+        shm.close()
+
+    _shared_cache[block] = contents
+    while len(_shared_cache) > SHARED_CACHE_SIZE:
+        _shared_cache.popitem(last = False)
+    return contents
+
+
+def run_check(check, block, tablename, url, meta, context):
+    '''runs one core check on one table, inside a worker process, and gives back the result with the wall and cpu time it took'''
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    shared = read_shared(block)
+
+    # one check at a time per worker, so it doesnt need more than one connection
+    eng = get_engine(url, pool_size = 1, max_overflow = 2)
+
+    result = check(shared['dataframe'], tablename, eng, meta, context = context, shapes = shared['shapes'])
+    return result, time.perf_counter() - wall_start, time.process_time() - cpu_start
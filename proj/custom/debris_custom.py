@@ -3,6 +3,7 @@
 from inspect import currentframe
 from flask import current_app, g
 from .functions import checkData
+from ..utils.lookups import lookup_values
 import pandas as pd
 import datetime
 
@@ -144,13 +145,11 @@ def debris(all_dfs):
     
     #Jordan - DebrisType - Check to see values match lu_debristypes
     print('DebrisType - Check to see values match lu_debristypes')			
-    dtypes = eng.execute('select debristype,debrisorigin from lu_debristypes;')
-    dt = pd.DataFrame(dtypes.fetchall())
-    dt.columns = dtypes.keys()
+    debristypes = lookup_values('lu_debristypes', 'debristype', eng)
     
     # compare submitted debristypes to lookuplist
     badrows = trawldebris[
-        ~trawldebris.debristype.isin(dt.debristype.tolist())
+        ~trawldebris.debristype.isin(list(debristypes))
     ].tmp_row.tolist()
     trawldebris_args = {
         "dataframe": trawldebris,
@@ -185,6 +184,10 @@ def debris(all_dfs):
     
     #Jordan - Conditional - If DebrisCategory has DebrisOrigin=Natural then EstimateCategory is allowed. If it has DebrisOrigin=Anthropogenic then it should be null.
     print('Conditional - If DebrisCategory has DebrisOrigin=Natural then EstimateCategory is allowed. If it has DebrisOrigin=Anthropogenic then it should be null.')
+    # the lookup cache only keeps the allowed values, this one needs the origin that goes with each type
+    dtypes = eng.execute('select debristype,debrisorigin from lu_debristypes;')
+    dt = pd.DataFrame(dtypes.fetchall())
+    dt.columns = dtypes.keys()
     debris_origins = trawldebris[['debristype','estimatecategory','tmp_row']]\
         .merge(
             dt, 
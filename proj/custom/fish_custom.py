@@ -3,6 +3,7 @@
 from inspect import currentframe
 from flask import current_app, g
 from .functions import checkData, mismatch
+from ..utils.lookups import lookup_values
 import pandas as pd
 import numpy as np
 
@@ -189,10 +190,11 @@ def fish(all_dfs):
     # User is required to enter an anomaly, but multple anomalies are allowed to be entered
     print("Fish Custom Checks")
     print("User is required to enter an anomaly, but multple anomalies are allowed to be entered")
+    fishanomalies = lookup_values('lu_fishanomalies', 'anomaly', eng)
     badrows = trawlfishabundance[
         trawlfishabundance.anomaly.apply(
             lambda x: 
-            not set([substring.strip() for substring in str(x).split(',')]).issubset(set(pd.read_sql("SELECT DISTINCT anomaly FROM lu_fishanomalies", eng).anomaly.tolist()))
+            not set([substring.strip() for substring in str(x).split(',')]).issubset(fishanomalies)
         )
     ].tmp_row.tolist()
     trawlfishabundance_args.update({
@@ -9,6 +9,7 @@ from arcgis.geometry import lengths, areas_and_lengths, project
 from arcgis.geometry.functions import intersect as arc_geometry_intersect
 import pandas as pd
 from flask import current_app
+from ..utils.lookups import lookup_values
 import json
 
 
@@ -234,7 +235,7 @@ def multivalue_lookup_check(df, field, listname, listfield, dbconnection, displa
     assert displayfieldname.lower() in df.columns, f"the displayfieldname {displayfieldname} was not found in the columns of the dataframe, even when it was lowercased"
 
     assert field in df.columns, f"In {str(currentframe().f_code.co_name)} (value against multiple values check) - {field} not in the columns of the dataframe"
-    lookupvals = set(read_sql(f'''SELECT DISTINCT "{listfield}" FROM "{listname}";''', dbconnection)[listfield].tolist())
+    lookupvals = lookup_values(listname, listfield, dbconnection)
 
     if not 'tmp_row' in df.columns:
         df['tmp_row'] = df.index
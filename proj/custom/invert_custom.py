@@ -3,6 +3,7 @@
 from inspect import currentframe
 from flask import current_app, g
 from .functions import checkData, multivalue_lookup_check, mismatch
+from ..utils.lookups import lookup_values
 from sqlalchemy import create_engine
 import pandas as pd
 import re
@@ -250,11 +251,10 @@ def invert(all_dfs):
     # 7a
     # Jordan - Species - Check Southern California Association of Marine Invertebrate Taxonomists Edition 12 - Check old species name
     print("Species - Check Southern California Association of Marine Invertebrate Taxonomists Edition 12 - Check old species name")
-    spcs_names = eng.execute("SELECT synonym, taxon FROM lu_invertsynonyms;")
-    sn = pd.DataFrame(spcs_names.fetchall()); sn.columns = spcs_names.keys()
+    synonyms = list(lookup_values('lu_invertsynonyms', 'synonym', eng))
 
     badrows = trawlinvertebrateabundance[
-        trawlinvertebrateabundance.invertspecies.isin(sn.synonym.tolist())
+        trawlinvertebrateabundance.invertspecies.isin(synonyms)
     ].tmp_row.tolist()
     trawlinvertebrateabundance_args = {
         "dataframe": trawlinvertebrateabundance,
@@ -270,7 +270,7 @@ def invert(all_dfs):
 
     # 4b
     badrows = trawlinvertebratebiomass[
-        trawlinvertebratebiomass.invertspecies.isin(sn.synonym.tolist())
+        trawlinvertebratebiomass.invertspecies.isin(synonyms)
     ].tmp_row.tolist()
     trawlinvertebratebiomass_args = {
         "dataframe": trawlinvertebratebiomass,
@@ -340,9 +340,8 @@ def invert(all_dfs):
     # 9a
     # Warn if the species is in lu_invertspeciesnotallowed
     # Jordan - Species - Check list of non-trawl taxa (next tab)
-    invalid_species = eng.execute("SELECT species AS invertspecies FROM lu_invertspeciesnotallowed;")
-    invs = pd.DataFrame(invalid_species.fetchall()); invs.columns= invalid_species.keys()
-    badrows = trawlinvertebrateabundance[trawlinvertebrateabundance.invertspecies.isin(invs.invertspecies.tolist())].tmp_row.tolist()
+    invalid_species = list(lookup_values('lu_invertspeciesnotallowed', 'species', eng))
+    badrows = trawlinvertebrateabundance[trawlinvertebrateabundance.invertspecies.isin(invalid_species)].tmp_row.tolist()
     trawlinvertebrateabundance_args = {
         "dataframe": trawlinvertebrateabundance,
         "tablename": 'tbl_trawlinvertebrateabundance',
@@ -0,0 +1,206 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from flask import current_app, g, session
+
+from ..utils.timing import span, add_span
+
+# Custom check registry
+# Each dataset has always been one big function that runs all of its checks one after the other (chemistry_custom.py is 2000 lines)
+#   and rebuilds the same merged frames and reference data queries over and over along the way
+# With the registry, each check is its own function, registered with what it needs:
+#
+#   @shared('infauna_reid', 'infauna', tables = ['tbl_infaunalabundance_reid'])
+#   def infauna(inputs):
+#       df = inputs['tbl_infaunalabundance_reid']
+#       return df.assign(tmp_row = df.index)
+#
+#   @custom_check('infauna_reid', tables = ['tbl_infaunalabundance_reid'], columns = ['abundance'], uses = ['infauna'])
+#   def abundance_minimum(inputs):
+#       df = inputs['infauna']
+#       return checkData(...)
+#
+#   - tables   - the tables of all_dfs the check reads
+#   - columns  - columns the check needs in those tables. If one is missing, the check is skipped (and that gets printed)
+#   - uses     - names of shared inputs (merged frames, reference data from the database etc)
+#                Each one is worked out once before the checks run, no matter how many checks use it
+#   - severity - 'error' or 'warning', which list the result goes in
+#   - after    - names of checks (registered before this one) that have to pass first. If any of them flagged rows, the check is skipped
+#                (the "only run these if there are no logic errors" pattern in the dataset functions)
+#
+# inputs is a dictionary with the tables, the shared inputs, and 'eng'
+# A check gives back what checkData gives back (or a list of those), and the results come out in the order the checks were registered,
+#   so it is the same errors and warnings list as when the dataset function ran them itself
+#
+# The checks that do not depend on each other run at the same time in a thread pool
+#   Threads rather than processes, since the checks use g, session and current_app, and the heavy parts are pandas and the database anyway
+#   Each thread gets its own request context with a copy of the session, and the engine of the check job
+#   The shared inputs are the same objects for every check, so a check should not modify them in place (use assign, or copy first)
+# Each check gets its own timing span (custom - <dataset> - <check>)
+#
+# Datasets get moved onto this one at a time. For now it is just infauna_reid, the others still run their checks in their dataset function
+# Config: CUSTOM_CHECK_WORKERS (default 4, 0 means the checks run one at a time in the check job)
+
+SEVERITIES = ('error', 'warning')
+
+# dataset -> list of checks, in the order they were registered
+CHECKS = dict()
+
+# dataset -> {name: shared input}
+SHARED = dict()
+
+
+class CustomCheck:
+    def __init__(self, func, dataset, tables, columns = None, uses = None, severity = 'error', after = None):
+        assert severity in SEVERITIES, f"severity of custom check {func.__name__} should be one of {SEVERITIES}, not {severity}"
+        self.func = func
+        self.name = func.__name__
+        self.dataset = dataset
+        self.tables = list(tables)
+        self.columns = list(columns or [])
+        self.uses = list(uses or [])
+        self.severity = severity
+        self.after = list(after or [])
+
+    def missing_columns(self, all_dfs):
+        return [
+            c for c in self.columns
+            if not any(c in all_dfs[tbl].columns for tbl in self.tables if tbl in all_dfs)
+        ]
+
+
+class SharedInput:
+    def __init__(self, func, dataset, name, tables = None, uses = None):
+        self.func = func
+        self.dataset = dataset
+        self.name = name
+        self.tables = list(tables or [])
+        self.uses = list(uses or [])
+
+
+def custom_check(dataset, tables, columns = None, uses = None, severity = 'error', after = None):
+    def register(func):
+        check = CustomCheck(func, dataset, tables, columns = columns, uses = uses, severity = severity, after = after)
+        assert check.name not in [c.name for c in CHECKS.get(dataset, [])], f"custom check {check.name} is registered twice for {dataset}"
+        CHECKS.setdefault(dataset, []).append(check)
+        return func
+    return register
+
+
+def shared(dataset, name, tables = None, uses = None):
+    def register(func):
+        SHARED.setdefault(dataset, dict())[name] = SharedInput(func, dataset, name, tables = tables, uses = uses)
+        return func
+    return register
+
+
+def resolve_shared(dataset, all_dfs, eng, checks):
+    '''works out each shared input the checks use, once, along with the shared inputs those need'''
+    inputs = {**all_dfs, "eng": eng}
+    registered = SHARED.get(dataset, dict())
+
+    def resolve(name, path):
+        if name in inputs:
+            return
+        assert name in registered, f"{dataset} check uses {name}, which is not a table or a registered shared input"
+        assert name not in path, f"shared inputs of {dataset} depend on each other in a circle ({' -> '.join([*path, name])})"
+        item = registered[name]
+        for dependency in item.uses:
+            resolve(dependency, [*path, name])
+        with span(f"custom - {dataset} - {name}", table = ','.join(item.tables) or None):
+            inputs[name] = item.func(inputs)
+
+    for check in checks:
+        for name in check.uses:
+            resolve(name, [])
+    return inputs
+
+
+def run_registered(dataset, all_dfs, eng = None):
+    '''
+    Runs the registered checks of the dataset, and gives back {'errors': [...], 'warnings': [...]} like a dataset function does
+    '''
+    eng = eng if eng is not None else g.eng
+    checks = CHECKS.get(dataset, [])
+    names = [c.name for c in checks]
+    for check in checks:
+        for name in check.after:
+            # the checks it runs after have to be registered before it, that way they can not wait on each other forever
+            assert name in names[:names.index(check.name)], \
+                f"custom check {check.name} runs after {name}, which is not a check of {dataset} registered before it"
+
+    inputs = resolve_shared(dataset, all_dfs, eng, checks)
+
+    results = dict()
+    skipped = set()
+    def ready(check):
+        return all(name in results or name in skipped for name in check.after)
+
+    def should_skip(check):
+        failed = [name for name in check.after if (name in skipped) or any(len(r) > 0 for r in results[name])]
+        if len(failed) > 0:
+            print(f"Skipping {check.name} since {', '.join(failed)} did not pass")
+            return True
+        missing = check.missing_columns(all_dfs)
+        if len(missing) > 0:
+            print(f"Skipping {check.name} since the columns {', '.join(missing)} are not in {', '.join(check.tables)}")
+            return True
+        return False
+
+    def done(check, output, wall, cpu):
+        # checkData gives back one error, some of the helper functions give back a list of them
+        results[check.name] = output if isinstance(output, list) else [output]
+        add_span(f"custom - {dataset} - {check.name}", wall, cpu, table = ','.join(check.tables), severity = check.severity)
+
+    workers = int(current_app.config.get('CUSTOM_CHECK_WORKERS', 4))
+    pending = list(checks)
+    if workers == 0:
+        while len(pending) > 0:
+            check = next(c for c in pending if ready(c))
+            pending.remove(check)
+            if should_skip(check):
+                skipped.add(check.name)
+                continue
+            done(check, *timed(check, inputs))
+    else:
+        app = current_app._get_current_object()
+        session_data = dict(session)
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            running = dict()
+            while len(pending) > 0 or len(running) > 0:
+                for check in [c for c in pending if ready(c)]:
+                    pending.remove(check)
+                    if should_skip(check):
+                        skipped.add(check.name)
+                        continue
+                    running[executor.submit(run_in_context, app, session_data, eng, check, inputs)] = check
+
+                if len(running) == 0:
+                    # everything that was ready got skipped, so the next ones are ready now
+                    continue
+
+                finished, _ = wait(running, return_when = FIRST_COMPLETED)
+                for future in finished:
+                    done(running.pop(future), *future.result())
+
+    errs = []
+    warnings = []
+    for check in checks:
+        if check.name in skipped:
+            continue
+        (errs if check.severity == 'error' else warnings).extend(results[check.name])
+    return {'errors': errs, 'warnings': warnings}
+
+
+def timed(check, inputs):
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    output = check.func(inputs)
+    return output, time.perf_counter() - wall_start, time.thread_time() - cpu_start
+
+
+def run_in_context(app, session_data, eng, check, inputs):
+    # same thing submit_job does for the check job itself (see utils/jobs.py), minus connecting to the database again
+    with app.test_request_context():
+        session.update(session_data)
+        g.eng = eng
+        return timed(check, inputs)
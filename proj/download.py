@@ -4,9 +4,20 @@ import pandas as pd
 from pandas import read_sql, DataFrame
 import re
 
+from .utils.jobs import read_job, MARKING_JOBID
+
 download = Blueprint('download', __name__)
 @download.route('/download/<submissionid>/<filename>', methods = ['GET','POST'])
 def submission_file(submissionid, filename):
+    # The marked excel file gets made in the background after the checks are done (mark_submission in main.py)
+    # If it is asked for before that job is done, the browser gets a 202 and should poll the job status (/upload/status/marking) before trying again
+    if filename.rsplit('.', 1)[0].endswith('-marked'):
+        marking = read_job(os.path.join(os.getcwd(), "files", submissionid), MARKING_JOBID)
+        if (marking is not None) and (marking.get('status') in ('queued', 'running')):
+            return jsonify(status = marking.get('status'), message = "The marked excel file is not ready yet"), 202
+        if (marking is not None) and (marking.get('status') == 'failed'):
+            return jsonify(message = "Something went wrong while marking the excel file")
+
     return send_file( os.path.join(os.getcwd(), "files", submissionid, filename), as_attachment = True, download_name = filename ) \
         if os.path.exists(os.path.join(os.getcwd(), "files", submissionid, filename)) \
         else jsonify(message = "file not found")
@@ -1,8 +1,11 @@
 from flask import Blueprint, current_app, session, jsonify, g
 from .utils.db import GeoDBDataFrame, next_objectid, registration_id
 from .utils.mail import data_receipt
+from .utils.snapshot import read_snapshot, read_load_snapshot, write_load_snapshot
 from .utils.exceptions import default_exception_handler
 from .core.functions import fetch_meta
+from .utils.schema import get_catalog
+from .utils.prepare import assert_schema_prepared
 
 import subprocess as sp
 
@@ -12,82 +15,41 @@ import pandas as pd
 import json, os
 
 finalsubmit = Blueprint('finalsubmit', __name__)
-@finalsubmit.route('/load', methods = ['GET','POST'])
-def load():
-
-    # This was put in because there was a bug on the JS side where the form was submitting twice, causing data to attempt to load twice, causing a critical error
-    print("REQUEST MADE TO /load")
-
-    assert session.get('submissionid') is not None, "No submissionID, session may have expired"
-
-    # Errors and warnings are stored in a directory in a json since it is likely that they will exceed 4kb in many cases
-    # For this reason i didnt use the session cookie
-    # Also couldnt figure out how to correctly set up a filesystem session.
-    if not pd.DataFrame( json.loads(open(os.path.join(session['submission_dir'], 'errors.json') , 'r').read()) ).empty:
-        return jsonify(user_error_message='An attempt was made to do a final submit, but there are errors in the submission')
 
 
-    # This ensures that the exact file that was originally read in and checked, is being read in the same exact way before the final submit
-    # This way, there are not issues with pandas changing data before rewriting the file to excel
-    excel_path = session['excel_path']
-
-    eng = g.eng
-    
-    all_dfs = dict()
-
-    for sheet in pd.ExcelFile(excel_path).sheet_names:
-        if ((sheet not in current_app.tabs_to_ignore) and (not sheet.startswith('lu_'))):
-            
-            converters = fetch_meta(sheet, g.eng, return_converters = True)
-            string_converters = converters.get("string_converters")
-            timestamp_converters = converters.get("timestamp_converters")
-            
-            assert string_converters is not None, f"String converters not returned for {sheet} in fetch_meta function"
-            assert timestamp_converters is not None, f"Timestamp converters not returned for {sheet} in fetch_meta function"
-
-
-            # This should never raise an exception - at least converting the columns to str datatypes should never cause a problem
-            tmpdf = pd.read_excel(
-                excel_path, 
-                sheet_name = sheet,
-                keep_default_na=False,
-                skiprows = current_app.excel_offset,
-                na_values = [''],
-                converters = string_converters
-            )
+def load_order(datatype, tables):
+    '''the tables of the datatype, then its analysis tables, in the order they are in the config - only the ones that are in tables'''
+    dataset = current_app.datasets.get(datatype)
+    order = []
+    for tbl in [*dataset.get('tables'), *(dataset.get('analysis_tables') or [])]:
+        if (tbl in tables) and (tbl not in order):
+            order.append(tbl)
+    return order
 
-            # Converting to timestamps may cause a critical error if the user enters a non-valid timestamp literal
-            # We do not want to catch the exception here anymore, because if it fails to convert to timestamp, its not going to load to the database anyways
-            # This way we will be alerted with a hopefully cleaner error message than the one coming from sqlalchemy
-            valid_timestamp_converters = {col: 'datetime64[ns]' for col in timestamp_converters.keys() if col in tmpdf.columns}
 
-            # Now use the filtered dictionary to safely convert types
-            tmpdf = tmpdf.astype(valid_timestamp_converters)
+def load_frames(submission_dir, eng):
+    '''
+    The tables of the snapshot the way they get loaded - timestamps converted, column names lowercase, and the warnings column tacked on
+    The columns that come from the session (submissionid, login fields etc) get added in /load
+    '''
+    all_dfs = read_snapshot(submission_dir)
 
-            all_dfs[sheet] = tmpdf
+    for sheet, tmpdf in all_dfs.items():
+        
+        timestamp_converters = fetch_meta(sheet, eng, return_converters = True).get("timestamp_converters")
+        assert timestamp_converters is not None, f"Timestamp converters not returned for {sheet} in fetch_meta function"
 
+        # Converting to timestamps may cause a critical error if the user enters a non-valid timestamp literal
+        # We do not want to catch the exception here anymore, because if it fails to convert to timestamp, its not going to load to the database anyways
+        # This way we will be alerted with a hopefully cleaner error message than the one coming from sqlalchemy
+        valid_timestamp_converters = {col: 'datetime64[ns]' for col in timestamp_converters.keys() if col in tmpdf.columns}
 
-    valid_tables = pd.read_sql(
-            # percent signs are escaped by doubling them, not with a backslash
-            # percent signs need to be escaped because otherwise the python interpreter will think you are trying to create a format string
-            f"""
-            SELECT table_name 
-            FROM information_schema.tables 
-            WHERE (table_name LIKE 'tbl_%%') OR (table_name LIKE 'analysis_%%') OR (table_name = '{current_app.config.get("TOXSUMMARY_TABLENAME")}') """, eng
-        ) \
-        .table_name \
-        .values
-    
-    print('all_dfs.keys()')
-    print(all_dfs.keys())
-    print('valid_tables')
-    print(valid_tables)
-    assert all(sheet in valid_tables for sheet in all_dfs.keys()), \
-        f"Sheetname in excel file {excel_path} not found in the list of tables that can be submitted to"
+        # Now use the filtered dictionary to safely convert types
+        all_dfs[sheet] = tmpdf.astype(valid_timestamp_converters)
 
     # read in warnings and merge it to tack on the warnings column
     # only if warnings is non empty
-    warnings = pd.DataFrame( json.loads(open(os.path.join(session['submission_dir'], 'warnings.json') , 'r').read()) )
+    warnings = pd.DataFrame( json.loads(open(os.path.join(submission_dir, 'warnings.json') , 'r').read()) )
       
     for tbl in all_dfs.keys():
 
@@ -115,7 +77,63 @@ def load():
                 all_dfs[tbl] = all_dfs[tbl].assign(warnings = '')
         else:
             all_dfs[tbl] = all_dfs[tbl].assign(warnings = '')
-            
+
+    return all_dfs
+
+
+def prepare_load(submission_dir, datatype, eng):
+    '''
+    Runs at the end of the upload routine when there are no errors, so final submit does not have to do any of this
+    Writes the load snapshot (see utils/snapshot.py)
+    '''
+    all_dfs = load_frames(submission_dir, eng)
+    order = load_order(datatype, all_dfs.keys())
+    # tables that are not part of the datatype stay at the end, /load will refuse them like it always has
+    order = [*order, *[t for t in all_dfs.keys() if t not in order]]
+    return write_load_snapshot(all_dfs, submission_dir, order)
+
+@finalsubmit.route('/load', methods = ['GET','POST'])
+def load():
+
+    # This was put in because there was a bug on the JS side where the form was submitting twice, causing data to attempt to load twice, causing a critical error
+    print("REQUEST MADE TO /load")
+
+    assert session.get('submissionid') is not None, "No submissionID, session may have expired"
+
+    # Errors and warnings are stored in a directory in a json since it is likely that they will exceed 4kb in many cases
+    # For this reason i didnt use the session cookie
+    # Also couldnt figure out how to correctly set up a filesystem session.
+    if not pd.DataFrame( json.loads(open(os.path.join(session['submission_dir'], 'errors.json') , 'r').read()) ).empty:
+        return jsonify(user_error_message='An attempt was made to do a final submit, but there are errors in the submission')
+
+
+    excel_path = session['excel_path']
+
+    eng = g.eng
+
+    # The load snapshot is written at the end of the upload routine, with the data the way it gets loaded (see prepare_load)
+    # read_load_snapshot verifies the content hash of each table against the manifest, and that it was made from the data that was checked
+    # If it is not there (the upload happened before this was put in, or writing it failed) it gets made from the snapshot right here
+    all_dfs = read_load_snapshot(session['submission_dir'])
+    if all_dfs is None:
+        print("No load snapshot, preparing the data from the snapshot")
+        all_dfs = load_frames(session['submission_dir'], eng)
+
+    # tables that can be submitted to, from the schema catalog
+    valid_tables = [
+        t for t in get_catalog(eng).tables() 
+        if t.startswith(('tbl_', 'analysis_')) or (t == current_app.config.get("TOXSUMMARY_TABLENAME"))
+    ]
+    
+    print('all_dfs.keys()')
+    print(all_dfs.keys())
+    print('valid_tables')
+    print(valid_tables)
+    assert all(sheet in valid_tables for sheet in all_dfs.keys()), \
+        f"Sheetname in excel file {excel_path} not found in the list of tables that can be submitted to"
+
+    for tbl in all_dfs.keys():
+
         print(session.get('login_info'))
         all_dfs[tbl] = all_dfs[tbl].assign(
             objectid = f"sde.next_rowid('sde','{tbl}')",
@@ -147,85 +165,80 @@ def load():
     
 
     # Now go through each tab and load to the database
-    tables_to_load = list(
-        set(
-            [
-                *current_app.datasets.get(session.get('datatype')).get('tables'), 
-                *analysis_tables
-            ]
-        )
-        .intersection(set(all_dfs.keys()))
-    )
-
-    for tbl in tables_to_load:
-
-        # Below comment applied to one project where the tables had foreign key relationships
-        # We may or may not want to also apply that to bight
-        # print(f"Loading Data to {tbl}. Be sure that the tables are in the correct order in __init__.py datasets")
-        print("If foreign key relationships are set, the tables need to be loadede in a particular order")
-        
-        # These columns are needed in all submission tables, but they are often overlooked
-        g.eng.execute(
-            f"""
-            ALTER TABLE "{tbl}" ADD COLUMN IF NOT EXISTS submissionid int4;
-            ALTER TABLE "{tbl}" ADD COLUMN IF NOT EXISTS warnings VARCHAR(5000);
-            ALTER TABLE "{tbl}" ADD COLUMN IF NOT EXISTS login_email VARCHAR(50);
-            ALTER TABLE "{tbl}" ADD COLUMN IF NOT EXISTS login_agency VARCHAR(50);
-            """
-        )
+    # in the order they are listed in the config, since if foreign key relationships are set, the tables need to be loaded in a particular order
+    tables_to_load = load_order(session.get('datatype'), all_dfs.keys())
+
+    # The system columns (submissionid, warnings, login_email, login_agency) and the objectid/globalid defaults
+    #   are put on the tables once when the app starts up, rather than with ALTER TABLEs on every load (see utils/prepare.py)
+    assert_schema_prepared(g.eng, tables_to_load)
+
+    # All the tables get loaded in one transaction, along with the checksum records and marking the submission as submitted
+    # It used to be one table at a time on autocommit, so if the third table failed, the first two stayed loaded
+    #   and when they tried again it ran into duplicate key errors on those
+    # Now if anything fails, none of it goes in (and the error handler below sends the error email like always)
+    # The number of rows loaded comes from the INSERT itself, rather than counting the rows of the submission in the table afterwards
+    loaded_counts = dict()
+    with eng.begin() as conn:
+        for tbl in tables_to_load:
+
+            # Below comment applied to one project where the tables had foreign key relationships
+            # We may or may not want to also apply that to bight
+            # print(f"Loading Data to {tbl}. Be sure that the tables are in the correct order in __init__.py datasets")
+            print("If foreign key relationships are set, the tables need to be loadede in a particular order")
+
+            loaded_counts[tbl] = all_dfs[tbl].to_geodb(tbl, conn)
+
+            print(f"done loading data to {tbl}")
+
+            conn.execute(
+                f"""
+                INSERT INTO submission_tracking_checksum
+                (objectid, submissionid, tablename, checksum, excel_rows)
+                VALUES
+                (
+                    sde.next_rowid('sde','submission_tracking_checksum'),
+                    {session.get('submissionid')},
+                    '{tbl}',
+                    {loaded_counts[tbl]},
+                    {len(all_dfs[tbl])}
+                )
+                ;"""
+            )
 
-        g.eng.execute(
+        # They are finally done!
+        # Set the submission tracking table record to 'submit = yes'
+        conn.execute(
             f"""
-            ALTER TABLE {tbl} ALTER COLUMN globalid SET DEFAULT next_globalid();
-            ALTER TABLE {tbl} ALTER COLUMN objectid SET DEFAULT next_rowid('sde','{tbl}');
+            UPDATE submission_tracking_table 
+            SET submit = 'yes' 
+            WHERE submissionid = {session.get('submissionid')};
             """
         )
 
-        all_dfs[tbl].to_geodb(tbl, g.eng)
-
-        print(f"done loading data to {tbl}")
-
-        g.eng.execute(
-            f"""
-            INSERT INTO submission_tracking_checksum
-            (objectid, submissionid, tablename, checksum, excel_rows)
-            VALUES
-            (
-                sde.next_rowid('sde','submission_tracking_checksum'),
-                {session.get('submissionid')},
-                '{tbl}',
-                {
-                    pd.read_sql(
-                        'SELECT COUNT(*) as n_rows FROM {} WHERE submissionid = {}'
-                        .format(tbl, session.get('submissionid')),
-                        eng
-                    )
-                    .n_rows 
-                    .values[0]
-                },
-                {len(all_dfs[tbl])}
-            )
-            ;"""
-        )
-    
     # So we know the massive argument list of the data receipt function, which is like the notification email for successful submission
     #def data_receipt(send_from, always_send_to, login_email, dtype, submissionid, originalfile, tables, eng, mailserver, *args, **kwargs):
     send_to = current_app.maintainers
     notify = current_app.datasets.get(session.get('datatype')).get("notify")
     if notify is not None:
         send_to = [*send_to, *notify]
-    data_receipt(
-        send_from = current_app.mail_from,
-        always_send_to = send_to,
-        login_email = session.get('login_info').get('login_email'),
-        dtype = session.get('datatype'),
-        submissionid = session.get('submissionid'),
-        originalfile = session.get('excel_path'),
-        tables = all_dfs.keys(),
-        eng = g.eng,
-        mailserver = current_app.config['MAIL_SERVER'],
-        login_info = session.get('login_info')
-    )
+    # The data is in at this point, so if the email fails, we do not want to tell them the submission failed
+    try:
+        data_receipt(
+            send_from = current_app.mail_from,
+            always_send_to = send_to,
+            login_email = session.get('login_info').get('login_email'),
+            dtype = session.get('datatype'),
+            submissionid = session.get('submissionid'),
+            originalfile = session.get('excel_path'),
+            tables = all_dfs.keys(),
+            eng = g.eng,
+            mailserver = current_app.config['MAIL_SERVER'],
+            login_info = session.get('login_info'),
+            counts = loaded_counts
+        )
+    except Exception as e:
+        print(f"Submission {session.get('submissionid')} was loaded, but the data receipt email could not be sent")
+        print(e)
     
     # TODO Need to move submitted and marked files to a separate directory that stores submitted files
     # I am having a conversation with myself, but present me, disagrees with past me.
@@ -234,17 +247,6 @@ def load():
     # SELECT submissionid FROM submission_tracking_table WHERE submit != 'yes'
 
 
-    # They are finally done!
-    # Set the submission tracking table record to 'submit = yes'
-    # Put their original filename in the submission tracking table
-    g.eng.execute(
-        f"""
-        UPDATE submission_tracking_table 
-        SET submit = 'yes' 
-        WHERE submissionid = {session.get('submissionid')};
-        """
-    )
-
     # They should not be able to submit with the same SubmissionID
     # Clear session after successful final submit
     session.clear()
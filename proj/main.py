@@ -1,17 +1,23 @@
 from flask import render_template, request, jsonify, current_app, Blueprint, session, g, send_from_directory
 from werkzeug.utils import secure_filename
 from gc import collect
-import os
+import os, shutil
 import pandas as pd
 from json import loads
 
 # custom imports, from local files
-from .preprocess import clean_data, hardcoded_fixes, rename_test_stations, check_test_stations
+from .preprocess import clean_data, check_test_stations
 from .match import match
 from .core.core import core
 from .core.functions import fetch_meta
 from .utils.generic import save_errors, correct_row_offset
-from .utils.excel import mark_workbook
+from .utils.errors import save_error_report, read_error_report, error_summary, rows_page, expand, KINDS as ERROR_KINDS
+from .utils.resultcache import cache_enabled, result_key, cached_result, store_result, restore_result, DEFAULT_SIZE as RESULT_CACHE_SIZE
+from .utils.excel import mark_workbook, read_workbook, round_trip_strings
+from .utils.snapshot import write_snapshot, read_snapshot
+from .load import prepare_load
+from .utils.jobs import submit_job, read_job, active_job, MARKING_JOBID
+from .utils.timing import start_spans, span, write_timings
 from .utils.exceptions import default_exception_handler
 from .custom import *
 
@@ -37,6 +43,11 @@ def main():
 
     # routine to grab the uploaded file
     print("uploading files")
+
+    # The check job works off of the files in the submission directory, so we cant let a new upload overwrite them while a job is running
+    if active_job(session['submission_dir']) is not None:
+        return jsonify(user_error_msg = "Your last file is still being checked. Please wait for it to finish before submitting another file.")
+
     files = request.files.getlist('files[]')
     if len(files) > 0:
         
@@ -78,9 +89,111 @@ def main():
 
     print("DONE uploading files")
 
+    # -------------------------------------------------------------------------- #
+
+    # The rest of the routine runs as a check job, outside of this request
+    # The browser gets the jobid back and polls /upload/status/<jobid> until the job is done
+    jobid = submit_job(
+        current_app._get_current_object(),
+        dict(session),
+        run_checks,
+        excel_path,
+        filename,
+        on_error = check_job_error_handler
+    )
+
+    return jsonify(jobid = jobid, submissionid = session.get("submissionid"))
+
+
+@upload.route('/upload/status/<jobid>', methods = ['GET'])
+def upload_status(jobid):
+
+    job = read_job(session['submission_dir'], secure_filename(jobid))
+    if job is None:
+        return jsonify(user_error_msg = f"Check job {jobid} not found for this submission")
+
+    # Whatever the pipeline put in the session (datatype, table_to_tab_map etc) needs to go in the user's session
+    # since that is what the final submit routine will use
+    session_data = job.pop('session')
+    if session_data is not None:
+        session.update(session_data)
+
+    return jsonify(**job)
+
+
+
+# The errors or warnings (kind) of the last upload, a page at a time. They can be filtered by table and error_type
+# The rows are left out, those come from the route below
+@upload.route('/errors/<kind>', methods = ['GET'])
+def error_report(kind):
+    if kind not in ERROR_KINDS:
+        return jsonify(user_error_msg = f"kind must be one of {', '.join(ERROR_KINDS)}")
+
+    page = max(request.args.get('page', 1, type = int), 1)
+    per_page = min(max(request.args.get('per_page', 100, type = int), 1), 1000)
+
+    records = [
+        r for r in read_error_report(session['submission_dir']).get(kind)
+        if (request.args.get('table') in (None, r.get('table')))
+        and (request.args.get('error_type') in (None, r.get('error_type')))
+    ]
+
+    return jsonify(
+        total = len(records),
+        page = page,
+        per_page = per_page,
+        errors = [
+            {k: v for k, v in r.items() if k != 'row_ranges'}
+            for r in records[(page - 1) * per_page : page * per_page]
+        ]
+    )
+
+
+# The row numbers of one error (or warning), a page at a time
+@upload.route('/errors/<kind>/<int:errorid>/rows', methods = ['GET'])
+def error_rows(kind, errorid):
+    if kind not in ERROR_KINDS:
+        return jsonify(user_error_msg = f"kind must be one of {', '.join(ERROR_KINDS)}")
+
+    records = read_error_report(session['submission_dir']).get(kind)
+    if not (0 <= errorid < len(records)):
+        return jsonify(user_error_msg = f"No {kind} with the id {errorid}")
+
+    page = max(request.args.get('page', 1, type = int), 1)
+    per_page = min(max(request.args.get('per_page', 1000, type = int), 1), 10000)
+
+    return jsonify(
+        total = records[errorid].get('row_count'),
+        page = page,
+        per_page = per_page,
+        rows = rows_page(records[errorid].get('row_ranges'), (page - 1) * per_page, per_page)
+    )
+
+
+
+def run_checks(job, excel_path, filename):
+
     # -------------------------------------------------------------------------- #
     
     # Read in the excel file to make a dictionary of dataframes (all_dfs)
+    job.stage("Reading the excel file")
+    start_spans()
+
+    # If this exact file was checked before, with the same code and the same reference data, the earlier result gets reused (see utils/resultcache.py)
+    cache_key = None
+    if cache_enabled(current_app.config):
+        with span("result_cache") as s:
+            try:
+                cache_key = result_key(excel_path, g.eng, current_app, session.get('login_info'), session.get('final_submit_requested'))
+                cached = cached_result(cache_key)
+            except Exception as e:
+                # the cache is only there to save time, it should never be the reason a check job fails
+                print("Unable to use the result cache")
+                print(e)
+                cache_key, cached = None, None
+            s['hit'] = cached is not None
+        if cached is not None:
+            return reuse_result(job, cached, excel_path, filename)
 
     assert isinstance(current_app.excel_offset, int), \
         "Number of rows to offset in excel file must be an integer. Check__init__.py"
@@ -99,27 +212,20 @@ def main():
     # converters = current_app.config.get('DTYPE_CONVERTERS')
     # converters = {k: eval(v) for k,v in converters.items()} if converters is not None else None
 
-    all_dfs = {
-
-        # Some projects may have descriptions in the first row, which are not the column headers
-        # This is the only reason why the skiprows argument is used.
-        # For projects that do not set up their data templates in this way, that arg should be removed
-
-        # Note also that only empty cells will be regarded as missing values
-        
-        # converters should not be applied at this stage - should be applied after match tables
-        sheet: pd.read_excel(
-            excel_path, 
-            sheet_name = sheet,
-            skiprows = current_app.excel_offset,
-            keep_default_na=False,
-            na_values = ['']
+    # Some projects may have descriptions in the first row, which are not the column headers
+    # This is the only reason why the skiprows argument is used.
+    # Note also that only empty cells will be regarded as missing values
+    # converters should not be applied at this stage - should be applied after match tables
+    # read_workbook opens the file once and parses each sheet from that, rather than re-opening the whole file per sheet
+    with span("read workbook") as s:
+        all_dfs = dict(
+            read_workbook(
+                excel_path,
+                skiprows = current_app.excel_offset,
+                ignored_tabs = ignored_tabs
+            )
         )
-        
-        for sheet in pd.ExcelFile(excel_path).sheet_names
-        
-        if ((sheet not in ignored_tabs) and (not sheet.startswith('lu_')))
-    }
+        s['rows'] = sum(len(df) for df in all_dfs.values())
 
     print("before filtering out empty dataframes")
     # filter out empty dataframes
@@ -130,7 +236,7 @@ def main():
             "critical_error": False,
             "user_error_msg": "You submitted a file with all empty tabs.",
         }
-        return jsonify(**returnvals)
+        return returnvals
     
     #assert len(all_dfs) > 0, f"submissionid - {session.get('submissionid')} all_dfs is empty"
     
@@ -153,8 +259,10 @@ def main():
     # alter the all_dfs variable with the match function
     # keys of all_dfs should be no longer the original sheet names but rather the table names that got matched, if any
     # if the tab didnt match any table it will not alter that item in the all_dfs dictionary
+    job.stage("Matching tables")
     print("Running match tables routine")
-    match_dataset, match_report, all_dfs = match(all_dfs)
+    with span("match", rows = sum(len(df) for df in all_dfs.values())):
+        match_dataset, match_report, all_dfs = match(all_dfs)
 
     # NOTE if all tabs in all_dfs matched a database table, but there is still no match_dataset
     #    then the problem is the app is not properly configured
@@ -170,7 +278,7 @@ def main():
         # A tab in their excel file did not get matched with a table
         # return to user
         print("Failed to match a dataset")
-        return jsonify(
+        return dict(
             filename = filename,
             match_report = match_report,
             match_dataset = match_dataset,
@@ -197,20 +305,18 @@ def main():
 
     # NOTE We should confirm whether they are ok with us doing this or not
     #   of course, the test station renaming is perfectly fine
+    job.stage("Preprocessing")
     print("preprocessing and cleaning data")
     
     # We are not sure if we want to do this
     # some projects like bight prohibit this
-    all_dfs = clean_data(all_dfs)
-    all_dfs = hardcoded_fixes(all_dfs)
-
-    
-    # if login_email == 'test@sccwrp.org' then it will rename the stations
-    
+    # strips whitespace, rewrites the chemistry units, and renames the test stations if login_email is the testing email (see NORMALIZATION_RULES in preprocess.py)
     print("login_email")
     print(str(session.get('login_info').get('login_email')) )
-    
-    all_dfs = rename_test_stations(all_dfs, str(session.get('login_info').get('login_email')) )
+
+    # the values that get changed to match the lookup lists (if fix_case is on for the dataset) come back as warnings
+    preprocess_warnings = []
+    all_dfs = clean_data(all_dfs, str(session.get('login_info').get('login_email')), match_dataset, warnings = preprocess_warnings)
 
 
 
@@ -234,41 +340,31 @@ def main():
     #   With the way the code is structured, that should always be the case, but the assert statement will let us know if we messed up or need to fix something 
     #   Technically we could write it back with the original tab names, and use the tab_to_table_map in load.py,
     #   But for now, the tab_table_map is mainly used by the javascript in the front end, to display error messages to the user
-    writer = pd.ExcelWriter(excel_path, engine = 'xlsxwriter') #, engine_kwargs = {"strings_to_formulas":False})
-    for tblname in all_dfs.keys():
-        all_dfs[tblname].to_excel(
-            writer, 
-            sheet_name = tblname, 
-            startrow = current_app.excel_offset, 
-            index=False
-        )
-    #writer.save()
-    writer.close()
-    
-    # Yes this is weird but if we write the all_dfs back to the excel file, and read it back in,
-    # this ensures 100% that the data is loaded exactly in the same state as it was in when it was checked
-    for sheet in pd.ExcelFile(excel_path).sheet_names:
-        if ((sheet not in current_app.tabs_to_ignore) and (not sheet.startswith('lu_'))):
-            
-            converters = fetch_meta(sheet, g.eng, return_converters = True)
-            string_converters = converters.get("string_converters")
-            
-            assert string_converters is not None, f"String converters not returned for {sheet} in fetch_meta function"
-
-            # This should never raise an exception - at least converting the columns to str datatypes should never cause a problem
-            tmpdf = pd.read_excel(
-                excel_path, 
-                sheet_name = sheet,
-                keep_default_na=False,
-                skiprows = current_app.excel_offset,
-                na_values = [''],
-                converters = string_converters
+    with span("write workbook", rows = sum(len(df) for df in all_dfs.values())):
+        writer = pd.ExcelWriter(excel_path, engine = 'xlsxwriter') #, engine_kwargs = {"strings_to_formulas":False})
+        for tblname in all_dfs.keys():
+            all_dfs[tblname].to_excel(
+                writer, 
+                sheet_name = tblname, 
+                startrow = current_app.excel_offset, 
+                index=False
             )
+        #writer.save()
+        writer.close()
+    
+    # The excel file is still written because custom checks (toxicity, ocean acidification) append their analysis tabs to it,
+    # and the marked excel file is made from it.
+    # It is NOT read back in anymore. Instead, the string converters are applied here, and the dataframes are written to the submission snapshot.
+    # The snapshot is what gets loaded during final submit, so the data that gets loaded is exactly the data that was checked
+    for tblname in all_dfs.keys():
+        string_converters = fetch_meta(tblname, g.eng, return_converters = True).get("string_converters")
+        assert string_converters is not None, f"String converters not returned for {tblname} in fetch_meta function"
+        
+        # This should never raise an exception - at least converting the columns to str datatypes should never cause a problem
+        round_trip_strings(all_dfs[tblname], [c for c in all_dfs[tblname].columns if c in string_converters.keys()])
 
-
-            all_dfs.update({
-                sheet: tmpdf
-            })
+    with span("write snapshot"):
+        write_snapshot(all_dfs, session['submission_dir'])
 
     
     # ----------------------------------------- #
@@ -277,11 +373,12 @@ def main():
 
     # initialize errors and warnings
     errs = []
-    warnings = []
+    warnings = [*preprocess_warnings]
 
     # Special routine for test data:
     errs.extend(check_test_stations(all_dfs, session.get('login_info').get('login_email')))
 
+    job.stage("Core checks")
     print("Core Checks")
 
     # meta data is needed for the core checks to run, to check precision, length, datatypes, etc
@@ -293,11 +390,11 @@ def main():
    
     # tack on core errors to errors list
     
-    # debug = False will cause corechecks to run with multiprocessing, 
-    # but the logs will not show as much useful information
+    # debug = False runs the core checks in the core check pool (CORE_CHECK_WORKERS in the config, see core/pool.py)
+    # set CORE_CHECK_DEBUG to "True" to run them one at a time, the logs show more useful information that way
     print("Right before core runs")
-    # core_output = core(all_dfs, g.eng, dbmetadata, debug = False)
-    core_output = core(all_dfs, g.eng, dbmetadata, debug = True)
+    with span("core", rows = sum(len(df) for df in all_dfs.values())):
+        core_output = core(all_dfs, g.eng, dbmetadata, debug = str(current_app.config.get('CORE_CHECK_DEBUG')) == 'True')
     print("Right after core runs")
 
     errs.extend(core_output['core_errors'])
@@ -354,6 +451,7 @@ def main():
 
 
 
+        job.stage("Custom checks")
         print("Custom Checks")
         print(f"Datatype: {match_dataset}")
         print(f"{match_dataset} function:")
@@ -365,7 +463,8 @@ def main():
         # The custom checks function is stored in __init__.py in the datasets dictionary and accessed and called accordingly
         # match_dataset is a string, which should also be the same as one of the function names imported from custom, so we can "eval" it
         try:
-            custom_output = eval(str(match_dataset).replace("_nobatch",""))(all_dfs)
+            with span(f"custom - {match_dataset}", rows = sum(len(df) for df in all_dfs.values())):
+                custom_output = eval(str(match_dataset).replace("_nobatch",""))(all_dfs)
         except NameError as err:
             print("Error with custom checks")
             print(err)
@@ -397,8 +496,34 @@ def main():
         # A certain routine needs to run for tox
         # If there were errors on the summary table dataframe, then the tox summary has to be added to the all_dfs variable
         if current_app.config.get("TOXSUMMARY_TABLENAME") in session['table_to_tab_map']:
-            all_dfs[current_app.config.get("TOXSUMMARY_TABLENAME")] = pd.read_excel(session.get('excel_path'), sheet_name=current_app.config.get("TOXSUMMARY_TABLENAME"))
+            all_dfs.update(
+                read_workbook(
+                    session.get('excel_path'), 
+                    sheets = [current_app.config.get("TOXSUMMARY_TABLENAME")],
+                    keep_default_na = True,
+                    na_values = None
+                )
+            )
                 
+        # Analysis tables are created by the custom checks and written to the excel file (tox summary, OA analysis tables)
+        # They need to go into the snapshot, since that is what gets loaded on final submit
+        analysis_tables = current_app.datasets.get(match_dataset).get('analysis_tables')
+        if analysis_tables:
+            def analysis_string_converters(sheet):
+                return fetch_meta(sheet, g.eng, return_converters = True).get("string_converters")
+            write_snapshot(
+                dict(
+                    read_workbook(
+                        session.get('excel_path'), 
+                        skiprows = current_app.excel_offset,
+                        sheets = analysis_tables,
+                        converters = analysis_string_converters
+                    )
+                ),
+                session['submission_dir'],
+                replace = False
+            )
+
 
         print("DONE - Custom Checks")
 
@@ -410,8 +535,19 @@ def main():
     # Save the warnings and errors in the current submission directory
     # It would be convenient to store in the session cookie but that has a 4kb limit
     # instead we can just dump it to a json file
-    save_errors(errs, os.path.join( session['submission_dir'], "errors.json" ))
-    save_errors(warnings, os.path.join( session['submission_dir'], "warnings.json" ))
+    with span("save_errors", rows = len(errs) + len(warnings)):
+        save_errors(errs, os.path.join( session['submission_dir'], "errors.json" ))
+        save_errors(warnings, os.path.join( session['submission_dir'], "warnings.json" ))
+
+    # If it can be submitted, the data gets put in the form it gets loaded in now, so final submit only has to copy it to the database
+    # (see prepare_load in load.py) - if this fails, /load does it itself
+    if all(len(e) == 0 for e in errs):
+        with span("prepare_load", rows = sum(len(df) for df in all_dfs.values())):
+            try:
+                prepare_load(session['submission_dir'], match_dataset, g.eng)
+            except Exception as e:
+                print("Unable to write the load snapshot")
+                print(e)
     
     # Later we will need to have a way to map the dataframe column names to the column indices
     # This is one of those lines of code where i dont know why it is here, but i have a feeling it will
@@ -435,21 +571,20 @@ def main():
     warnings = correct_row_offset(warnings, offset = current_app.excel_offset)
     print("warnings populated")
 
+    # The errors and warnings with their rows as ranges, for the report page (see utils/errors.py)
+    # The browser only gets the counts back, and gets the rest a page at a time from the /errors routes
+    with span("save_error_report", rows = len(errs) + len(warnings)):
+        error_report = save_error_report(errs, warnings, session['submission_dir'])
+
 
     # -------------------------------------------------------------------------------- #
 
     # Mark up the excel workbook
-    print("Marking Excel file")
-
-    # mark_workbook function returns the file path to which it saved the marked excel file
-    session['marked_excel_path'] = mark_workbook(
-        all_dfs = all_dfs, 
-        excel_path = session.get('excel_path'), 
-        errs = errs, 
-        warnings = warnings
-    )
-
-    print("DONE - Marking Excel file")
+    # Making the marked excel file is not part of the check job anymore, since a lot of people only look at the errors in the browser
+    #   the job for it gets submitted here, and the browser gets its result without waiting on it.
+    #   The download route tells the browser to wait if it is asked for the file before the marking job is done
+    marked_filename = f"{filename.rsplit('.',1)[0]}-marked.{filename.rsplit('.',1)[-1]}"
+    marking_jobid = start_marking(marked_filename, errs, warnings)
 
     # -------------------------------------------------------------------------------- #
 
@@ -458,12 +593,12 @@ def main():
     # https://pics.me.me/code-comments-be-like-68542608.png
     returnvals = {
         "filename" : filename,
-        "marked_filename" : f"{filename.rsplit('.',1)[0]}-marked.{filename.rsplit('.',1)[-1]}",
+        "marked_filename" : marked_filename,
+        "marking_jobid" : marking_jobid,
         "match_report" : match_report,
         "matched_all_tables" : True,
         "match_dataset" : match_dataset,
-        "errs" : errs,
-        "warnings": warnings,
+        "error_summary" : error_summary(error_report),
         "submissionid": session.get("submissionid"),
         "critical_error": False,
         "all_datasets": list(current_app.datasets.keys()),
@@ -473,8 +608,122 @@ def main():
     
     #print(returnvals)
 
-    print("DONE with upload routine, returning JSON to browser")
-    return jsonify(**returnvals)
+    # timings.json goes next to errors.json, the admin /timings route aggregates them
+    write_timings(session['submission_dir'], submissionid = session.get("submissionid"), datatype = match_dataset)
+
+    if cache_key is not None:
+        with span("store_result"):
+            try:
+                store_result(cache_key, returnvals, dict(session), int(current_app.config.get('RESULT_CACHE_SIZE', RESULT_CACHE_SIZE)))
+            except Exception as e:
+                print("Unable to store the result in the result cache")
+                print(e)
+
+    print("DONE with check job, returning result")
+    return returnvals
+
+
+# A submission with no errors or warnings has nothing to mark, so the marked file is just a copy of the file
+# Otherwise the marking job gets submitted, and its jobid is returned
+def start_marking(marked_filename, errs, warnings):
+    if len(errs) + len(warnings) == 0:
+        print("No errors or warnings, the marked excel file is a copy of the excel file")
+        session['marked_excel_path'] = os.path.join(session['submission_dir'], marked_filename)
+        shutil.copy(session.get('excel_path'), session['marked_excel_path'])
+        return None
+
+    print("Submitting the marking job")
+    return submit_job(
+        current_app._get_current_object(),
+        dict(session),
+        mark_submission,
+        errs,
+        warnings,
+        jobid = MARKING_JOBID
+    )
+
+
+# The check job when the result cache has the result for the file already
+# It puts the files from the earlier check in this submission directory, and gives back the earlier result
+def reuse_result(job, entry, excel_path, filename):
+    job.stage("Reusing the result of an earlier check of this file")
+    print(f"Result cache hit - reusing the result from {entry.get('submission_dir')}")
+
+    restore_result(entry, session['submission_dir'], excel_path)
+    session.update(entry.get('session'))
+
+    g.eng.execute(
+        f"""
+        UPDATE submission_tracking_table 
+        SET datatype = '{session.get('datatype')}'
+        WHERE submissionid = {session.get('submissionid')};
+        """
+    )
+
+    # the marked file from the earlier check can be used too, as long as its marking job is not still going (or failed)
+    result = entry.get('result')
+    marked_filename = f"{filename.rsplit('.',1)[0]}-marked.{filename.rsplit('.',1)[-1]}"
+    earlier_marked_path = os.path.join(entry.get('submission_dir'), result.get('marked_filename'))
+    earlier_marking = read_job(entry.get('submission_dir'), MARKING_JOBID)
+    marking_jobid = None
+    if os.path.exists(earlier_marked_path) and ((earlier_marking is None) or (earlier_marking.get('status') == 'done') or (result.get('marking_jobid') is None)):
+        session['marked_excel_path'] = os.path.join(session['submission_dir'], marked_filename)
+        if os.path.abspath(earlier_marked_path) != os.path.abspath(session['marked_excel_path']):
+            shutil.copy(earlier_marked_path, session['marked_excel_path'])
+    else:
+        error_report = read_error_report(session['submission_dir'])
+        marking_jobid = start_marking(marked_filename, expand(error_report.get('errors')), expand(error_report.get('warnings')))
+
+    write_timings(session['submission_dir'], submissionid = session.get("submissionid"), datatype = session.get('datatype'), result_cache = 'hit')
+
+    return {
+        **result,
+        "filename" : filename,
+        "marked_filename" : marked_filename,
+        "marking_jobid" : marking_jobid,
+        "submissionid": session.get("submissionid"),
+        "table_to_tab_map" : session['table_to_tab_map'],
+        "final_submit_requested" : session.get("final_submit_requested")
+    }
+
+
+# Runs as a job of its own once the check job is done (see the end of run_checks)
+# The sheets are written from the snapshot rather than all_dfs, since some of the custom checks add their own columns to the dataframes (tmp_row)
+def mark_submission(job, errs, warnings):
+    job.stage("Marking the excel file")
+
+    # nothing gets loaded from here, so there is no need to check the hashes
+    all_dfs = read_snapshot(session['submission_dir'], verify = False)
+
+    # mark_workbook function returns the file path to which it saved the marked excel file
+    session['marked_excel_path'] = mark_workbook(
+        all_dfs = all_dfs, 
+        excel_path = session.get('excel_path'), 
+        errs = errs, 
+        warnings = warnings,
+        startrow = current_app.excel_offset
+    )
+
+    print("DONE - Marking Excel file")
+    return {"marked_filename": os.path.basename(session['marked_excel_path'])}
+
+
+# When the check job crashes, the maintainers still get the email, and the browser gets the critical error response through the status route
+def check_job_error_handler(error):
+    # keep the timings of the stages that ran before it crashed
+    write_timings(session['submission_dir'], submissionid = session.get("submissionid"), datatype = session.get("datatype"), failed = True)
+
+    response = default_exception_handler(
+        mail_from = current_app.mail_from,
+        errmsg = str(error),
+        maintainers = current_app.maintainers,
+        project_name = current_app.project_name,
+        attachment = session.get('excel_path'),
+        login_info = session.get('login_info'),
+        submissionid = session.get('submissionid'),
+        mail_server = current_app.config['MAIL_SERVER']
+    )
+    return response.get_json()
 
 # When an exception happens when the browser is sending requests to the upload blueprint, this routine runs
 @upload.errorhandler(Exception)
@@ -1,9 +1,83 @@
+import numpy as np
 import pandas as pd
-from copy import deepcopy
+from threading import Lock
 from flask import session, current_app, g
-from gc import collect
 from openpyxl import load_workbook
 
+from .utils.schema import get_catalog
+
+
+# Column signature index
+# Matching a tab to a table used to compare the set of the tab's columns against every tbl_ table with an apply,
+#   and when there was no match, three more applies over every table to find the closest one
+# The index is built from the schema catalog once (and again whenever the catalog gets reloaded)
+#   - signatures maps the frozenset of a table's columns to the table name, so an exact match is a dictionary lookup
+#   - incidence is a table by column matrix of 0s and 1s, so the size of the symmetric difference with every table
+#     comes out of one matrix multiplication:  |tab| + |table| - 2 * |tab & table|
+class ColumnSignatureIndex:
+    def __init__(self, cols_df):
+        # cols_df has the columns table_name and column_name
+        grouped = cols_df.groupby('table_name').column_name.apply(list)
+
+        self.tables = grouped.index.tolist()
+        self.columns = {tbl: colnames for tbl, colnames in grouped.items()}
+        self.vocabulary = {col: i for i, col in enumerate(sorted(cols_df.column_name.unique()))}
+
+        self.signatures = dict()
+        for tbl in self.tables:
+            # if two tables have exactly the same columns, the first one (alphabetically) wins, like it did before
+            self.signatures.setdefault(frozenset(self.columns[tbl]), tbl)
+
+        self.incidence = np.zeros((len(self.tables), len(self.vocabulary)), dtype = 'int32')
+        for i, tbl in enumerate(self.tables):
+            self.incidence[i, [self.vocabulary[c] for c in set(self.columns[tbl])]] = 1
+        self.table_sizes = self.incidence.sum(axis = 1)
+
+    def exact(self, colnames):
+        '''the table with exactly these columns, or None'''
+        return self.signatures.get(frozenset(colnames))
+
+    def closest(self, colnames):
+        '''the table with the smallest symmetric difference with these columns, and what is different'''
+        tab = set(colnames)
+        vector = np.zeros(len(self.vocabulary), dtype = 'int32')
+        vector[[self.vocabulary[c] for c in tab if c in self.vocabulary]] = 1
+
+        symdiff_len = len(tab) + self.table_sizes - 2 * (self.incidence @ vector)
+
+        # argmin gives the first one in case multiple tables tied for being the closest
+        tbl = self.tables[int(np.argmin(symdiff_len))]
+        return {
+            "table_name"       : tbl,
+            "in_tab_not_table" : [c for c in colnames if c not in set(self.columns[tbl])],
+            "in_table_not_tab" : [c for c in self.columns[tbl] if c not in tab]
+        }
+
+
+_index = {"catalog": None, "key": None, "index": None}
+_index_lock = Lock()
+
+def signature_index(eng, system_fields, toxsummary_tablename):
+    catalog = get_catalog(eng)
+    key = (tuple(system_fields), toxsummary_tablename)
+
+    with _index_lock:
+        if (_index['catalog'] is not catalog) or (_index['key'] != key):
+            # the columns of the tbl_ tables (and the tox summary table) from the schema catalog, leaving out the system fields and login fields
+            cols_df = catalog.all_columns()
+            cols_df = cols_df[
+                (cols_df.table_name.str.startswith('tbl_') | (cols_df.table_name == toxsummary_tablename))
+                & (~cols_df.column_name.isin(system_fields))
+                & (~cols_df.column_name.str.startswith('login_'))
+            ]
+
+            # we assume that query will return results
+            assert not cols_df.empty, "match.py - dataframe for which tables have which columns, came up empty for some reason"
+
+            _index.update(catalog = catalog, key = key, index = ColumnSignatureIndex(cols_df[['table_name', 'column_name']]))
+
+        return _index['index']
+
 
 def match(all_dfs):
 
@@ -15,71 +89,25 @@ def match(all_dfs):
     # To be used in the error reporting system on the front end when the app returns the json response to the browser
     table_to_tab_map = dict()
 
-    match_tbls_sql = f"""
-        SELECT table_name, column_name 
-        FROM information_schema.columns 
-        WHERE ((table_name LIKE 'tbl_%%') OR (table_name = '{current_app.config.get("TOXSUMMARY_TABLENAME")}'))
-        AND column_name NOT IN ('{"','".join(system_fields)}')
-        AND column_name NOT LIKE 'login_%%'
-        ;"""
-
-    cols_df = pd.read_sql(match_tbls_sql, eng) \
-        .groupby('table_name') \
-        .apply(lambda x: x.column_name.tolist() ) \
-        .reset_index(name='colnames')
-    
-    # if someone would want to see what the above dataframe looks like, you can uncomment this line
-    # but it should result in a 2 column dataframe, with the table name in one column, and all the column names
-    # of that table in the other column, separated by pipes
-    # print("cols_df")
-    # print(cols_df)
-
-    # we assume that query will return results
-    assert not cols_df.empty, "match.py - dataframe for which tables have which columns, came up empty for some reason"
+    index = signature_index(eng, system_fields, current_app.config.get("TOXSUMMARY_TABLENAME"))
 
     match_report = []
 
-    # unless we make a deep copy of all_dfs, it will alter all_dfs during the for loop
-    # but if we iterate on the items of all_dfs and all_dfs changes during the steps of iteration, thats a big problem
-    # I am surprised there wasnt an infinite loop before
-    # We can delete tmp_dfs after and collect the garbage
-    tmp_dfs = deepcopy(all_dfs)
-    
     matched_tables = []
 
-    for sheetname, df in tmp_dfs.items():
-
-        # joining the submitted dataframe by pipes and trying to match
+    # all_dfs gets changed during the loop (tabs get renamed to the table they matched) so we loop over a list of the items
+    # Only the column headers are needed here, so there is no need to copy the dataframes
+    for sheetname, df in list(all_dfs.items()):
 
-        m = cols_df[
-            # each item in the colnames column should be a set
-            cols_df.colnames.apply(lambda x: set(x) == set(df.columns))
-        ]
+        matched_tbl = index.exact(df.columns)
 
         print("df.columns")
         print(df.columns)
         
 
-        if m.empty:
+        if matched_tbl is None:
             print(f"No match for {sheetname} - finding closest match")
-            cols_df['in_tab_not_table'] = cols_df.colnames.apply(
-                lambda x: list( set(df.columns.tolist()) - set(x) )
-            )
-            cols_df['in_table_not_tab'] = cols_df.colnames.apply(
-                lambda x:  list( set(x) - set(df.columns.tolist()) )
-            )
-
-            # symdiff = symmetric difference
-            cols_df['symdiff_len'] = cols_df.colnames.apply(lambda x:  len(set(x).symmetric_difference(set(df.columns.tolist()))) )
-
-
-            closest = cols_df[cols_df.symdiff_len == cols_df.symdiff_len.min()]
-            
-            # We assume its not empty
-            assert not closest.empty, "match.py - dataframe with variable name closest is empty for some reason"
-
-            # iloc zero (grab only first row) in case mutliple tables tied for being the closest
-            closest = closest.iloc[0].to_dict()
+            closest = index.closest(df.columns.tolist())
 
             match_report.append(
                 {
@@ -93,8 +121,6 @@ def match(all_dfs):
 
         else:
             print(f"found match for {sheetname}")
-            # m should only have one row based on our assumption covered in the assert statement above the for loop
-            matched_tbl = m.iloc[0, m.columns.get_loc("table_name")]
 
             # append it to the matched_tables list
             matched_tables.append(matched_tbl)
@@ -122,12 +148,7 @@ def match(all_dfs):
                 }
             )
         
-    # delete the temp object and collect garbage to save memory
-    del tmp_dfs
-    collect()
 
-    
-    
     # I am not quite sure why we now do it so that the tables list matches the matched_tables list rather than the keys of the dictionary
     # But we will use this to get rid of the tox summary tab if they are submitting tox data with a summary
     # match_dataset = [k for k,v in datasets.items() if set(v.get('tables')) == set(all_dfs.keys())]
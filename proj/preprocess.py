@@ -6,6 +6,10 @@ import re
 import time
 import numpy as np
 
+from .utils.timing import span
+from .utils.schema import get_catalog
+from .utils.lookups import lookup_values, lookup_cache
+
 # its getting late and its Friday and i need to leave soon,
 # I put this in a table called "lu_teststation"
 # later i need to adjust the checker code to use that table rather 
@@ -23,166 +27,172 @@ test_station_renaming_key = {
     'B23-12113' : 'B23-TEST11'
 }
 
+# The varchar columns of the table, leaving out the login fields and system fields
+def varchar_columns(table_name, df):
+    meta = get_catalog(g.eng).columns(table_name)
+    meta = meta[(~meta.column_name.str.startswith('login_')) & (~meta.column_name.isin(current_app.system_fields))]
+    return [c for c in meta[meta['udt_name'] == 'varchar'].column_name.values if c in df.columns]
+
+
+def as_strings(col):
+    # str(x) of every value in the column
+    # astype(str) does that for object columns, but for datetime columns it uses a format for the whole column (it leaves off the time if they are all midnight)
+    return col.astype(str) if col.dtype == object else col.map(str)
+
+
+def count_changed(before, after):
+    # how many values a normalization rule changed (nulls that stayed null dont count)
+    return int((~((before == after) | (pd.isnull(before) & pd.isnull(after)))).sum())
+
+
 def strip_whitespace(all_dfs: dict):
     print("BEGIN Stripping whitespace function")
-    for table_name in all_dfs.keys():
-        #First get all the foreign keys columns
-        meta = pd.read_sql(
-            f"""
-            SELECT 
-                table_name, 
-                column_name, 
-                is_nullable, 
-                data_type,
-                udt_name, 
-                character_maximum_length, 
-                numeric_precision, 
-                numeric_scale 
-            FROM 
-                information_schema.columns 
-            WHERE 
-                table_name = '{table_name}'
-                AND column_name NOT LIKE 'login_%%'
-                AND column_name NOT IN ('{"','".join(current_app.system_fields)}');
-            """, 
-             g.eng
-        )
-        
-        meta[meta['udt_name'] == 'varchar']
-        table_df = all_dfs[f'{table_name}'] 
-        # Get all varchar cols from table in all_dfs
-        all_varchar_cols = meta[meta['udt_name'] == 'varchar'].column_name.values
-        
-        # Strip whitespace left side and right side
-        table_df[all_varchar_cols] = table_df[all_varchar_cols].apply(
-            lambda col: col.apply(lambda x: str(x).strip() if not pd.isnull(x) else x)
-        )
-        all_dfs[f"{table_name}"] = table_df
+    changed = 0
+    for table_name, table_df in all_dfs.items():
+        for col in varchar_columns(table_name, table_df):
+            # Strip whitespace left side and right side, leaving the empty values as they are
+            stripped = table_df[col].astype(object).where(pd.isnull(table_df[col]), as_strings(table_df[col]).str.strip())
+            changed += count_changed(table_df[col], stripped)
+            table_df[col] = stripped
     print("END Stripping whitespace function")
-    return all_dfs
-
-def fix_case(all_dfs: dict):
+    return changed
+
+# Lookup list case correction
+# If the only thing wrong with a value is the capitalization (or the lookup list has it as "Reference - SRM 1944" and they put "reference - srm 1944")
+#   we change it to the value in the lookup list, rather than failing the lookup list check
+# It is turned on per dataset in the config ("fix_case": "True" in the dataset), some projects like bight dont want us changing their data
+# The corrected values get reported back as warnings so the user knows what we changed
+def fix_case(all_dfs: dict, warnings = None):
     print("BEGIN fix_case function")
-    for table_name in all_dfs.keys():
-        table_df = all_dfs[f'{table_name}'] 
-    #Among all the varchar cols, only get the ones tied to the lookup list -- modified to only find lu_lists that are not of numeric types
-        lookup_sql = f"""
-            SELECT
-                kcu.column_name, 
-                ccu.table_name AS foreign_table_name,
-                ccu.column_name AS foreign_column_name,
-                isc.data_type AS column_data_type 
-            FROM 
-                information_schema.table_constraints AS tc 
-                JOIN information_schema.key_column_usage AS kcu
-                ON tc.constraint_name = kcu.constraint_name
-                AND tc.table_schema = kcu.table_schema
-                JOIN information_schema.constraint_column_usage AS ccu
-                ON ccu.constraint_name = tc.constraint_name
-                AND ccu.table_schema = tc.table_schema
-                JOIN information_schema.columns as isc
-                ON isc.column_name = ccu.column_name
-                AND isc.table_name = ccu.table_name
-            WHERE tc.constraint_type = 'FOREIGN KEY' 
-            AND tc.table_name='{table_name}'
-            AND ccu.table_name LIKE 'lu_%%'
-            AND isc.data_type NOT IN ('integer', 'smallint', 'numeric');
-        """
-        lu_info = pd.read_sql(lookup_sql, g.eng)
-           
-        # The keys of this dictionary are the column's names in the dataframe, values are their lookup values
-        foreignkeys_luvalues = {
-            x : y for x,y in zip(
-                lu_info.column_name,
-                [
-                    pd.read_sql(f"SELECT {lu_col} FROM {lu_table}",  g.eng)[f'{lu_col}'].to_list() 
-                    for lu_col,lu_table 
-                    in zip (lu_info.foreign_column_name, lu_info.foreign_table_name) 
-                ]
-            ) 
-        }
-        # Get their actual values in the dataframe
-        foreignkeys_rawvalues = {
-            x : [
-                item 
-                for item in table_df[x] 
-                if str(item).lower() in list(map(str.lower,foreignkeys_luvalues[x])) # bug: 'lower' for 'str' objects doesn't apply to 'int' object
-            ]  
-            for x in lu_info.column_name
-        }
-        
-        # Remove the empty lists in the dictionary's values. 
-        # Empty lists indicate there are values that are not in the lu list for a certain column
-        # This will be taken care of by core check.
-        foreignkeys_rawvalues = {x:y for x,y in foreignkeys_rawvalues.items() if len(y)> 0}
-        
-        # Now we need to make a dictionary to fix the case, something like {col: {wrongvalue:correctvalue} }
-        # this is good indentation, looks good and easy to read - Robert
-        fix_case  = {
-            col : {
-                  item : new_item 
-                  for item in foreignkeys_rawvalues[col] 
-                  for new_item in foreignkeys_luvalues[col] 
-                  if str(item).lower() == new_item.lower()
-            } 
-            for col in foreignkeys_rawvalues.keys()
-        }
-        table_df = table_df.replace(fix_case)                
-        all_dfs[f'{table_name}'] = table_df
-    print("END fix_case function")
-    return all_dfs
+    changed = 0
+    for table_name, table_df in all_dfs.items():
+        # Among all the varchar cols, only get the ones tied to the lookup list -- modified to only find lu_lists that are not of numeric types
+        lu_info = get_catalog(g.eng).foreign_keys(table_name)
+        lu_info = lu_info[
+            lu_info.foreign_data_type.notnull() 
+            & ~lu_info.foreign_data_type.isin(['integer', 'smallint', 'numeric']) 
+            & lu_info.column_name.isin(table_df.columns)
+        ]
+        lookup_cache.prefetch(list(zip(lu_info.foreign_table_name, lu_info.foreign_column_name)), g.eng)
+
+        for col, lu_table, lu_col in zip(lu_info.column_name, lu_info.foreign_table_name, lu_info.foreign_column_name):
+            if table_df[col].dtype != object:
+                # no strings in the column, nothing to fix
+                continue
+
+            # casefolded lookup list value -> lookup list value
+            # if two values in the lookup list only differ by case, we cant know which one they meant, so those get left alone
+            casefolded = dict()
+            for v in lookup_values(lu_table, lu_col, g.eng):
+                if isinstance(v, str):
+                    casefolded.setdefault(v.casefold(), []).append(v)
+            casefolded = {k: v[0] for k, v in casefolded.items() if len(v) == 1}
+
+            # .str gives NaN for the values that are not strings, and those map to NaN
+            corrected = table_df[col].str.casefold().map(casefolded)
+            fix = (corrected.notnull() & (corrected != table_df[col])).values
+            if not fix.any():
+                continue
+
+            if warnings is not None:
+                # one warning per value that got changed
+                fixed = pd.DataFrame({"original": table_df[col].values[fix], "corrected": corrected.values[fix], "row": np.flatnonzero(fix)})
+                for (original, new_value), grp in fixed.groupby(['original', 'corrected']):
+                    warnings.append({
+                        "table": table_name,
+                        "rows": grp.row.tolist(),
+                        "columns": col,
+                        "error_type": "Case Corrected",
+                        "is_core_error": False,
+                        "error_message": f"The value {original} was changed to {new_value} to match the lookup list {lu_table}"
+                    })
+
+            table_df.loc[fix, col] = corrected.values[fix]
+            changed += int(fix.sum())
 
+    print("END fix_case function")
+    return changed
 
 
 # because every project will have those non-generalizable, one off, "have to hard code" kind of fixes
 # and this project is no exception
 def hardcoded_fixes(all_dfs):
+    changed = 0
     if 'tbl_chemresults' in all_dfs.keys():
-        all_dfs['tbl_chemresults']['units'] = all_dfs['tbl_chemresults'] \
-            .apply(
-                lambda row: str(row.units).replace('ug/kg ww','ng/g ww').replace('ug/kg dw','ng/g dw') if not ('Reference' in str(row.sampletype)) else row.units, 
-                axis = 1
-            )
-    print('hardcorde fixes - done')
-    return all_dfs
+        df = all_dfs['tbl_chemresults']
 
+        # the units of the non reference samples get rewritten from ug/kg to ng/g
+        # (like before, those units end up as strings, even if they were empty)
+        rows = ~as_strings(df['sampletype']).str.contains('Reference', regex = False)
+        units = df['units'].astype(object)
+        units[rows.values] = as_strings(units[rows.values]).str.replace('ug/kg ww', 'ng/g ww', regex = False).str.replace('ug/kg dw', 'ng/g dw', regex = False).values
 
-def clean_data(all_dfs):
-    print("preprocessing")
-    print("strip whitespace")
-    #print(all_dfs['tbl_fish_sample_metadata'][['siteid','estuaryname']])
-    #rint('\n')
-    all_dfs = strip_whitespace(all_dfs)
-    #print(all_dfs['tbl_fish_sample_metadata'][['siteid','estuaryname']])
-    #print('\n')
-    
-    #disabled to test checks -- jk enabled to test submit data
-    
-    # print("fix case")
-    # fix for lookup list values too, match to the lookup list value if case insensitivity is the only issue
-    # all_dfs = fix_case(all_dfs)                
-    
+        changed = count_changed(df['units'], units)
+        df['units'] = units
+    print('hardcorde fixes - done')
+    return changed
 
-    # all_dfs = hardcoded_fixes(all_dfs)
 
-    print('done')
-    return all_dfs
+# columns that hold station ids - stationid, and the like (test_stationid etc)
+def station_columns(df):
+    return [c for c in df.columns if str(c).endswith('stationid')]
 
 
 def rename_test_stations(all_dfs, login_email):
     print("renaming test stations")
-    
-    # Make the test_station_renaming_key (https://chat.openai.com/share/3f615ac3-2dd3-4dba-9456-3ff8f5530628)
-    df = pd.read_sql("SELECT stationid, test_stationid FROM lu_teststation", g.eng)
-    test_station_renaming_key = pd.Series(df.test_stationid.values,index=df.stationid).to_dict()
+    changed = 0
+
+    if (login_email is not None) and (login_email == current_app.config.get('TESTING_EMAIL_ADDRESS')):
+        # Make the test_station_renaming_key (https://chat.openai.com/share/3f615ac3-2dd3-4dba-9456-3ff8f5530628)
+        key = pd.read_sql("SELECT stationid, test_stationid FROM lu_teststation", g.eng)
+        test_station_renaming_key = pd.Series(key.test_stationid.values, index = key.stationid).to_dict()
 
-    if login_email == current_app.config.get('TESTING_EMAIL_ADDRESS'):
+        # This used to be a df.replace across every column of every table, but the station ids only ever need to be swapped out in the station id columns
         for dfname, df in all_dfs.items():
-            all_dfs[dfname] = df.replace(test_station_renaming_key)
+            for col in station_columns(df):
+                renamed = df[col].where(~df[col].isin(test_station_renaming_key.keys()), df[col].map(test_station_renaming_key))
+                changed += count_changed(df[col], renamed)
+                df[col] = renamed
 
-    
     print('done')
+    return changed
+
+
+# Normalization stage
+# The rules that clean up the values before anything gets checked. They all run in order, each one in its own timing span,
+# and each one changes the dataframes in all_dfs in place and gives back how many values it changed
+# The timings and counts show up in timings.json (and the admin /timings route) as normalize - <rule>
+# Each rule gets the context of the submission: login_email, dataset, and warnings (a list for the rules to report what they changed)
+NORMALIZATION_RULES = [
+    ("strip_whitespace", lambda all_dfs, context: strip_whitespace(all_dfs)),
 
+    # fix for lookup list values too, match to the lookup list value if case insensitivity is the only issue
+    # only for the datasets that have it turned on in the config
+    (
+        "fix_case", 
+        lambda all_dfs, context: 
+            fix_case(all_dfs, context.get('warnings')) 
+            if str(current_app.datasets.get(context.get('dataset'), dict()).get('fix_case')) == 'True' 
+            else 0
+    ),
+
+    ("hardcoded_fixes", lambda all_dfs, context: hardcoded_fixes(all_dfs)),
+
+    # if login_email is the testing email address then it will rename the stations
+    ("rename_test_stations", lambda all_dfs, context: rename_test_stations(all_dfs, context.get('login_email')))
+]
+
+def clean_data(all_dfs, login_email = None, dataset = None, warnings = None):
+    print("preprocessing")
+    context = {"login_email": login_email, "dataset": dataset, "warnings": warnings}
+    report = []
+    for name, rule in NORMALIZATION_RULES:
+        with span(f"normalize - {name}", rows = sum(len(df) for df in all_dfs.values())) as record:
+            record['changed'] = rule(all_dfs, context)
+        report.append(f"{name}: {record['changed']} values changed")
+
+    print('\n'.join(report))
+    print('done')
     return all_dfs
 
 
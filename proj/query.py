@@ -2,12 +2,13 @@ import json, time, os
 import pandas as pd
 from io import BytesIO
 from flask import request, jsonify, Blueprint, current_app, send_from_directory, url_for, session, render_template, g, make_response, send_file
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 from zipfile import ZipFile
 from functools import wraps
 from datetime import datetime
 
 from .utils.excel import format_existing_excel
+from .utils.db import get_engine, pool_options
 
 
 def support_jsonp(f):
@@ -42,8 +43,9 @@ def send_log(path):
 def unifiedquery():
     # function to build query from url string and return result as an excel file or zip file if requesting all data
     print("start export")
-    admin_engine = create_engine(os.environ.get("UNIFIED_BIGHT_DB_ADMIN_CONNECTION_STRING"))
-    query_engine = create_engine(os.environ.get("UNIFIED_BIGHT_DB_READONLY_CONNECTION_STRING"))
+    # pooled engines, which live for the life of the process (see get_engine in utils/db.py)
+    admin_engine = get_engine(os.environ.get("UNIFIED_BIGHT_DB_ADMIN_CONNECTION_STRING"), **pool_options(current_app.config))
+    query_engine = get_engine(os.environ.get("UNIFIED_BIGHT_DB_READONLY_CONNECTION_STRING"), **pool_options(current_app.config))
 
     # initialize this variable
     action = None
@@ -183,8 +185,6 @@ def unifiedquery():
                     return response
 
     export_link = outlink
-    admin_engine.dispose()
-    query_engine.dispose()
     response = jsonify({'code': 200, 'link': export_link})
     return response
 
@@ -82,12 +82,19 @@
             method: 'post',
             body: formData
         });
-        document.getElementById("loader-gif-container").classList.add("hidden");
-        document.querySelector(".after-submit").classList.remove("hidden");
         console.log(response);
-        const result = await response.json();
+        let result = await response.json();
         console.log(result);
 
+        // The checks run as a job on the server, so we poll the status route until it is done
+        if (Object.keys(result).includes("jobid")) {
+            result = await pollCheckJob(result.jobid);
+            console.log(result);
+        }
+
+        document.getElementById("loader-gif-container").classList.add("hidden");
+        document.querySelector(".after-submit").classList.remove("hidden");
+
         // handling the case where there was a critical error
         if (result.critical_error) {
             // critical_error_handler defined in globals.js
@@ -98,15 +105,15 @@
         }
 
         //show the final submit buttin
-        if (Object.keys(result).includes("errs")) {
+        if (Object.keys(result).includes("error_summary")) {
             console.log("result['final_submit_requested']");
             console.log(result['final_submit_requested']);
-            if (result['errs'].length == 0){
+            if (result.error_summary.errors.total == 0){
                 if (result['final_submit_requested'] === true) {
                     document.querySelector("#final-submit-button-container").classList.remove("hidden");
                     addFinalSubmitListener()
                 }
-                if (result.warnings?.length > 0) {
+                if (result.error_summary.warnings.total > 0) {
                     // Cover the case where there are no errors but there are warnings
                     // Giving the user a final warning/final chance to check their warnings
                     document.getElementById('final-warning-container').classList.remove('hidden');
@@ -133,7 +140,7 @@
                 document.getElementById('final-warning-container').classList.add('hidden');
             }
         }
-        if (Object.keys(result).includes("warnings") && (result['warnings'].length > 0) ) {
+        if (Object.keys(result).includes("error_summary") && (result.error_summary.warnings.total > 0) ) {
             document.getElementById('warnings-report-header').classList.add('warning-alert');
             document.getElementById('warnings-report-header').innerText = `⚠️ Warnings`;
             document.getElementById('warnings-report-header').addEventListener('click', function(e) {
@@ -156,6 +163,26 @@
 
     })
 
+    // Polls the status of the check job, showing the stage it is at under the loader gif, and returns the result once the job is finished
+    async function pollCheckJob(jobid) {
+        const loaderHeader = document.querySelector(".loader-gif-card-header");
+        while (true) {
+            const response = await fetch(`/${script_root}/upload/status/${jobid}`);
+            const job = await response.json();
+
+            if (Object.keys(job).includes("user_error_msg") || job.critical_error) {
+                return job;
+            }
+            if (job.status === 'done' || job.status === 'failed') {
+                loaderHeader.innerText = "Please wait";
+                return job.result;
+            }
+            
+            loaderHeader.innerText = job.stage ? `Please wait - ${job.stage} (${Math.round(job.elapsed)}s)` : "Please wait";
+            await new Promise(resolve => setTimeout(resolve, 2000));
+        }
+    }
+
     if (document.getElementById('clear-session-button')){
         document.getElementById('clear-session-button').addEventListener('click', async function(){
             const response = await fetch(`/${script_root}/`, {
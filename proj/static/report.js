@@ -42,249 +42,195 @@ const buildReport = (res) => {
     // Let them download their marked excel file
     document.getElementById("excel-markup-download").classList.remove('hidden')
     document.getElementById("excel-markup-download").setAttribute("href",`/${script_root}/download/${res.submissionid}/${res.marked_filename}`) ;
-    
-    // Error report summary table for the front page
-    if (res.errs) {
-        const totalErrorsCount = res.errs.length;
-        const coreErrorsCount = res.errs.filter(err => {return err.is_core_error}).length;
-        const customErrorsCount = res.errs.filter(err => {return !err.is_core_error}).length;
-        const warningsCount = res.warnings ? res.warnings.length : 0;
-        document.getElementById('total-errors-count').innerText = totalErrorsCount;
-        document.getElementById('core-errors-count').innerText = coreErrorsCount;
-        document.getElementById('custom-errors-count').innerText = customErrorsCount;
-        document.getElementById('total-warnings-count').innerText = warningsCount;
-    }
 
-    // errors
-    const errs_tables_headers = [...new Set(res.errs.map(e => res.table_to_tab_map[e.table]))]
-    const errs_tables = [...new Set(res.errs.map(e => e.table))]
-    
-    // Create the tab headers, as many as there are unique tables in the error report
-    document.getElementById("errors-report-tab-headers").innerHTML = `<div class="errors-tab-header tab-header col-sm"></div>`.repeat(errs_tables.length);
-    
-    // put the appropriate ID's and inner text on each div ("table") containing the error tab headers
-    let errorsHeaders = document.querySelectorAll("#errors-report-tab-headers .errors-tab-header");
-    for (let i = 0; i < errorsHeaders.length; i++) {
-        errorsHeaders[i].setAttribute('id',`${errs_tables[i]}-errors-tab-header`);
-        errorsHeaders[i].innerText = errs_tables_headers[i];
+    // The marked file is made in the background after the checks finish, so wait for the marking job before downloading it
+    document.getElementById("excel-markup-download").onclick = async function(e) {
+        if (!res.marking_jobid) return;
+        e.preventDefault();
+
+        const linkText = this.innerText;
+        this.innerText = "Preparing the marked Excel file...";
+        while (true) {
+            const response = await fetch(`/${script_root}/upload/status/${res.marking_jobid}`);
+            const job = await response.json();
+            if (Object.keys(job).includes("user_error_msg") || job.status === 'done' || job.status === 'failed') {
+                break;
+            }
+            await new Promise(resolve => setTimeout(resolve, 2000));
+        }
+        this.innerText = linkText;
+        window.location = this.getAttribute("href");
     }
     
-    // repeat the error tab bodies as much as there are tables with errors
-    // document.getElementById("errors-report-body-inner-tab-container").innerHTML = document.getElementById("errors-report-body-inner-tab-container")
-    //     .innerHTML
-    //     .repeat(errs_tables.length > 0 ? errs_tables.length : 1) ;
-    document.getElementById("errors-report-body-inner-tab-container").innerHTML = `
-        <!--This div needs to be repeated, one per table-->
-        <div class="errors-tab-body">
-        <!--id would be tablename-errors-tab-body-->
-
-            <div class="row errors-report-header">
-                <div class="col-sm errors-report-cell">Column(s)</div>
-                <!--<div class="col-sm errors-report-cell">Error Type</div>-->
-                <div class="col-sm errors-report-cell">Error Message</div>
-                <div class="col-sm errors-report-cell">Row(s)</div>
-                <div class="col-sm errors-report-cell"></div>
-            </div>
-
-            <div class="errors-tab-rows">
-            </div>
-
-        </div>`
-        .repeat(errs_tables.length) ;
-
+    // Error report summary table for the front page
+    // The upload result only has the counts, the errors themselves come from the /errors routes (see the error report section of main.py)
+    const summary = res.error_summary;
+    document.getElementById('total-errors-count').innerText = summary.errors.total;
+    document.getElementById('core-errors-count').innerText = summary.errors.core;
+    document.getElementById('custom-errors-count').innerText = summary.errors.custom;
+    document.getElementById('total-warnings-count').innerText = summary.warnings.total;
 
+    // errors and warnings are displayed the same way, just in different containers
+    buildIssueReport('errors', 'error', summary.errors, res.table_to_tab_map);
+    buildIssueReport('warnings', 'warning', summary.warnings, res.table_to_tab_map);
 
-    // put the appropriate ID's on each div ("table")containing the error messages
-    let errorsTabBodies = document.querySelectorAll("#errors-report-body-inner-tab-container .errors-tab-body");
-    for (let i = 0; i < errorsTabBodies.length; i++) {
-        errorsTabBodies[i].setAttribute('id', `${errs_tables[i]}-errors-tab-body`);
-    }
-    
-    // Now append the rows with the error information
-    errs_tables.map(tblname => {
-        let tbl = document.querySelector(`#${tblname}-errors-tab-body div.errors-tab-rows`);
-        
-        tbl.innerHTML = res.errs.map((e, i) => {
-            if (e.table === tblname) {
-                let s = `
-                    <div class="error-description-list row">
-                        <div class="errors-report-cell error-description-list-item col-sm">
-                            ${e.columns.replaceAll(",","<br>")}
-                        </div>
-                        <!--<div class="errors-report-cell error-description-list-item col-sm">
-                            ${e.error_type}
-                        </div>-->
-                        <div class="errors-report-cell error-description-list-item col-sm">
-                            ${e.error_message}
-                        </div>
-                        <div class="errors-report-cell error-description-list-item col-sm">
-                            <span id="error-row-numbers-${i}"> ${e.rows.sort((a, b) => a - b).join(", ") }</span>
-                        </div>
-                        <div class="errors-report-cell error-description-list-item col-sm">
-                            <button class="btn btn-secondary hide-row-numbers-btn" data-role="hide" data-error-type="error" data-iteration-number="${i}">
-                                Hide row numbers
-                            </button>
-                        </div>
-                    </div>
-                `;
-                return s
-            } else {
-                return ''
-            }
-        }).join("")
-    })
-
-    // set up the tabbing system
-    let tabIDs = new Object();
-    errorsHeaders = document.querySelectorAll("#errors-report-tab-headers .errors-tab-header");
-    errorsTabBodies = document.querySelectorAll("#errors-report-body-inner-tab-container .errors-tab-body");
-    for (let i = 0; i < errorsHeaders.length; i++) {
-        tabIDs[errorsHeaders[i].getAttribute('id')] = errorsTabBodies[i].getAttribute('id')
+    // display the map if applicable
+    if (document.getElementById("submission-type").innerText && ((summary.errors.total > 0) | (summary.warnings.total > 0))){
+        document.getElementById("map-report-header")?.classList.remove("hidden")
+        document.getElementById('visual-map').setAttribute('src',`/${script_root}/map`)
     }
-    tabs(
-        tabClass = 'errors-tab', 
-        tabIDs = tabIDs
-    )
 
+}
 
 
-    /* 
-    I am fully aware that this is a disgusting violation of the DRY (Don't Repeat Yourself) Principle
-    But its been 3 weeks of getting this thing done, we are almost there, it needs to get done ASAP, there's only one place where that above errors display routine
-    will be repeated, so i think its ok.
-    
-    If we have time in the future we can think of a way to generalize it, but there's not so much of a need to do so in this particular case
-    */
-
-
-    // warnings
-    const warnings_tables_headers = [...new Set(res.warnings.map(e => res.table_to_tab_map[e.table]))]
-    const warnings_tables = [...new Set(res.warnings.map(e => e.table))]
+// kind is errors or warnings, singular is error or warning (some of the ids and classes use the singular)
+const buildIssueReport = (kind, singular, kindSummary, tableToTabMap) => {
+    const tables = Object.keys(kindSummary.tables);
+    const tableHeaders = tables.map(t => tableToTabMap[t]);
 
-    // Create the tab headers, as many as there are unique tables in the error report
-    //document.getElementById("warnings-report-tab-headers").innerHTML = document.getElementById("warnings-report-tab-headers").innerHTML.repeat(warnings_tables.length);
-    document.getElementById("warnings-report-tab-headers").innerHTML = `<div class="warnings-tab-header tab-header col-sm"></div>`.repeat(warnings_tables.length);
+    // Create the tab headers, as many as there are unique tables in the report
+    document.getElementById(`${kind}-report-tab-headers`).innerHTML = `<div class="${kind}-tab-header tab-header col-sm"></div>`.repeat(tables.length);
 
-    // put the appropriate ID's and inner text on each div ("table") containing the error tab headers
-    let warningsHeaders = document.querySelectorAll("#warnings-report-tab-headers .warnings-tab-header");
-    for (let i = 0; i < warningsHeaders.length; i++) {
-        warningsHeaders[i].setAttribute('id',`${warnings_tables[i]}-warnings-tab-header`);
-        warningsHeaders[i].innerText = warnings_tables_headers[i];
+    // put the appropriate ID's and inner text on each div ("table") containing the tab headers
+    let headers = document.querySelectorAll(`#${kind}-report-tab-headers .${kind}-tab-header`);
+    for (let i = 0; i < headers.length; i++) {
+        headers[i].setAttribute('id',`${tables[i]}-${kind}-tab-header`);
+        headers[i].innerText = tableHeaders[i];
     }
 
-    // repeat the error tab bodies as much as there are tables with warnings
-    document.getElementById("warnings-report-body-inner-tab-container").innerHTML = `
+    // repeat the tab bodies as much as there are tables with errors/warnings
+    document.getElementById(`${kind}-report-body-inner-tab-container`).innerHTML = `
         <!--This div needs to be repeated, one per table-->
-        <div class="warnings-tab-body">
-            <!--id would be tablename-warnings-tab-body-->
-
-            <div class="row warnings-report-header">
-                <div class="col-sm warnings-report-cell">Column(s)</div>
-                <!--<div class="col-sm warnings-report-cell">Error Type</div>-->
-                <div class="col-sm warnings-report-cell">Error Message</div>
-                <div class="col-sm warnings-report-cell">Row(s)</div>
-                <div class="col-sm warnings-report-cell"></div>
+        <div class="${kind}-tab-body">
+            <!--id would be tablename-${kind}-tab-body-->
+
+            <div class="row ${kind}-report-header">
+                <div class="col-sm ${kind}-report-cell">Column(s)</div>
+                <!--<div class="col-sm ${kind}-report-cell">Error Type</div>-->
+                <div class="col-sm ${kind}-report-cell">Error Message</div>
+                <div class="col-sm ${kind}-report-cell">Row(s)</div>
+                <div class="col-sm ${kind}-report-cell"></div>
             </div>
 
-            <div class="warnings-tab-rows">
+            <div class="${kind}-tab-rows">
             </div>
 
-        </div>`
-        .repeat(warnings_tables.length);
+            <button class="btn btn-secondary load-more-btn hidden">Load more</button>
 
+        </div>`
+        .repeat(tables.length);
 
-    // put the appropriate ID's on each div ("table")containing the error messages
-    let warningsTabBodies = document.querySelectorAll("#warnings-report-body-inner-tab-container .warnings-tab-body");
-    for (let i = 0; i < warningsTabBodies.length; i++) {
-        warningsTabBodies[i].setAttribute('id', `${warnings_tables[i]}-warnings-tab-body`);
+    // put the appropriate ID's on each div ("table") containing the messages
+    let tabBodies = document.querySelectorAll(`#${kind}-report-body-inner-tab-container .${kind}-tab-body`);
+    for (let i = 0; i < tabBodies.length; i++) {
+        tabBodies[i].setAttribute('id', `${tables[i]}-${kind}-tab-body`);
     }
 
-    // Now append the rows with the error information
-    warnings_tables.map(tblname => {
-        console.log(tblname);
-        let tbl = document.querySelector(`#${tblname}-warnings-tab-body div.warnings-tab-rows`);
-        tbl.innerHTML = res.warnings.map((e, i) => {
-            if (e.table === tblname) {
-                let s = `
-                    <div class="error-description-list row">
-                        <div class="warnings-report-cell error-description-list-item col-sm">
-                            ${e.columns.replaceAll(",","<br>")}
-                        </div>
-                        <!--<div class="warnings-report-cell error-description-list-item col-sm">
-                            ${e.error_type}
-                        </div>-->
-                        <div class="warnings-report-cell error-description-list-item col-sm">
-                            ${e.error_message}
-                        </div>
-                        <div class="warnings-report-cell error-description-list-item col-sm">
-                            <span id="warning-row-numbers-${i}"> ${e.rows.sort((a, b) => a - b).join(", ") }</span>
-                        </div>
-                        <div class="warnings-report-cell error-description-list-item col-sm">
-                            <button class="btn btn-secondary hide-row-numbers-btn" data-role="hide" data-error-type="warning" data-iteration-number="${i}">
-                                Hide row numbers
-                            </button>
-                        </div>
-                    </div>
-                `;
-                return s
-            } else {
-                return ''
-            }
-        }).join("")
+    // Now append the rows with the error information, the first page for each table
+    tables.forEach(tblname => {
+        const tabBody = document.getElementById(`${tblname}-${kind}-tab-body`);
+        const loadMoreButton = tabBody.querySelector('.load-more-btn');
+        let page = 0;
+        const loadPage = async () => {
+            page += 1;
+            const response = await fetch(`/${script_root}/errors/${kind}?table=${encodeURIComponent(tblname)}&page=${page}&per_page=100`);
+            const result = await response.json();
+            tabBody.querySelector(`div.${kind}-tab-rows`).insertAdjacentHTML(
+                'beforeend',
+                result.errors.map(e => issueRowHTML(kind, singular, e)).join("")
+            );
+            result.errors.forEach(e => addRowNumbersListener(kind, singular, e.id));
+            loadMoreButton.classList.toggle('hidden', page * result.per_page >= result.total);
+        }
+        loadMoreButton.addEventListener('click', loadPage);
+        loadPage();
     })
 
     // set up the tabbing system
-    tabIDs = new Object();
-    warningsHeaders = document.querySelectorAll("#warnings-report-tab-headers .warnings-tab-header");
-    warningsTabBodies = document.querySelectorAll("#warnings-report-body-inner-tab-container .warnings-tab-body");
-    for (let i = 0; i < warningsHeaders.length; i++) {
-        tabIDs[warningsHeaders[i].getAttribute('id')] = warningsTabBodies[i].getAttribute('id')
+    let tabIDs = new Object();
+    headers = document.querySelectorAll(`#${kind}-report-tab-headers .${kind}-tab-header`);
+    tabBodies = document.querySelectorAll(`#${kind}-report-body-inner-tab-container .${kind}-tab-body`);
+    for (let i = 0; i < headers.length; i++) {
+        tabIDs[headers[i].getAttribute('id')] = tabBodies[i].getAttribute('id')
     }
     tabs(
-        tabClass = 'warnings-tab', 
+        tabClass = `${kind}-tab`, 
         tabIDs = tabIDs
     )
+}
 
-    // display the map if applicable
-    if (document.getElementById("submission-type").innerText && ((res.errs.length > 0) | (res.warnings.length > 0))){
-        document.getElementById("map-report-header")?.classList.remove("hidden")
-        document.getElementById('visual-map').setAttribute('src',`/${script_root}/map`)
-    }
-
-    Array.from(document.getElementsByClassName('hide-row-numbers-btn')).forEach(
-        (btn) => {
-            console.log("btn");
-            console.log(btn);
-            btn.addEventListener('click', () => {
-                const role = btn.dataset.role;
-                const errtype = btn.dataset.errorType;
-                const iterationNumber = btn.dataset.iterationNumber;
-                console.assert(
-                    ['hide','show'].includes(role),
-                    "in the hide row numbers button, the data attribute called function should be set to hide or show"
-                )
-                const rowNumberContainer = document.getElementById(`${errtype}-row-numbers-${iterationNumber}`);
-                
-                if (role === 'hide') {
-                    rowNumberContainer.classList.add('hidden')
-                    
-                    // set the button up so the next click shows them
-                    btn.setAttribute('data-role','show');
-                    btn.innerText = 'Show row numbers';
-                } else {
-                    rowNumberContainer.classList.remove('hidden')
 
-                    // set the button up so the next click hides them
-                    btn.setAttribute('data-role','hide')
-                    btn.innerText = 'Hide row numbers';
-                }
-            
-            })
-        }
-    )
+const issueRowHTML = (kind, singular, e) => {
+    return `
+        <div class="error-description-list row">
+            <div class="${kind}-report-cell error-description-list-item col-sm">
+                ${e.columns.replaceAll(",","<br>")}
+            </div>
+            <!--<div class="${kind}-report-cell error-description-list-item col-sm">
+                ${e.error_type}
+            </div>-->
+            <div class="${kind}-report-cell error-description-list-item col-sm">
+                ${e.error_message}
+            </div>
+            <div class="${kind}-report-cell error-description-list-item col-sm">
+                ${e.row_count} row(s)
+                <div id="${singular}-row-numbers-${e.id}" class="hidden">
+                    <span class="row-numbers"></span>
+                    <a href="#" class="more-row-numbers hidden">... more</a>
+                </div>
+            </div>
+            <div class="${kind}-report-cell error-description-list-item col-sm">
+                <button class="btn btn-secondary hide-row-numbers-btn" id="${singular}-row-numbers-btn-${e.id}" data-role="show">
+                    Show row numbers
+                </button>
+            </div>
+        </div>
+    `;
+}
 
-    
-    
 
+// The row numbers are fetched a page at a time, the first time they are shown, and then when the "more" link is clicked
+const loadRowNumbers = async (kind, errorid, container) => {
+    const page = Number(container.dataset.pagesLoaded || 0) + 1;
+    const response = await fetch(`/${script_root}/errors/${kind}/${errorid}/rows?page=${page}&per_page=1000`);
+    const result = await response.json();
+    container.dataset.pagesLoaded = page;
+    container.querySelector('.row-numbers').innerText += (page > 1 ? ", " : "") + result.rows.join(", ");
+    container.querySelector('.more-row-numbers').classList.toggle('hidden', page * result.per_page >= result.total);
 }
 
+
+const addRowNumbersListener = (kind, singular, errorid) => {
+    const btn = document.getElementById(`${singular}-row-numbers-btn-${errorid}`);
+    const rowNumberContainer = document.getElementById(`${singular}-row-numbers-${errorid}`);
+
+    rowNumberContainer.querySelector('.more-row-numbers').addEventListener('click', (e) => {
+        e.preventDefault();
+        loadRowNumbers(kind, errorid, rowNumberContainer);
+    })
+
+    btn.addEventListener('click', async () => {
+        const role = btn.dataset.role;
+        console.assert(
+            ['hide','show'].includes(role),
+            "in the hide row numbers button, the data attribute called function should be set to hide or show"
+        )
+        
+        if (role === 'hide') {
+            rowNumberContainer.classList.add('hidden')
+            
+            // set the button up so the next click shows them
+            btn.setAttribute('data-role','show');
+            btn.innerText = 'Show row numbers';
+        } else {
+            if (!rowNumberContainer.dataset.pagesLoaded) {
+                await loadRowNumbers(kind, errorid, rowNumberContainer);
+            }
+            rowNumberContainer.classList.remove('hidden')
+
+            // set the button up so the next click hides them
+            btn.setAttribute('data-role','hide')
+            btn.innerText = 'Hide row numbers';
+        }
+    })
+}
@@ -1,5 +1,100 @@
-import re
+import re, os, time, csv
+from io import StringIO
+from threading import Lock
 from pandas import read_sql, Timestamp, isnull, DataFrame
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+from .schema import get_catalog
+
+
+# Engine registry
+# We used to create a new engine in before_request and dispose of it in teardown_request,
+#   so every request paid for a brand new connection to the database (and query.py made two more every time)
+# Now there is one pooled engine per connection string per process, which lives as long as the process does
+# uwsgi imports the app and then forks the workers. A pool must never be shared across the fork,
+#   so the registry is keyed by process id, and it gets emptied in the child right after a fork
+
+class TimedQueuePool(QueuePool):
+    '''QueuePool that keeps track of how long it takes to get a connection out of the pool'''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+
+_engines = dict()
+_engines_lock = Lock()
+
+
+def _reset_engines_after_fork():
+    # The engines we inherited from the parent process belong to the parent
+    # close = False leaves the parent's connections alone, we just stop using them
+    for eng in _engines.values():
+        eng.dispose(close = False)
+    _engines.clear()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child = _reset_engines_after_fork)
+
+
+def pool_options(config):
+    '''the pool settings from the app configuration'''
+    return {
+        "pool_size"    : int(config.get('DB_POOL_SIZE', 5)),
+        "max_overflow" : int(config.get('DB_POOL_MAX_OVERFLOW', 10)),
+        "pool_recycle" : int(config.get('DB_POOL_RECYCLE', 1800)),
+        "pool_timeout" : int(config.get('DB_POOL_TIMEOUT', 30))
+    }
+
+
+def get_engine(constring, **options):
+    '''
+    Returns the engine for the connection string, creating it the first time it is asked for in this process
+    options are the pool settings (see pool_options) and only apply when the engine gets created
+    '''
+    assert constring is not None, "Database connection string not found in the environment"
+    key = (os.getpid(), constring)
+    eng = _engines.get(key)
+    if eng is None:
+        with _engines_lock:
+            eng = _engines.get(key)
+            if eng is None:
+                eng = create_engine(constring, poolclass = TimedQueuePool, pool_pre_ping = True, **options)
+                _engines[key] = eng
+    return eng
+
+
+def engine_stats():
+    '''pool statistics of the engines of this process'''
+    stats = []
+    for (pid, constring), eng in list(_engines.items()):
+        pool = eng.pool
+        stats.append({
+            "pid"             : pid,
+            "database"        : repr(eng.url), # repr hides the password
+            "pool_size"       : pool.size(),
+            "checked_out"     : pool.checkedout(),
+            "checked_in"      : pool.checkedin(),
+            "overflow"        : pool.overflow(),
+            "checkouts"       : getattr(pool, 'checkouts', None),
+            "wait_total"      : round(getattr(pool, 'wait_total', 0), 4),
+            "wait_mean"       : round(pool.wait_total / pool.checkouts, 4) if getattr(pool, 'checkouts', 0) else None,
+            "wait_max"        : round(getattr(pool, 'wait_max', 0), 4),
+            "status"          : pool.status()
+        })
+    return stats
 
 
 def check_dtype(t, x):
@@ -9,6 +104,9 @@ def check_dtype(t, x):
     except Exception as e:
         return False
 
+# rows per COPY
+COPY_CHUNKSIZE = 50000
+
 class GeoDBDataFrame(DataFrame):
     def __init__(self, *args, **kwargs):
         super(GeoDBDataFrame, self).__init__(*args, **kwargs)
@@ -17,7 +115,22 @@ class GeoDBDataFrame(DataFrame):
     def _constructor(self):
         return(GeoDBDataFrame)
 
-    def to_geodb(self, tablename, eng):
+    # to_geodb used to build one INSERT statement with every value of the dataframe written into it
+    #   For a 300k row chemistry submission that string was hundreds of MB, and postgres had to parse all of it in one go
+    # Now the rows get streamed to a temporary staging table with COPY, a chunk at a time,
+    #   and then one INSERT ... SELECT moves them into the table
+    # Same rules for the values as the INSERT statement had - blank or missing is NULL, anything else is the string of the value, stripped
+    #   and postgres converts the strings to the column types the same way it did for the quoted values in the INSERT
+    # Columns where the value is an sde function (objectid and globalid, see load.py) get called in the INSERT ... SELECT, once for each row
+    #
+    # eng can be the engine, or a connection that is already in a transaction (then the caller decides when it gets committed)
+    # progress(rows_copied, total_rows) gets called after each chunk if it is given
+    # Returns the number of rows inserted
+    def to_geodb(self, tablename, eng, chunksize = COPY_CHUNKSIZE, progress = None):
+        if isinstance(eng, Engine):
+            with eng.begin() as conn:
+                return self.to_geodb(tablename, conn, chunksize = chunksize, progress = progress)
+
         tbl_cols = read_sql(f"SELECT * FROM information_schema.columns WHERE table_name = '{tablename}';", eng) \
             .column_name \
             .tolist()
@@ -26,54 +139,83 @@ class GeoDBDataFrame(DataFrame):
         # Thus we will make these assert statements for faster troubleshooting and debugging.
         assert set(self.columns) - set(tbl_cols) == set(), \
             f"Dataframe has columns not found in table {tablename}: {','.join(set(self.columns) - set(tbl_cols))}"
-        
-
-        if not self.empty:
-            # this used to have ON CONFLICT ON CONSTRAINT (prinary key) DO NOTHING
-            # but that was in the bmpsync routine. I'm not sure if we want to include that here.
-
-            # TODO assert that the columns match up between the dataframe and table
-
-            finalsql = """
-                INSERT INTO {} \n({}) \nVALUES {}
-                """ \
-                .format(
-                    tablename, 
-                    ', '.join(set(self.columns).intersection(set(tbl_cols))),
-                    ',\n'.join(
-                        "({})" \
-                        .format(
-                            ', '.join(
-                                [
-                                    'NULL'
-                                    if ( (str(val).strip() == '') or (isnull(val)) )
-                                    
-                                    # checks if the string literal is numeric or not
-                                    # If it is, we do not want to wrap it in single quotes
-                                    # If its an arc function, we also dont want to wrap it in quotes in that case
-                                    else str(val).strip()
-                                    #if ( (check_dtype(float, val)) or (check_dtype(int, val)) or ("sde.next_" in str(val)) )
-                                    if ( ("sde.next_" in str(val)) )
-
-                                    # If all else fails its basically either a character or a time
-                                    # in which case we wrap in single quotes
-                                    # single quotes within a string are escaped by doubling them
-                                    # not by using a backslash
-                                    else "'{}'".format(str(val).strip().replace("'","''"))  
-                                    for val in x
-                                ]
-                            )
-                        )
-                        for x in 
-                        list(zip(*[self[c] for c in set(self.columns).intersection(set(tbl_cols))]))
-                    ),
-                    tablename
-                ) \
-                .replace("%","%%")
-
-            eng.execute(finalsql)
-        else:
+
+        if self.empty:
             print("Nothing to load.")
+            return 0
+
+        # this used to have ON CONFLICT ON CONSTRAINT (prinary key) DO NOTHING
+        # but that was in the bmpsync routine. I'm not sure if we want to include that here.
+        cols = [c for c in self.columns if c in tbl_cols]
+        functions = {c: sde_function(self[c]) for c in cols}
+        functions = {c: f for c, f in functions.items() if f is not None}
+        datacols = [c for c in cols if c not in functions]
+        assert len(datacols) > 0, f"Nothing but sde function columns to load to {tablename}"
+
+        stage = f"stage_{tablename}"
+        collist = ', '.join(f'"{c}"' for c in datacols)
+
+        cursor = eng.connection.cursor()
+        try:
+            # staging table with the same column types as the table, minus the constraints and defaults
+            # stage_row keeps the rows in order, so the objectids go in the same order as the rows of the excel file
+            cursor.execute(f'CREATE TEMP TABLE "{stage}" ON COMMIT DROP AS SELECT {collist} FROM "{tablename}" WITH NO DATA;')
+            cursor.execute(f'ALTER TABLE "{stage}" ADD COLUMN stage_row BIGSERIAL;')
+
+            # FORCE_NULL so an empty quoted value is NULL too (csv writes a row with one empty value as "")
+            copysql = f'COPY "{stage}" ({collist}) FROM STDIN WITH (FORMAT csv, FORCE_NULL ({collist}))'
+            total = len(self)
+            for start in range(0, total, chunksize):
+                cursor.copy_expert(copysql, copy_csv(self.iloc[start:start + chunksize], datacols))
+
+                copied = min(start + chunksize, total)
+                print(f"{tablename} - copied {copied} of {total} rows")
+                if progress is not None:
+                    progress(copied, total)
+
+            cursor.execute(
+                f"""
+                INSERT INTO "{tablename}" ({', '.join([collist, *[f'"{c}"' for c in functions.keys()]])})
+                SELECT {', '.join([collist, *functions.values()])} FROM "{stage}" ORDER BY stage_row;
+                """
+            )
+            inserted = cursor.rowcount
+            cursor.execute(f'DROP TABLE "{stage}";')
+        finally:
+            cursor.close()
+
+        return inserted
+
+
+def copy_csv(chunk, columns):
+    '''the rows of the chunk as csv for COPY, in a buffer that is ready to be read'''
+    buffer = StringIO()
+    # every value gets quoted (FORCE_NULL still makes "" a NULL). Left unquoted, a carriage return in a value
+    #   (the csv writer only quotes for \n) made COPY fail, and a value that is just \. on a line of its own would end the data
+    csv.writer(buffer, lineterminator = '\n', quoting = csv.QUOTE_ALL).writerows(
+        zip(*[[copy_value(val) for val in chunk[c].tolist()] for c in columns])
+    )
+    buffer.seek(0)
+    return buffer
+
+
+def copy_value(val):
+    if isnull(val):
+        return None
+    val = str(val).strip()
+    return val if val != '' else None
+
+
+def sde_function(series):
+    '''
+    If the values of the column are an sde function call (like "sde.next_globalid()") gives back that function call, otherwise None
+    Those went in the INSERT statement without quotes, so they are called for each row
+    '''
+    first = series.iloc[0]
+    if not (isinstance(first, str) and ("sde.next_" in first)):
+        return None
+    assert (series == first).all(), f"Column {series.name} has an sde function in some rows but not all of them"
+    return first.strip()
 
 
 
@@ -103,23 +245,7 @@ def primary_key(table, eng):
     eng is the database connection
     '''
 
-    sql = f'''
-        SELECT
-            tc.TABLE_NAME,
-            C.COLUMN_NAME,
-            C.data_type 
-        FROM
-            information_schema.table_constraints tc
-            JOIN information_schema.constraint_column_usage AS ccu USING ( CONSTRAINT_SCHEMA, CONSTRAINT_NAME )
-            JOIN information_schema.COLUMNS AS C ON C.table_schema = tc.CONSTRAINT_SCHEMA 
-            AND tc.TABLE_NAME = C.TABLE_NAME 
-            AND ccu.COLUMN_NAME = C.COLUMN_NAME 
-        WHERE
-            constraint_type = 'PRIMARY KEY' 
-            AND tc.TABLE_NAME = '{table}';
-    '''
-
-    return read_sql(sql, eng).column_name.tolist()
+    return get_catalog(eng).primary_key(table)
 
 def foreign_keys(table, eng):
     '''
@@ -127,29 +253,12 @@ def foreign_keys(table, eng):
     eng is the database connection
     '''
 
-    sql = f"""
-        SELECT
-        DISTINCT
-            kcu.column_name, 
-            ccu.table_name AS foreign_table_name
-        FROM 
-            information_schema.table_constraints AS tc 
-            JOIN information_schema.key_column_usage AS kcu
-            ON tc.constraint_name = kcu.constraint_name
-            AND tc.table_schema = kcu.table_schema
-            JOIN information_schema.constraint_column_usage AS ccu
-            ON ccu.constraint_name = tc.constraint_name
-            AND ccu.table_schema = tc.table_schema
-        WHERE tc.constraint_type = 'FOREIGN KEY' 
-        AND tc.table_name='{table}'
-        AND ccu.table_name LIKE 'lu_%%';
-    """
-
-    dat = read_sql(sql, eng)
+    dat = get_catalog(eng).foreign_keys(table)[['column_name', 'foreign_table_name']].drop_duplicates()
     return dat.set_index('column_name')['foreign_table_name'].to_dict() if not dat.empty else dict()
 
 
 
+# This one still queries the database directly, since it needs the column comments and the custom column order, which are not in the schema catalog
 # In the part that gets the column comments we might need also :
 #   WHERE table_catalog = {os.environ.get('DB_NAME')}
 def metadata_summary(table, eng):
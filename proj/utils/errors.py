@@ -0,0 +1,120 @@
+import os, json
+import numpy as np
+
+# Error report
+# The checks give back every error with a list of all the row numbers it applies to, and those lists all went back to the browser in the upload result
+#   A systematic error (a wrong unit on 150k rows for example) made for a response of several megabytes that the browser choked on
+# Now the errors and warnings are kept in the submission directory, with the rows stored as ranges of consecutive row numbers
+#   so [[2, 150001]] instead of 150k separate numbers
+# The upload result only has the counts (see error_summary), and the report page gets the errors of each table,
+#   and the row numbers of each error, a page at a time from the /errors routes in main.py
+#
+# NOTE This is a json file like everything else in the submission directory. msgpack and parquet are not installed,
+#   and with the rows as ranges the file is small anyway
+
+ERROR_REPORT_FILENAME = 'error_report.json'
+KINDS = ('errors', 'warnings')
+
+
+def row_ranges(rows):
+    '''sorted list of row numbers -> [[first, last], ...] for each run of consecutive row numbers'''
+    rows = np.unique(np.asarray(rows, dtype = np.int64))
+    if len(rows) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(rows) != 1)
+    starts = np.concatenate((rows[:1], rows[breaks + 1]))
+    ends = np.concatenate((rows[breaks], rows[-1:]))
+    return np.column_stack((starts, ends)).tolist()
+
+
+def rows_page(ranges, start, count):
+    '''the row numbers from position start to start + count, out of all the row numbers covered by the ranges'''
+    if len(ranges) == 0:
+        return []
+    ranges = np.asarray(ranges, dtype = np.int64)
+    # position of the first row of each range, counting through all of them
+    offsets = np.concatenate(([0], np.cumsum(ranges[:, 1] - ranges[:, 0] + 1)))
+
+    rows = []
+    i = int(np.searchsorted(offsets, start, side = 'right')) - 1
+    position = start
+    while (i < len(ranges)) and (len(rows) < count):
+        first = ranges[i, 0] + (position - offsets[i])
+        last = min(ranges[i, 1], first + (count - len(rows)) - 1)
+        rows.extend(range(int(first), int(last) + 1))
+        position = offsets[i + 1]
+        i += 1
+    return rows
+
+
+def compact(errs):
+    records = []
+    for e in errs:
+        # No empty errors
+        if len(e) == 0:
+            continue
+        ranges = row_ranges(e.get('rows'))
+        records.append({
+            **{k: v for k, v in e.items() if k != 'rows'},
+            "id"         : len(records),
+            "row_count"  : sum(last - first + 1 for first, last in ranges),
+            "row_ranges" : ranges
+        })
+    return records
+
+
+def expand(records):
+    '''the other way around from compact, the records of the error report back to errors with a list of rows (for marking the excel file)'''
+    return [
+        {
+            **{k: v for k, v in r.items() if k not in ('id', 'row_count', 'row_ranges')},
+            "rows": rows_page(r.get('row_ranges'), 0, r.get('row_count'))
+        }
+        for r in records
+    ]
+
+
+def save_error_report(errs, warnings, submission_dir):
+    '''
+    errs and warnings should already have their rows corrected to the excel row numbers (correct_row_offset)
+    The id of an error is its position in the list, which is how the rows route finds it
+    '''
+    report = {"errors": compact(errs), "warnings": compact(warnings)}
+    with open(os.path.join(submission_dir, ERROR_REPORT_FILENAME), 'w') as f:
+        json.dump(report, f, default = str)
+    return report
+
+
+def read_error_report(submission_dir):
+    path = os.path.join(submission_dir, ERROR_REPORT_FILENAME)
+    if not os.path.exists(path):
+        return {kind: [] for kind in KINDS}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def error_summary(report):
+    '''
+    What goes back to the browser in the upload result, the counts of the errors and warnings, and the number of rows they flagged
+    per table and per check (error_type)
+    '''
+    summary = dict()
+    for kind in KINDS:
+        records = report.get(kind)
+        tables = dict()
+        checks = dict()
+        for r in records:
+            for key, counts in ((r.get('table'), tables), (r.get('error_type'), checks)):
+                counts.setdefault(key, {"count": 0, "rows": 0})
+                counts[key]["count"] += 1
+                counts[key]["rows"] += r.get('row_count')
+
+        summary[kind] = {
+            "total"  : len(records),
+            "core"   : sum(1 for r in records if r.get('is_core_error')),
+            "custom" : sum(1 for r in records if not r.get('is_core_error')),
+            "rows"   : sum(r.get('row_count') for r in records),
+            "tables" : tables,
+            "checks" : checks
+        }
+    return summary
@@ -1,99 +1,242 @@
-import os, shutil
+import os
 from io import BytesIO
+from datetime import datetime, date
 
+import numpy as np
+import pandas as pd
+import xlsxwriter
 from openpyxl import load_workbook
-from openpyxl.comments import Comment
 from openpyxl.styles import Font, Border, Side, PatternFill
 
 from flask import session
-from math import floor
 
 
-def mark_workbook(all_dfs, excel_path, errs, warnings):
+# Opens the workbook a single time and yields (sheetname, dataframe) for every sheet that the checker cares about
+# pd.read_excel(path, sheet_name = sheet) re-opens the xlsx package on every call, and loads the workbook, the shared strings and the styles again,
+#   so calling it once per sheet made us pay that over and over for workbooks with many tabs
+# pd.ExcelFile keeps the workbook open, and .parse() only reads the one sheet out of it
+# (the sheets themselves take just as long to read either way - see benchmarks/read_workbook.py)
+def read_workbook(excel_path, skiprows = 0, ignored_tabs = [], converters = None, sheets = None, **kwargs):
+    '''
+    excel_path is the path to the excel file (or a file like object)
+    skiprows is the number of rows to skip before the column headers (current_app.excel_offset)
+    ignored_tabs are sheets we should not read in at all. Sheets starting with lu_ are always skipped
+    converters can be a dictionary of converters applied to every sheet, 
+        or a function which takes the sheet name and returns the converters for that sheet
+    sheets, if given, restricts the reader to only those sheet names
+    Any other keyword arguments are passed through to ExcelFile.parse
+    '''
+
+    # Only empty cells will be regarded as missing values, unless the caller says otherwise
+    parse_kwargs = {'keep_default_na': False, 'na_values': ['']}
+    parse_kwargs.update(kwargs)
+
+    with pd.ExcelFile(excel_path) as xls:
+        for sheet in xls.sheet_names:
+            if (sheet in ignored_tabs) or (sheet.startswith('lu_')):
+                continue
+            if (sheets is not None) and (sheet not in sheets):
+                continue
+
+            yield sheet, xls.parse(
+                sheet,
+                skiprows = skiprows,
+                converters = converters(sheet) if callable(converters) else converters,
+                **parse_kwargs
+            )
+
+
+
+# What str() of a cell value gives back after the value is written with xlsxwriter and read back in with read_excel (converters = str)
+# The upload routine used to do exactly that round trip to convert the string columns, now it converts them in memory (see main.py)
+#   - xlsxwriter writes numbers with 16 significant digits, and read_excel gives back the ones with nothing after the decimal point as int,
+#     so 8001.0 comes back as "8001", not "8001.0"
+#   - dates come back as datetimes
+def excel_str(value):
+    if isinstance(value, (bool, np.bool_)):
+        return str(bool(value))
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        if not np.isfinite(float(value)):
+            return str(value)
+        number = float(f"{value:.16G}")
+        return str(int(number) if number.is_integer() else number)
+    if isinstance(value, date) and not isinstance(value, datetime):
+        return str(datetime(value.year, value.month, value.day))
+    return str(value)
+
+
+def round_trip_strings(df, columns):
+    '''
+    Does to the dataframe (in place) what the excel round trip did - the columns get excel_str,
+    and empty strings in any column become NaN, since the empty cells came back as missing (na_values = [''])
+    So a value that strip_whitespace left empty is still NULL, like it always was
+    '''
+    for col in columns:
+        notnull = df[col].notnull()
+        df[col] = df[col].astype(object)
+        df.loc[notnull, col] = df.loc[notnull, col].apply(excel_str)
+    for col in df.columns:
+        if df[col].dtype == object:
+            empty = (df[col] == '').to_numpy()
+            if empty.any():
+                df.loc[empty, col] = np.nan
+    return df
+
+
+# The cell fill colors of the marked excel file
+ERROR_COLOR = '#FF8585'
+WARNING_COLOR = '#FFFF00'
+
+
+def cell_index(all_dfs, errs, warnings):
+    '''
+    Goes through the errors and warnings one time, and gives back {sheet: {row: [(column index, severity, message), ...]}}
+    row and column are both zero based (the rows in errs and warnings are excel row numbers, which start at 1)
+    '''
+    index = dict()
+    for severity, lst in (('error', errs), ('warning', warnings)):
+        for e in lst:
+            # No empty errors allowed otherwise it crashes
+            if len(e) == 0:
+                continue
+            table = e.get('table')
+            if table not in all_dfs:
+                print(f"mark_workbook - {table} is not one of the tables that were checked, its {severity}s will not be marked")
+                continue
+
+            message = e.get('error_message') if severity == 'error' else f"{e.get('error_message')} (Warning)"
+            colindices = [all_dfs[table].columns.get_loc(str(col).strip().lower()) for col in e.get('columns').split(',')]
+            sheet = index.setdefault(table, dict())
+            for r in e.get('rows'):
+                cells = sheet.setdefault(int(r) - 1, [])
+                cells.extend((c, severity, message) for c in colindices)
+    return index
+
+
+def merge_marks(cells):
+    '''
+    (column index, severity, message) tuples for one row -> {column index: (severity, comment text)}
+    A cell flagged more than once gets one comment with all the messages (errors first), and the error color if any of them was an error
+    '''
+    merged = dict()
+    for c, severity, message in cells:
+        severities, messages = merged.setdefault(c, (set(), []))
+        severities.add(severity)
+        if message not in messages:
+            messages.append(message)
+    return {
+        c: (
+            'error' if 'error' in severities else 'warning',
+            '\n'.join(sorted(messages, key = lambda m: m.endswith('(Warning)')))
+        )
+        for c, (severities, messages) in merged.items()
+    }
+
+
+class MarkedFormats:
+    '''
+    xlsxwriter needs one format object for every combination of fill and number format,
+    they get made the first time they are needed, since every one of them ends up in the styles of the file
+    '''
+    NUM_FORMATS = {'datetime': 'YYYY-MM-DD HH:MM:SS', 'date': 'YYYY-MM-DD'}
+
+    def __init__(self, workbook):
+        self.workbook = workbook
+        self.formats = dict()
+        self.header = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+
+    def get(self, severity = None, kind = None):
+        if (severity is None) and (kind is None):
+            return None
+        if (severity, kind) not in self.formats:
+            props = dict()
+            if severity is not None:
+                props.update({'bg_color': ERROR_COLOR if severity == 'error' else WARNING_COLOR, 'pattern': 1})
+            if kind is not None:
+                props['num_format'] = self.NUM_FORMATS[kind]
+            self.formats[(severity, kind)] = self.workbook.add_format(props)
+        return self.formats[(severity, kind)]
+
+
+def write_cell(worksheet, row, col, value, formats, severity = None):
+    # the pandas/openpyxl values to the matching xlsxwriter write method
+    # strings always go through write_string, so nothing the user typed in gets turned into a formula or a link
+    if (value is None) or (value != value):
+        # NaN and NaT are the only values not equal to themselves. Empty cells only need to be written if they are marked
+        if severity is not None:
+            worksheet.write_blank(row, col, None, formats.get(severity))
+    elif isinstance(value, str):
+        worksheet.write_string(row, col, value, formats.get(severity))
+    elif isinstance(value, (bool, np.bool_)):
+        worksheet.write_boolean(row, col, bool(value), formats.get(severity))
+    elif isinstance(value, (int, float, np.number)):
+        worksheet.write_number(row, col, value, formats.get(severity))
+    elif isinstance(value, datetime):
+        worksheet.write_datetime(row, col, value.replace(tzinfo = None), formats.get(severity, 'datetime'))
+    elif isinstance(value, date):
+        worksheet.write_datetime(row, col, value, formats.get(severity, 'date'))
+    else:
+        worksheet.write_string(row, col, str(value), formats.get(severity))
+
+
+def write_marked_row(worksheet, row, values, cells, formats):
+    marks = merge_marks(cells) if cells else dict()
+    for col, value in enumerate(values):
+        severity, comment = marks.pop(col, (None, None))
+        write_cell(worksheet, row, col, value, formats, severity)
+        if comment is not None:
+            worksheet.write_comment(row, col, comment, {'author': 'Checker'})
+
+    # marks on cells past the end of the row (empty cells at the end of a row do not come back from the excel file)
+    for col in sorted(marks.keys()):
+        severity, comment = marks[col]
+        worksheet.write_blank(row, col, None, formats.get(severity))
+        worksheet.write_comment(row, col, comment, {'author': 'Checker'})
+
+
+def mark_workbook(all_dfs, excel_path, errs, warnings, startrow = 0):
+    '''
+    Writes the marked copy of the submitted excel file (the one the upload routine wrote) to the submission directory
+    The sheets of the checked tables are written straight from all_dfs, with the column headers at startrow (current_app.excel_offset)
+    Any other sheets in the file (tabs that the custom checks added to it, like the tox summary) are copied over as they are
+    '''
     assert session.get('submission_dir') is not None, "function - mark_workbook - session submission dir is not defined."
     orig_filename = excel_path.rsplit('/', 1)[-1]
     filename = orig_filename.rsplit('.',1)[0]
     ext = orig_filename.rsplit('.',1)[-1]
     marked_path = os.path.join(session.get('submission_dir'), f"{filename}-marked.{ext}")
-    
-    # copy the excel file and have "marked" in the name, and we will mark this excel file
-    shutil.copy(excel_path, marked_path)
-
-    # No empty errors allowed otherwise it crashes
-    errs = [e for e in errs if len(e) > 0]
-
-    errs_cells = dict()
-    for table in set([e.get('table') for e in errs]):
-        errs_cells[table] = []
-        [    
-            errs_cells[table].append(
-                {
-                    'row_index': r,
-                    'column_index': all_dfs[table].columns.get_loc(str(col).strip().lower()),
-                    'message': e.get('error_message')
-                }
-            )
-            for e in errs
-            for col in e.get('columns').split(',')
-            for r in e.get('rows')
-            if e.get('table') == table
-        ]
-
-    warnings_cells = dict()
-    for table in set([w.get('table') for w in warnings]):
-        warnings_cells[table] = []
-        [    
-            warnings_cells[table].append(
-                {
-                    'row_index': r,
-                    'column_index': all_dfs[table].columns.get_loc(str(col).strip().lower()),
-                    'message': f"{w.get('error_message')} (Warning)"
-                }
-            )
-            for w in warnings
-            for col in w.get('columns').split(',')
-            for r in w.get('rows')
-            if w.get('table') == table
-        ]
 
-    
-    # for errors
-    redFill = PatternFill(
-        start_color='FF8585',
-        end_color='FF8585',
-        fill_type='solid'
-    )
+    # This used to copy the excel file, load the whole thing into openpyxl and set the fill and comment cell by cell
+    #   which took longer than the checks themselves (and a lot of memory) when there were tens of thousands of flagged cells
+    # Now the marked file is written from scratch in a single pass with xlsxwriter.
+    # In constant_memory mode each row goes to disk as soon as the next row is started, so the rows of each sheet must be written in order,
+    #   which is why the errors and warnings are put into a (sheet, row) index first
+    index = cell_index(all_dfs, errs, warnings)
 
-    # for warnings
-    yellowFill = PatternFill(
-        start_color='00FFFF00',
-        end_color='00FFFF00',
-        fill_type='solid'
-    )
+    source = load_workbook(excel_path, read_only = True)
+    workbook = xlsxwriter.Workbook(marked_path, {'constant_memory': True, 'nan_inf_to_errors': True})
+    formats = MarkedFormats(workbook)
+    try:
+        for sheet in source.sheetnames:
+            worksheet = workbook.add_worksheet(sheet)
+            marks = index.get(sheet, dict())
 
+            if sheet in all_dfs:
+                df = all_dfs[sheet]
+                for col, name in enumerate(df.columns):
+                    worksheet.write_string(startrow, col, str(name), formats.header)
 
-    wb = load_workbook(marked_path)
-
-    for sheet in wb.sheetnames:
-        # Mark warnings first - this way if there are an error and warning in the same cell, the error will be shown
-        for coord in warnings_cells.get(sheet) if warnings_cells.get(sheet) is not None else []:
-            colindex = coord.get('column_index')
-            wb[sheet][f"{chr(65 +  (floor(colindex/26) - 1)  ) if colindex >= 26 else ''}{chr(65 + (colindex % 26))}{int(coord.get('row_index'))}"].fill = yellowFill 
-            wb[sheet][f"{chr(65 +  (floor(colindex/26) - 1)  ) if colindex >= 26 else ''}{chr(65 + (colindex % 26))}{int(coord.get('row_index'))}"].comment = Comment(coord.get('message'), "Checker")
-        
-        for coord in errs_cells.get(sheet) if errs_cells.get(sheet) is not None else []:
-            
-            # the workbook sheet or whatever its called accesses the cells of the excel file not with the numeric indexing like pandas but rather that letter indexing thing
-            # like "Cell A1" and stuff like that
-
-            # So the gigantic disgusting f string f"{chr(65 +  (math.floor(colindex/26) - 1)  ) if colindex >= 26 else ''}{chr(65 + (colindex % 26))}{coord.get('row_index')}"
-            # is to convert from pandas indexing to the letter indexing style thing
-
-            colindex = coord.get('column_index')
-            wb[sheet][f"{chr(65 +  (floor(colindex/26) - 1)  ) if colindex >= 26 else ''}{chr(65 + (colindex % 26))}{int(coord.get('row_index'))}"].fill = redFill 
-            wb[sheet][f"{chr(65 +  (floor(colindex/26) - 1)  ) if colindex >= 26 else ''}{chr(65 + (colindex % 26))}{int(coord.get('row_index'))}"].comment = Comment(coord.get('message'), "Checker")
-        
-    wb.save(marked_path)
+                columns = [df[col].tolist() for col in df.columns]
+                for i, values in enumerate(zip(*columns)):
+                    row = startrow + 1 + i
+                    write_marked_row(worksheet, row, values, marks.get(row), formats)
+            else:
+                # read only mode reads the rows as it goes, rather than building the whole sheet in memory
+                for row, values in enumerate(source[sheet].iter_rows(values_only = True)):
+                    write_marked_row(worksheet, row, values, marks.get(row), formats)
+    finally:
+        source.close()
+        workbook.close()
 
     return marked_path
 
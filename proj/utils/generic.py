@@ -1,5 +1,5 @@
 from json import dump
-from pandas import DataFrame
+import numpy as np
 from inspect import currentframe
 
 
@@ -23,41 +23,29 @@ def collect_error_messages(errs):
     
     print('in collect error messages')
     print("errs")
-    output = [
-        {
-            # This will be written to a json and stored in the submission directory
-            # to be read in later during the final submission routine, 
-            # or in the routine which marks up their excel file
-            # If i really wanted to do it officially, i'd probably make the message a json format
-            # I decided not to do it this way because i can imagine a lot of bugs happening, such as quotes being in error messages, 
-            #   colons in error messages, etc
-            # Instead i separate the columns and the associated error message with 3 hyphens
-            # As long as 3 consecutive hyphens with spaces on both sides doesnt show up in an error message, it will work
-            # I dont like doing it this way, but i'm thinking it might be the lesser of two evils, 
-            #   since doing it with json we will have to test every possible case that could break it
-            #   So this way is not elegant, but less likely to break with unexpected input
-            "columns"         : e['columns'],
-            "table"           : e['table'],
-            "row_number"      : r,
-            "message"         : f"{e['columns']} --- {e['error_message']}"
-        }
-        for e in errs
-        for r in e['rows']
-    ]
-
-    # print("output from generic.py before groupby: ")
-    # print(output)
-
-    output = DataFrame(output).groupby(['row_number', 'table']) \
-        .apply(
-            # .tolist() doesnt work. 
-            lambda x: '; '.join( list(x['message']) ) 
-        ).to_dict() 
-
-    # print("output from generic.py after groupby: ")
-    # print(output)
-    
-    return [{'row_number': k[0], 'table': k[1], 'message': v} for k, v in output.items()]
+    # This will be written to a json and stored in the submission directory
+    # to be read in later during the final submission routine, 
+    # or in the routine which marks up their excel file
+    # If i really wanted to do it officially, i'd probably make the message a json format
+    # I decided not to do it this way because i can imagine a lot of bugs happening, such as quotes being in error messages, 
+    #   colons in error messages, etc
+    # Instead i separate the columns and the associated error message with 3 hyphens
+    # As long as 3 consecutive hyphens with spaces on both sides doesnt show up in an error message, it will work
+    # I dont like doing it this way, but i'm thinking it might be the lesser of two evils, 
+    #   since doing it with json we will have to test every possible case that could break it
+    #   So this way is not elegant, but less likely to break with unexpected input
+
+    # The messages are grouped by row number and table in a dictionary as they are collected
+    #   this used to make a dictionary for every row of every error, and then put them back together with DataFrame.groupby(...).apply(join)
+    #   which was really slow when one error covered a lot of rows
+    output = dict()
+    for e in errs:
+        message = f"{e['columns']} --- {e['error_message']}"
+        for r in e['rows']:
+            output.setdefault((int(r), e['table']), []).append(message)
+
+    # groupby sorted by row number then table, so it stays in that order
+    return [{'row_number': k[0], 'table': k[1], 'message': '; '.join(v)} for k, v in sorted(output.items())]
 
 
 
@@ -72,14 +60,9 @@ def correct_row_offset(lst, offset):
     print("offset: ")
     print(offset)
 
-    [
-        e.update(
-            { "rows" : [ r + offset + 1 + 1 for r in e['rows']] }
-        )
-        for e in lst
-        if len(e) > 0
-        
-    ]
+    for e in lst:
+        if len(e) > 0:
+            e.update({ "rows" : (np.asarray(e['rows'], dtype = np.int64) + (offset + 1 + 1)).tolist() })
 
     return lst
 
@@ -0,0 +1,210 @@
+import os, json, time, traceback
+from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
+from flask import session, current_app, has_app_context
+
+# Check jobs
+# The upload routine used to run the whole pipeline (read, match, clean, core checks, custom checks, marking) inside the request
+# For the larger submissions that would hold up a uwsgi worker for minutes at a time, and sometimes the proxy would time out before it finished
+# Now the upload route saves the file and submits a job, and the browser polls the status route until the job is finished
+
+# The jobs are stored as json files in the submission directory, so there is no broker or other service to stand up
+#   files/<submissionid>/jobs/<jobid>.json
+# The jobs are run by a thread pool in the same process that received the upload
+#   The pipeline spends most of its time in the database, pandas and R (subprocess) so threads are enough here
+# A job that is queued or running in a process that died (uwsgi restarted a worker, the server got rebooted) would never finish,
+#   so the job records the pid of the process running it, and the time it last changed
+#   When that process is gone, or the job has not changed in CHECK_JOB_STALE_TIMEOUT seconds (default an hour), it reads as failed
+#   otherwise the user would never be able to upload to that submission directory again, and the browser would poll forever
+
+JOBS_DIRNAME = 'jobs'
+
+# The marked excel file is made by a job of its own after the check job is done, it always has this jobid
+# so the download route can find it (see mark_submission in main.py)
+MARKING_JOBID = 'marking'
+
+STALE_TIMEOUT = 3600
+
+# The executor is created lazily and per process id
+# uwsgi forks the workers after the app is imported, and a thread pool created before the fork would not have any live threads in the child
+_executor = None
+_executor_pid = None
+
+
+def get_executor(max_workers = 2):
+    global _executor, _executor_pid
+    if (_executor is None) or (_executor_pid != os.getpid()):
+        _executor = ThreadPoolExecutor(max_workers = max_workers, thread_name_prefix = 'checkjob')
+        _executor_pid = os.getpid()
+    return _executor
+
+
+def jobs_dir(submission_dir):
+    return os.path.join(submission_dir, JOBS_DIRNAME)
+
+
+def job_path(submission_dir, jobid):
+    return os.path.join(jobs_dir(submission_dir), f"{jobid}.json")
+
+
+def stale_timeout():
+    if has_app_context():
+        return int(current_app.config.get('CHECK_JOB_STALE_TIMEOUT', STALE_TIMEOUT))
+    return STALE_TIMEOUT
+
+
+def abandoned(job, timeout = STALE_TIMEOUT):
+    '''True if the job is queued or running, but the process running it is gone, or it has not changed in timeout seconds'''
+    if job.get('status') not in ('queued', 'running'):
+        return False
+    if time.time() - (job.get('updated') or job.get('submitted')) > timeout:
+        return True
+    if job.get('pid') is None:
+        return False
+    try:
+        os.kill(int(job.get('pid')), 0)
+    except ProcessLookupError:
+        return True
+    except (ValueError, OSError):
+        # PermissionError means the process is there, it just belongs to someone else
+        return False
+    return False
+
+
+def read_job(submission_dir, jobid):
+    path = job_path(submission_dir, jobid)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        job = json.load(f)
+
+    if abandoned(job, stale_timeout()):
+        print(f"Check job {jobid} was {job.get('status')} in process {job.get('pid')}, which is gone or has not touched it in a while")
+        job['status'] = 'failed'
+        job['abandoned'] = True
+        job['result'] = job.get('result') or {"critical_error": True}
+        job['finished'] = job.get('updated') or job.get('submitted')
+
+    # Give the elapsed time of the stage that is currently running
+    now = time.time()
+    for stage in job.get('stages'):
+        if stage.get('elapsed') is None:
+            stage['elapsed'] = round((job.get('finished') or now) - stage.get('started'), 3)
+    job['elapsed'] = round((job.get('finished') or now) - job.get('submitted'), 3)
+
+    return job
+
+
+def active_job(submission_dir):
+    # returns the jobid of a job that is queued or running in this submission directory, if there is one
+    # (read_job already makes the abandoned ones failed)
+    if not os.path.exists(jobs_dir(submission_dir)):
+        return None
+    for filename in os.listdir(jobs_dir(submission_dir)):
+        if not filename.endswith('.json'):
+            continue
+        job = read_job(submission_dir, filename.rsplit('.', 1)[0])
+        if (job is not None) and (job.get('status') in ('queued', 'running')):
+            return job.get('jobid')
+    return None
+
+
+class CheckJob:
+    '''
+    The record of a check job, which gets written to the jobs directory every time it changes
+    The pipeline calls job.stage("stage name") at the start of each stage, so the status route can report where it is at
+    '''
+    def __init__(self, submission_dir, jobid = None):
+        self.submission_dir = submission_dir
+        self.jobid = jobid if jobid is not None else uuid4().hex
+        self.record = {
+            "jobid"     : self.jobid,
+            "status"    : "queued",
+            "stage"     : None,
+            "stages"    : [],
+            "submitted" : time.time(),
+            "updated"   : time.time(),
+            "pid"       : os.getpid(),
+            "started"   : None,
+            "finished"  : None,
+            "result"    : None,
+            "session"   : None
+        }
+
+    def save(self):
+        os.makedirs(jobs_dir(self.submission_dir), exist_ok = True)
+        path = job_path(self.submission_dir, self.jobid)
+
+        self.record['updated'] = time.time()
+
+        # write to a temp file then swap it in, so the status route never reads a half written file
+        tmppath = f"{path}.tmp"
+        with open(tmppath, 'w') as f:
+            json.dump(self.record, f, default = str)
+        os.replace(tmppath, path)
+
+    def _close_stage(self):
+        if len(self.record['stages']) > 0 and self.record['stages'][-1].get('elapsed') is None:
+            self.record['stages'][-1]['elapsed'] = round(time.time() - self.record['stages'][-1].get('started'), 3)
+
+    def stage(self, name):
+        print(f"Check job {self.jobid} - {name}")
+        self._close_stage()
+        self.record['stage'] = name
+        self.record['stages'].append({"name": name, "started": time.time(), "elapsed": None})
+        self.save()
+
+    def start(self):
+        self.record['status'] = 'running'
+        self.record['started'] = time.time()
+        self.save()
+
+    def finish(self, result, session_data, status = 'done'):
+        self._close_stage()
+        self.record['status'] = status
+        self.record['stage'] = None
+        self.record['finished'] = time.time()
+        self.record['result'] = result
+        self.record['session'] = session_data
+        self.save()
+
+
+def submit_job(app, session_data, func, *args, on_error = None, jobid = None, **kwargs):
+    '''
+    Submits func to the worker pool, and returns the jobid
+
+    func gets called as func(job, *args, **kwargs) inside a request context of the app,
+    with the session populated from session_data, and the before_request functions already run (so g.eng is there)
+    That way the pipeline code, and the custom checks, can keep using session, g and current_app like they always have
+
+    func should return a dictionary, which is what the browser gets back as the result of the job
+    Whatever the pipeline put in the session gets stored with the job, and the status route puts it in the user's session
+    on_error(err) should return the dictionary to give back to the browser if the job crashes
+    jobid can be given for jobs that need to be found without being told the id (the marking job), otherwise a random one is made
+    '''
+    job = CheckJob(session_data.get('submission_dir'), jobid = jobid)
+    job.save()
+
+    def run():
+        with app.test_request_context():
+            try:
+                session.update(session_data)
+                app.preprocess_request()
+                job.start()
+                result = func(job, *args, **kwargs)
+                job.finish(result, dict(session))
+            except Exception as err:
+                print(f"Check job {job.jobid} failed")
+                traceback.print_exc()
+                result = {"critical_error": True}
+                try:
+                    # if the error handler itself fails (mail server down for example) the job still has to be marked as failed,
+                    # otherwise the browser would poll forever
+                    if on_error is not None:
+                        result = on_error(err)
+                finally:
+                    job.finish(result, dict(session), status = 'failed')
+
+    get_executor(int(app.config.get('CHECK_JOB_WORKERS', 2))).submit(run)
+
+    return job.jobid
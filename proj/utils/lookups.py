@@ -0,0 +1,141 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+from pandas import read_sql
+from flask import current_app, has_app_context
+
+from .schema import get_catalog
+
+# Lookup list cache
+# The lookup list checks (core checks, multivalue_lookup_check, fix_case, and a few of the custom checks)
+#   used to query the lookup list table every single time, and fish even did it once for every row
+# The cache keeps the values of a lookup list column in a frozenset, so checking a value is just a set membership test
+#
+# To know if a lookup list changed, we compare its "version" - the row count and the max last_edited_date (if the table has that column)
+#   The version query is cheap, and the versions of several tables can be fetched in a single query (see prefetch)
+#   It also is only run once every LOOKUP_CACHE_CHECK_INTERVAL seconds (default 30) per table, within that time the cached values are trusted
+# The least recently used entries get dropped once there are more than LOOKUP_CACHE_SIZE (default 256) of them
+
+DEFAULT_SIZE = 256
+DEFAULT_CHECK_INTERVAL = 30
+
+
+def _config(key, default):
+    if has_app_context():
+        return current_app.config.get(key, default)
+    return default
+
+
+class LookupCache:
+    def __init__(self):
+        # key is (database url, table, column), value is a dict with the values, version and the time the version was last checked
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def _versions(self, tables, eng):
+        # one query for the versions of all the tables
+        catalog = get_catalog(eng)
+        selects = []
+        for t in tables:
+            has_last_edited = 'last_edited_date' in catalog.column_names(t)
+            selects.append(
+                f"""SELECT '{t}' AS tablename, COUNT(*) AS n_rows, {"CAST(MAX(last_edited_date) AS TEXT)" if has_last_edited else "CAST(NULL AS TEXT)"} AS last_edited FROM "{t}" """
+            )
+        versions = read_sql(' UNION ALL '.join(selects), eng)
+        return {r.tablename: (int(r.n_rows), r.last_edited) for r in versions.itertuples()}
+
+    def _load(self, table, column, eng):
+        return frozenset(read_sql(f'''SELECT DISTINCT "{column}" FROM "{table}";''', eng)[column].tolist())
+
+    def prefetch(self, pairs, eng):
+        '''
+        pairs is a list of (lookup table, column) tuples
+        Checks the versions of all the lookup tables that are due for a check in one query, and reloads the ones that changed or are not cached
+        After this, lookup_values for those pairs will not hit the database
+        '''
+        url = str(eng.url)
+        interval = float(_config('LOOKUP_CACHE_CHECK_INTERVAL', DEFAULT_CHECK_INTERVAL))
+        now = time.time()
+
+        with self._lock:
+            due = [
+                (t, c) for t, c in set(pairs)
+                if ((url, t, c) not in self._entries) or (now - self._entries[(url, t, c)]['checked'] > interval)
+            ]
+        if len(due) == 0:
+            return
+
+        versions = self._versions(sorted(set(t for t, c in due)), eng)
+        for t, c in due:
+            key = (url, t, c)
+            with self._lock:
+                entry = self._entries.get(key)
+            if (entry is not None) and (entry['version'] == versions[t]):
+                entry['checked'] = now
+                continue
+
+            values = self._load(t, c, eng)
+            with self._lock:
+                if entry is not None:
+                    self.refreshes += 1
+                self._entries[key] = {"values": values, "version": versions[t], "checked": now}
+                self._entries.move_to_end(key)
+                self._evict()
+
+    def _evict(self):
+        maxsize = int(_config('LOOKUP_CACHE_SIZE', DEFAULT_SIZE))
+        while len(self._entries) > maxsize:
+            self._entries.popitem(last = False)
+
+    def lookup_values(self, table, column, eng):
+        '''frozenset of the values in the column of the lookup list table'''
+        key = (str(eng.url), table, column)
+
+        with self._lock:
+            cached = key in self._entries
+        self.prefetch([(table, column)], eng)
+
+        with self._lock:
+            if cached:
+                self.hits += 1
+            else:
+                self.misses += 1
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry['values']
+
+        # another thread pushed it out of the cache in the meantime
+        return self._load(table, column, eng)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries"   : len(self._entries),
+                "hits"      : self.hits,
+                "misses"    : self.misses,
+                "refreshes" : self.refreshes,
+                "tables"    : sorted(set(f"{t}.{c}" for _, t, c in self._entries.keys()))
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# one cache per process
+lookup_cache = LookupCache()
+
+
+def lookup_values(table, column, eng):
+    return lookup_cache.lookup_values(table, column, eng)
+
+
+def lookup_versions(tables, eng):
+    '''{table: (row count, max last_edited_date)} for each of the lookup tables, in one query'''
+    if len(tables) == 0:
+        return dict()
+    return lookup_cache._versions(sorted(set(tables)), eng)
@@ -1,37 +1,25 @@
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email.mime.multipart import MIMEMultipart
-from email.mime.application import MIMEApplication
-from email.utils import COMMASPACE, formatdate
-from email import encoders
+from email.utils import COMMASPACE
 import smtplib
 from smtplib import SMTPException
 import pandas as pd
 
+from .outbox import build_message, enqueue, outbox_enabled, start_sender
+
 # Function to be used later in sending email
+# The email goes in the outbox, and the sender thread sends it (see outbox.py), so the request does not wait on the mail server
 def send_mail(send_from, send_to, subject, text, filename=None, server="localhost"):
-    msg = MIMEMultipart()
-    
-    msg['From'] = send_from
-    msg['To'] = COMMASPACE.join(send_to)
     print("----- MESSAGE TO ----")
-    print(msg['To'])
-    msg['Date'] = formatdate(localtime=True)
-    msg['Subject'] = subject
-    
-    msg_content = MIMEText(text)
-    msg.attach(msg_content)
-    
+    print(COMMASPACE.join(send_to))
+    if outbox_enabled():
+        start_sender()
+        return enqueue(send_from, send_to, subject, text, filename = filename, server = server)
+    send_now(send_from, send_to, subject, text, filename = filename, server = server)
+
+
+# sends it right away, like send_mail always used to
+def send_now(send_from, send_to, subject, text, filename=None, server="localhost"):
     print(f"filename: {filename}")
-    if filename is not None:
-        print("filename IS NOT NONE")
-        attachment = open(filename,"rb")
-        p = MIMEBase('application','octet-stream')
-        p.set_payload((attachment).read())
-        encoders.encode_base64(p)
-        p.add_header('Content-Disposition','attachment; filename= %s' % filename.split("/")[-1])
-        msg.attach(p)
-        print(" done with if conditional within send_mail fcn")
+    msg = build_message(send_from, send_to, subject, text, filename = filename)
     try:
         print("inside try to send the email")
         smtp = smtplib.SMTP(server)
@@ -44,7 +32,7 @@ def send_mail(send_from, send_to, subject, text, filename=None, server="localhos
         print("Error: unable to send email")
 
 
-def data_receipt(send_from, always_send_to, login_email, dtype, submissionid, originalfile, tables, eng, mailserver, login_info, cc = None, *args, **kwargs):
+def data_receipt(send_from, always_send_to, login_email, dtype, submissionid, originalfile, tables, eng, mailserver, login_info, cc = None, counts = None, *args, **kwargs):
     """
     Depending on the project, this function will likely need to be modified. In some cases there are agencies and data owners that
     must be incuded in the email body or subject.
@@ -57,6 +45,8 @@ def data_receipt(send_from, always_send_to, login_email, dtype, submissionid, or
     tables is the list of all tables they submitted data to
     eng is the database connection to confirm the records were loaded
     mailserver is the server that will be used to send the email
+    counts is the number of records loaded to each table ({tablename: count}), if the load already knows them
+        otherwise they get counted in the database
     """
 
     email_subject = f"Successful Data Load - {dtype} -- Submission ID#: {submissionid}"
@@ -67,9 +57,13 @@ def data_receipt(send_from, always_send_to, login_email, dtype, submissionid, or
     for k,v in login_info.items():
         email_body += f"{k}: {v}\n\t"
     email_body += "\n\n"
+    counts = counts if counts is not None else dict()
     email_body += "\n".join(
         [
-            f"""{pd.read_sql(f'SELECT COUNT(*) AS n_records FROM "{tbl}" WHERE submissionid = {submissionid};', eng).n_records.values[0]} records loaded to {tbl}"""
+            f"""{
+                counts[tbl] if tbl in counts
+                else pd.read_sql(f'SELECT COUNT(*) AS n_records FROM "{tbl}" WHERE submissionid = {submissionid};', eng).n_records.values[0]
+            } records loaded to {tbl}"""
             for tbl in tables 
         ]
     )
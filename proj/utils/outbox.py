@@ -0,0 +1,291 @@
+import os, json, time, shutil, smtplib
+from uuid import uuid4
+from threading import Thread, Event, Lock
+from email.mime.text import MIMEText
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.utils import COMMASPACE, formatdate
+from email import encoders
+from flask import current_app, has_app_context
+
+# Mail outbox
+# send_mail used to connect to the mail server right there in the request, and attach the whole workbook
+#   so if the mail relay was slow or hung, the final submit and the error pages hung right along with it
+# Now send_mail (see mail.py) only puts the message in the outbox, and a background thread sends it
+#
+# The outbox is a directory, like everything else the checker keeps
+#   files/.outbox/pending/<messageid>/message.json (and a copy of the attachment, since a new upload can overwrite the original)
+#   files/.outbox/sending/<pid>-<messageid>/ while a process is sending it
+#   files/.outbox/failed/<messageid>/ once it ran out of attempts
+# Every uwsgi worker has its own sender thread. A sender takes a message by renaming its directory from pending to sending,
+#   which only one of them can do, so a message does not get sent twice
+#   If a worker dies while it is sending, the next sender that starts puts its messages back in pending
+#
+# The sender sends the messages that are due in batches, over one connection to the mail server per batch
+#   If the connection fails, or the server turns a message down, it gets tried again later, waiting twice as long each time
+#
+# Config: MAIL_OUTBOX ("True" by default, "False" sends the email right away like before)
+
+OUTBOX_DIR = os.path.join(os.getcwd(), "files", ".outbox")
+MESSAGE_FILENAME = 'message.json'
+
+BATCH_SIZE = 20
+POLL_INTERVAL = 5
+SMTP_TIMEOUT = 30
+MAX_ATTEMPTS = 8
+# seconds to wait before the first retry, it doubles after each attempt up to MAX_BACKOFF
+BACKOFF = 30
+MAX_BACKOFF = 3600
+
+_sender = None
+_sender_pid = None
+_sender_lock = Lock()
+_wakeup = Event()
+
+
+def outbox_enabled():
+    return has_app_context() and str(current_app.config.get('MAIL_OUTBOX', 'True')) == 'True'
+
+
+def outbox_path(*parts, outbox_dir = None):
+    return os.path.join(outbox_dir or OUTBOX_DIR, *parts)
+
+
+def build_message(send_from, send_to, subject, text, filename = None, attachment_name = None):
+    msg = MIMEMultipart()
+
+    msg['From'] = send_from
+    msg['To'] = COMMASPACE.join(send_to)
+    msg['Date'] = formatdate(localtime=True)
+    msg['Subject'] = subject
+
+    msg.attach(MIMEText(text))
+
+    if filename is not None:
+        with open(filename, "rb") as attachment:
+            p = MIMEBase('application','octet-stream')
+            p.set_payload(attachment.read())
+        encoders.encode_base64(p)
+        p.add_header('Content-Disposition','attachment; filename= %s' % (attachment_name or filename.split("/")[-1]))
+        msg.attach(p)
+
+    return msg
+
+
+def enqueue(send_from, send_to, subject, text, filename = None, server = "localhost", outbox_dir = None):
+    '''puts the email in the outbox and gives back its id - the sender thread takes it from there'''
+    messageid = f"{time.time_ns()}-{uuid4().hex[:8]}"
+    tmpdir = outbox_path('tmp', messageid, outbox_dir = outbox_dir)
+    os.makedirs(tmpdir)
+
+    attachment = None
+    if filename is not None:
+        if os.path.exists(filename):
+            attachment = os.path.basename(filename)
+            # a hard link is free, but the files directory and the outbox might not be on the same filesystem
+            try:
+                os.link(filename, os.path.join(tmpdir, attachment))
+            except OSError:
+                shutil.copy(filename, os.path.join(tmpdir, attachment))
+        else:
+            print(f"Attachment {filename} not found, sending the email without it")
+
+    message = {
+        "id"           : messageid,
+        "send_from"    : send_from,
+        "send_to"      : list(send_to),
+        "subject"      : subject,
+        "text"         : text,
+        "attachment"   : attachment,
+        "server"       : server,
+        "attempts"     : 0,
+        "next_attempt" : 0,
+        "errors"       : []
+    }
+    with open(os.path.join(tmpdir, MESSAGE_FILENAME), 'w') as f:
+        json.dump(message, f)
+
+    # it only shows up in pending once it is all there
+    os.makedirs(outbox_path('pending', outbox_dir = outbox_dir), exist_ok = True)
+    os.rename(tmpdir, outbox_path('pending', messageid, outbox_dir = outbox_dir))
+
+    print(f"Email {messageid} to {', '.join(message['send_to'])} is in the outbox")
+    _wakeup.set()
+    return messageid
+
+
+def read_message(messagedir):
+    with open(os.path.join(messagedir, MESSAGE_FILENAME), 'r') as f:
+        return json.load(f)
+
+
+def write_message(messagedir, message):
+    path = os.path.join(messagedir, MESSAGE_FILENAME)
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(message, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def claim_due(outbox_dir = None, limit = None):
+    '''moves up to limit (default BATCH_SIZE) messages that are due from pending to sending, and gives back their directories (oldest first)'''
+    limit = BATCH_SIZE if limit is None else limit
+    pending = outbox_path('pending', outbox_dir = outbox_dir)
+    sending = outbox_path('sending', outbox_dir = outbox_dir)
+    if not os.path.isdir(pending):
+        return []
+    os.makedirs(sending, exist_ok = True)
+
+    claimed = []
+    now = time.time()
+    for messageid in sorted(os.listdir(pending)):
+        if len(claimed) >= limit:
+            break
+        try:
+            if read_message(os.path.join(pending, messageid)).get('next_attempt', 0) > now:
+                continue
+            target = os.path.join(sending, f"{os.getpid()}-{messageid}")
+            os.rename(os.path.join(pending, messageid), target)
+        except (OSError, ValueError):
+            # another sender got to it first (or it is half written)
+            continue
+        claimed.append(target)
+    return claimed
+
+
+def retry_later(messagedir, error, outbox_dir = None):
+    message = read_message(messagedir)
+    message['attempts'] += 1
+    message['errors'].append(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {error}")
+
+    if message['attempts'] >= MAX_ATTEMPTS:
+        print(f"Email {message['id']} ({message['subject']}) failed {message['attempts']} times, giving up on it")
+        write_message(messagedir, message)
+        os.makedirs(outbox_path('failed', outbox_dir = outbox_dir), exist_ok = True)
+        os.rename(messagedir, outbox_path('failed', message['id'], outbox_dir = outbox_dir))
+        return
+
+    message['next_attempt'] = time.time() + min(BACKOFF * (2 ** (message['attempts'] - 1)), MAX_BACKOFF)
+    print(f"Email {message['id']} could not be sent ({error}), trying again in {round(message['next_attempt'] - time.time())} seconds")
+    write_message(messagedir, message)
+    os.rename(messagedir, outbox_path('pending', message['id'], outbox_dir = outbox_dir))
+
+
+def recover_abandoned(outbox_dir = None, own = False):
+    '''
+    puts the messages back in pending that a process was sending when it died
+    own = True puts back the ones of this process too (for when a pass of the sender crashed part way through)
+    '''
+    sending = outbox_path('sending', outbox_dir = outbox_dir)
+    if not os.path.isdir(sending):
+        return
+    for name in os.listdir(sending):
+        pid, messageid = name.split('-', 1)
+        try:
+            if not (own and int(pid) == os.getpid()):
+                os.kill(int(pid), 0)
+                continue
+        except ProcessLookupError:
+            pass
+        except (ValueError, OSError):
+            continue
+        print(f"Email {messageid} was being sent by process {pid}, which did not finish. Putting it back in the outbox")
+        try:
+            os.rename(os.path.join(sending, name), outbox_path('pending', messageid, outbox_dir = outbox_dir))
+        except OSError:
+            continue
+
+
+def send_batch(messagedirs, outbox_dir = None):
+    '''sends the claimed messages, over one connection per mail server'''
+    byserver = dict()
+    for messagedir in messagedirs:
+        byserver.setdefault(read_message(messagedir).get('server'), []).append(messagedir)
+
+    sent = 0
+    for server, dirs in byserver.items():
+        try:
+            smtp = smtplib.SMTP(server, timeout = SMTP_TIMEOUT)
+        except (OSError, smtplib.SMTPException) as e:
+            for messagedir in dirs:
+                retry_later(messagedir, f"unable to connect to {server} - {e}", outbox_dir = outbox_dir)
+            continue
+
+        try:
+            for i, messagedir in enumerate(dirs):
+                message = read_message(messagedir)
+                try:
+                    msg = build_message(
+                        message['send_from'],
+                        message['send_to'],
+                        message['subject'],
+                        message['text'],
+                        filename = os.path.join(messagedir, message['attachment']) if message.get('attachment') else None
+                    )
+                    smtp.sendmail(message['send_from'], message['send_to'], msg.as_string())
+                except smtplib.SMTPServerDisconnected as e:
+                    # the connection is gone, this one and the rest of the batch go back in the outbox
+                    for d in dirs[i:]:
+                        retry_later(d, f"disconnected from {server} - {e}", outbox_dir = outbox_dir)
+                    break
+                except (OSError, smtplib.SMTPException) as e:
+                    retry_later(messagedir, e, outbox_dir = outbox_dir)
+                    continue
+
+                print(f"Email {message['id']} ({message['subject']}) sent")
+                shutil.rmtree(messagedir, ignore_errors = True)
+                sent += 1
+        finally:
+            try:
+                smtp.quit()
+            except (OSError, smtplib.SMTPException):
+                pass
+    return sent
+
+
+def deliver_due(outbox_dir = None):
+    '''one pass of the sender - sends everything that is due, a batch at a time, and gives back how many were sent'''
+    sent = 0
+    while True:
+        claimed = claim_due(outbox_dir = outbox_dir)
+        if len(claimed) == 0:
+            return sent
+        sent += send_batch(claimed, outbox_dir = outbox_dir)
+
+
+def sender_loop(outbox_dir = None):
+    recover_abandoned(outbox_dir = outbox_dir)
+    while True:
+        _wakeup.clear()
+        try:
+            deliver_due(outbox_dir = outbox_dir)
+        except Exception as e:
+            # the sender should never die, whatever happens to one pass
+            print("Error in the mail outbox sender")
+            print(e)
+            recover_abandoned(outbox_dir = outbox_dir, own = True)
+        # enqueue wakes it up, otherwise it checks again every POLL_INTERVAL seconds for the retries that are due
+        _wakeup.wait(POLL_INTERVAL)
+
+
+def start_sender(outbox_dir = None):
+    '''
+    Starts the sender thread of this process if it is not running
+    It is per process id, since uwsgi forks the workers after the app is imported, and threads do not survive the fork
+    '''
+    global _sender, _sender_pid
+    if (_sender is not None) and (_sender_pid == os.getpid()) and _sender.is_alive():
+        return _sender
+    with _sender_lock:
+        if (_sender is None) or (_sender_pid != os.getpid()) or not _sender.is_alive():
+            _sender = Thread(target = sender_loop, kwargs = {"outbox_dir": outbox_dir}, name = 'outbox', daemon = True)
+            _sender.start()
+            _sender_pid = os.getpid()
+    return _sender
+
+
+def outbox_stats(outbox_dir = None):
+    stats = dict()
+    for state in ('pending', 'sending', 'failed'):
+        path = outbox_path(state, outbox_dir = outbox_dir)
+        stats[state] = len(os.listdir(path)) if os.path.isdir(path) else 0
+    return stats
@@ -0,0 +1,159 @@
+import json
+from hashlib import sha256
+from pandas import read_sql
+
+from .schema import invalidate_catalog
+
+# Schema preparation
+# Every final submit used to run these on every table it loaded to:
+#   ALTER TABLE ... ADD COLUMN IF NOT EXISTS (submissionid, warnings, login_email, login_agency)
+#   ALTER TABLE ... ALTER COLUMN globalid/objectid SET DEFAULT ...
+# Each of those takes an ACCESS EXCLUSIVE lock on the production table, even when there is nothing to change,
+#   so the duplicate checks, the reports and the query exports all had to wait behind the load
+#
+# Now the tables of all the datasets in the config get prepared once - when the app starts up, or through the admin route /schema/prepare
+#   Only the columns and defaults that are actually missing get changed, so a table that is already prepared does not get locked at all
+#   Each table that is prepared gets a record in checker_schema_version with the version of the preparation
+# /load only checks that every table it loads to has the current version (see assert_schema_prepared)
+#
+# If SYSTEM_COLUMNS or SYSTEM_DEFAULTS change, the version changes, and the tables get prepared again the next time the app starts
+# Config: PREPARE_SCHEMA_ON_STARTUP ("True" by default)
+
+SCHEMA_VERSION_TABLE = 'checker_schema_version'
+
+# columns every submission table needs, which are often overlooked when the tables get made
+SYSTEM_COLUMNS = (
+    ('submissionid', 'int4'),
+    ('warnings', 'VARCHAR(5000)'),
+    ('login_email', 'VARCHAR(50)'),
+    ('login_agency', 'VARCHAR(50)')
+)
+
+# column, default, and what the default should contain if it is already set ({tbl} gets the table name)
+SYSTEM_DEFAULTS = (
+    ('globalid', "next_globalid()", ("next_globalid(",)),
+    ('objectid', "next_rowid('sde','{tbl}')", ("next_rowid(", "'{tbl}'"))
+)
+
+SCHEMA_VERSION = sha256(json.dumps({"columns": SYSTEM_COLUMNS, "defaults": SYSTEM_DEFAULTS}).encode()).hexdigest()
+
+# so the app does not sit there forever at startup if someone has a long running query on one of the tables
+LOCK_TIMEOUT = '10s'
+
+
+def prepare_enabled(config):
+    return str(config.get('PREPARE_SCHEMA_ON_STARTUP', 'True')) == 'True'
+
+
+def dataset_tables(datasets):
+    '''all the tables data gets loaded to, for the datasets in the config'''
+    tables = set()
+    for dataset in datasets.values():
+        tables.update(dataset.get('tables') or [])
+        tables.update(dataset.get('analysis_tables') or [])
+    return sorted(tables)
+
+
+def create_version_table(eng):
+    eng.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {SCHEMA_VERSION_TABLE} (
+            tablename VARCHAR(255) NOT NULL PRIMARY KEY,
+            version VARCHAR(64) NOT NULL,
+            prepared_at TIMESTAMP NOT NULL DEFAULT now()
+        );
+        """
+    )
+
+
+def schema_versions(eng, tables):
+    '''{tablename: version} of the tables that were prepared'''
+    exists = not read_sql(f"SELECT table_name FROM information_schema.tables WHERE table_name = '{SCHEMA_VERSION_TABLE}';", eng).empty
+    if not exists or len(tables) == 0:
+        return dict()
+    tablenames = ', '.join("'{}'".format(str(t).replace("'", "''")) for t in tables)
+    versions = read_sql(f"SELECT tablename, version FROM {SCHEMA_VERSION_TABLE} WHERE tablename IN ({tablenames});", eng)
+    return dict(zip(versions.tablename, versions.version))
+
+
+def table_statements(tablename, columns):
+    '''
+    the ALTER TABLE statements that still need to run on the table
+    columns is the part of information_schema.columns for the table (column_name and column_default)
+    '''
+    existing = set(columns.column_name)
+    defaults = dict(zip(columns.column_name, columns.column_default))
+
+    statements = [
+        f'ALTER TABLE "{tablename}" ADD COLUMN IF NOT EXISTS {name} {datatype};'
+        for name, datatype in SYSTEM_COLUMNS
+        if name not in existing
+    ]
+    for name, default, expected in SYSTEM_DEFAULTS:
+        current = str(defaults.get(name) or '')
+        if not all(e.format(tbl = tablename) in current for e in expected):
+            statements.append(f'ALTER TABLE "{tablename}" ALTER COLUMN {name} SET DEFAULT {default.format(tbl = tablename)};')
+    return statements
+
+
+def prepare_schema(eng, datasets):
+    '''
+    Adds the system columns and defaults the tables of the datasets are missing, and records the version for each table
+    Gives back what happened to each table - "prepared" (with the statements that ran), "unchanged" or "failed" (with the error)
+    A table that fails does not stop the others
+    '''
+    create_version_table(eng)
+    tables = dataset_tables(datasets)
+    versions = schema_versions(eng, tables)
+
+    tablenames = ', '.join("'{}'".format(str(t).replace("'", "''")) for t in tables)
+    columns = read_sql(
+        f"SELECT table_name, column_name, column_default FROM information_schema.columns WHERE table_name IN ({tablenames});",
+        eng
+    ) if len(tables) > 0 else None
+
+    results = dict()
+    changed = False
+    for tbl in tables:
+        tblcolumns = columns[columns.table_name == tbl]
+        if tblcolumns.empty:
+            print(f"WARNING: table {tbl} is in the datasets config, but not in the database")
+            results[tbl] = {"status": "failed", "error": "table not found in the database"}
+            continue
+
+        statements = table_statements(tbl, tblcolumns)
+        if len(statements) == 0 and versions.get(tbl) == SCHEMA_VERSION:
+            results[tbl] = {"status": "unchanged"}
+            continue
+
+        try:
+            with eng.begin() as conn:
+                conn.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}';")
+                for statement in statements:
+                    print(statement)
+                    conn.execute(statement)
+                conn.execute(
+                    f"""
+                    INSERT INTO {SCHEMA_VERSION_TABLE} (tablename, version, prepared_at) VALUES ('{tbl}', '{SCHEMA_VERSION}', now())
+                    ON CONFLICT (tablename) DO UPDATE SET version = EXCLUDED.version, prepared_at = EXCLUDED.prepared_at;
+                    """
+                )
+            results[tbl] = {"status": "prepared", "statements": statements}
+            changed = changed or len(statements) > 0
+        except Exception as e:
+            print(f"WARNING: unable to prepare table {tbl}")
+            print(e)
+            results[tbl] = {"status": "failed", "error": str(e)}
+
+    # the schema catalog has the column defaults in it
+    if changed:
+        invalidate_catalog()
+
+    return results
+
+
+def assert_schema_prepared(eng, tables):
+    versions = schema_versions(eng, tables)
+    unprepared = [t for t in tables if versions.get(t) != SCHEMA_VERSION]
+    assert len(unprepared) == 0, \
+        f"The tables {', '.join(unprepared)} have not been prepared for loading data (the app prepares them on startup, or go to /schema/prepare)"
@@ -0,0 +1,185 @@
+import os, json, time, shutil
+from glob import glob
+from hashlib import sha256
+from pandas import read_sql
+
+from .snapshot import file_hash, read_manifest, snapshot_dir, SNAPSHOT_DIRNAME
+from .errors import ERROR_REPORT_FILENAME
+from .lookups import lookup_versions
+from .schema import get_catalog
+
+# Result cache
+# People upload the exact same workbook over and over (checking it again before final submit, refreshing the page etc)
+#   and every time the whole pipeline ran again
+# The result of a check job gets stored under a key made from
+#   - the sha256 of the uploaded file
+#   - a fingerprint of the code that decides what the errors are (core, custom, preprocess.py, match.py)
+#   - the dataset config and the login info of the user (the custom checks look at the login fields)
+#   - the versions of the tables - the insert/update/delete counters postgres keeps for every table (pg_stat_user_tables),
+#     and the row count and max last_edited_date of each lookup list (same as the lookup list cache)
+# so if the lookup lists, or the data in the production tables changed since, the key is different and the checks run again
+#
+# NOTE postgres reports the counters a little after the fact (up to several seconds), so data loaded a moment ago might not change the key yet
+#
+# The entry points back to the submission directory it came from (errors, warnings, error report, snapshot, marked file)
+#   Those files get fingerprinted when the entry is stored, and checked again before they are reused,
+#   so if that submission directory got a different upload in the meantime, the entry is thrown out
+# The upload overwrites the workbook in place when the file name is the same, so the workbook the pipeline wrote is copied into the entry itself
+#
+# The entries live in files/.result_cache/<key>/, and the least recently used get removed once there are more than RESULT_CACHE_SIZE (default 100)
+# Config: RESULT_CACHE ("True" by default, "False" turns it off), RESULT_CACHE_SIZE
+
+RESULT_CACHE_DIR = os.path.join(os.getcwd(), "files", ".result_cache")
+ENTRY_FILENAME = 'entry.json'
+WORKBOOK_FILENAME = 'workbook.xlsx'
+DEFAULT_SIZE = 100
+
+# what gets reused from the earlier submission directory
+ARTIFACTS = ('errors.json', 'warnings.json', ERROR_REPORT_FILENAME)
+
+# what the pipeline puts in the session, that the final submit routine needs
+SESSION_KEYS = ('datatype', 'table_to_tab_map', 'col_indices')
+
+PROJ_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FINGERPRINT_PATHS = ('core', 'custom', 'preprocess.py', 'match.py')
+
+_code_fingerprint = None
+
+
+def cache_enabled(config):
+    return str(config.get('RESULT_CACHE', 'True')) == 'True'
+
+
+def code_fingerprint():
+    # the code can not change without the app restarting, so this is only worked out once per process
+    global _code_fingerprint
+    if _code_fingerprint is None:
+        h = sha256()
+        for p in FINGERPRINT_PATHS:
+            path = os.path.join(PROJ_DIR, p)
+            if not os.path.exists(path):
+                continue
+            files = sorted(glob(os.path.join(path, '**', '*.py'), recursive = True)) if os.path.isdir(path) else [path]
+            for f in files:
+                h.update(os.path.relpath(f, PROJ_DIR).encode())
+                h.update(file_hash(f).encode())
+        _code_fingerprint = h.hexdigest()
+    return _code_fingerprint
+
+
+def table_versions(eng):
+    stats = read_sql(
+        """
+        SELECT relname, n_tup_ins, n_tup_upd, n_tup_del FROM pg_stat_user_tables
+        WHERE relname LIKE 'tbl_%%' OR relname LIKE 'analysis_%%' OR relname LIKE 'lu_%%'
+        ORDER BY relname;
+        """,
+        eng
+    )
+    return {
+        "tables"  : {r.relname: [int(r.n_tup_ins), int(r.n_tup_upd), int(r.n_tup_del)] for r in stats.itertuples()},
+        "lookups" : lookup_versions(get_catalog(eng).tables(prefixes = ['lu_']), eng)
+    }
+
+
+def rules_version(eng, app, login_info):
+    '''
+    Everything other than the file itself that decides what the errors are - the code, the config, the login info and the versions of the tables
+    The incremental core checks use this too, to know if the results of the last upload can still be used (see core/incremental.py)
+    '''
+    version = {
+        "code"     : code_fingerprint(),
+        "config"   : {
+            "datasets"      : app.datasets,
+            "system_fields" : app.system_fields,
+            "excel_offset"  : app.excel_offset,
+            "tabs_to_ignore": app.tabs_to_ignore
+        },
+        "login"    : login_info,
+        "versions" : table_versions(eng)
+    }
+    return sha256(json.dumps(version, sort_keys = True, default = str).encode()).hexdigest()
+
+
+def result_key(excel_path, eng, app, login_info, final_submit_requested = False):
+    # login_info does not have check-or-submit in it (login.py pops it into the session), and a final submit runs checks a plain check does not
+    #   same as the version of the incremental core checks (see core/core.py)
+    return sha256(f"{file_hash(excel_path)}:{rules_version(eng, app, login_info)}:{bool(final_submit_requested)}".encode()).hexdigest()
+
+
+def entry_dir(key):
+    return os.path.join(RESULT_CACHE_DIR, key)
+
+
+def artifact_fingerprints(submission_dir):
+    return {
+        "files"    : {name: file_hash(os.path.join(submission_dir, name)) for name in ARTIFACTS},
+        "snapshot" : read_manifest(submission_dir)
+    }
+
+
+def store_result(key, result, session_data, maxsize = DEFAULT_SIZE):
+    submission_dir = session_data.get('submission_dir')
+    outdir = entry_dir(key)
+    os.makedirs(outdir, exist_ok = True)
+    shutil.copy(session_data.get('excel_path'), os.path.join(outdir, WORKBOOK_FILENAME))
+
+    entry = {
+        "key"            : key,
+        "created"        : time.time(),
+        "submission_dir" : submission_dir,
+        "result"         : result,
+        "session"        : {k: session_data.get(k) for k in SESSION_KEYS},
+        "fingerprints"   : artifact_fingerprints(submission_dir)
+    }
+
+    # temp file then swap it in, another process might be reading it
+    path = os.path.join(outdir, ENTRY_FILENAME)
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(entry, f, default = str)
+    os.replace(f"{path}.tmp", path)
+
+    evict(maxsize)
+
+
+def cached_result(key):
+    '''the cache entry for the key, or None if there isnt one, or the files it points to changed'''
+    path = os.path.join(entry_dir(key), ENTRY_FILENAME)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            entry = json.load(f)
+        if artifact_fingerprints(entry.get('submission_dir')) != entry.get('fingerprints'):
+            print(f"Result cache entry {key} is stale, the files in {entry.get('submission_dir')} changed")
+            shutil.rmtree(entry_dir(key), ignore_errors = True)
+            return None
+    except (OSError, ValueError) as e:
+        print(f"Unable to read result cache entry {key}")
+        print(e)
+        shutil.rmtree(entry_dir(key), ignore_errors = True)
+        return None
+
+    # the modified time of the entry is what the eviction goes by
+    os.utime(path)
+    return entry
+
+
+def restore_result(entry, submission_dir, excel_path):
+    '''puts the files of the cached result in the submission directory, as if the pipeline had just run there'''
+    source = entry.get('submission_dir')
+    if os.path.abspath(source) != os.path.abspath(submission_dir):
+        for name in ARTIFACTS:
+            shutil.copy(os.path.join(source, name), os.path.join(submission_dir, name))
+        shutil.rmtree(snapshot_dir(submission_dir), ignore_errors = True)
+        shutil.copytree(snapshot_dir(source), os.path.join(submission_dir, SNAPSHOT_DIRNAME))
+    shutil.copy(os.path.join(entry_dir(entry.get('key')), WORKBOOK_FILENAME), excel_path)
+
+
+def evict(maxsize = DEFAULT_SIZE):
+    entries = sorted(
+        glob(os.path.join(RESULT_CACHE_DIR, '*', ENTRY_FILENAME)),
+        key = lambda p: os.path.getmtime(p) if os.path.exists(p) else 0
+    )
+    for path in entries[:max(len(entries) - maxsize, 0)]:
+        shutil.rmtree(os.path.dirname(path), ignore_errors = True)
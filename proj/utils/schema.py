@@ -0,0 +1,210 @@
+import os, time
+from threading import Lock
+from pandas import read_sql, concat
+from flask import current_app, has_app_context
+
+# Schema catalog
+# One upload used to query information_schema dozens of times - fetch_meta for every table (three separate times),
+#   the primary key twice per table, the foreign keys in checkLookUpLists and fix_case, strip_whitespace and match each had their own query etc
+# The catalog loads the columns, primary keys and foreign keys of all the tbl_, analysis_ and lu_ tables in three queries,
+#   and everything else reads from that
+# It is cached per process (per database) for SCHEMA_CACHE_TTL seconds (default 300)
+# If the schema gets changed, the cache can be cleared with invalidate_catalog() (the admin route /schema/refresh does this)
+
+# Which tables get loaded up front. Any other table gets loaded the first time it is asked for
+CATALOG_TABLES_FILTER = """
+    (
+        ({alias}table_name LIKE 'tbl_%%')
+        OR ({alias}table_name LIKE 'analysis_%%')
+        OR ({alias}table_name LIKE 'lu_%%')
+        OR ({alias}table_name = '{toxsummary}')
+    )
+"""
+
+DEFAULT_TTL = 300
+
+# invalidate_catalog touches this file, and every process reloads its catalog if it was loaded before the file was last touched
+# That way clearing the cache in one uwsgi worker clears it in all of them
+INVALIDATED_MARKER = os.path.join(os.getcwd(), "files", ".schema_invalidated")
+
+
+def invalidated_at():
+    try:
+        return os.path.getmtime(INVALIDATED_MARKER)
+    except OSError:
+        return 0
+
+
+class SchemaCatalog:
+    def __init__(self, eng, toxsummary_tablename = None):
+        self.toxsummary_tablename = toxsummary_tablename
+        self.loaded_at = time.time()
+        self._columns, self._pkeys, self._fkeys = self._load(
+            eng,
+            lambda alias: CATALOG_TABLES_FILTER.format(alias = alias, toxsummary = toxsummary_tablename)
+        )
+        self._eng = eng
+        self._lock = Lock()
+        # tables that were asked for but do not exist, so we dont keep querying for them
+        self._missing = set()
+
+    def _load(self, eng, where):
+        # where is a function that takes the alias of the table with the table_name column, and returns the condition for the WHERE clause
+        columns = read_sql(
+            f"""
+            SELECT
+                table_name,
+                column_name,
+                ordinal_position,
+                is_nullable,
+                data_type,
+                udt_name,
+                character_maximum_length,
+                numeric_precision,
+                numeric_scale,
+                column_default
+            FROM
+                information_schema.columns
+            WHERE
+                {where('')}
+            ORDER BY table_name, ordinal_position;
+            """,
+            eng
+        )
+
+        # same query get_primary_key used to run, just for all the tables at once
+        pkeys = read_sql(
+            f"""
+            SELECT
+                tc.table_name,
+                c.column_name,
+                c.data_type
+            FROM information_schema.table_constraints tc
+            JOIN information_schema.constraint_column_usage AS ccu USING (constraint_schema, constraint_name)
+            JOIN information_schema.columns AS c ON c.table_schema = tc.constraint_schema
+                AND tc.table_name = c.table_name AND ccu.column_name = c.column_name
+            WHERE constraint_type = 'PRIMARY KEY' AND {where('tc.')}
+            ORDER BY tc.table_name, c.ordinal_position;
+            """,
+            eng
+        )
+
+        # foreign keys that point to lookup lists, along with the datatype of the lookup list column (fix_case needs that)
+        fkeys = read_sql(
+            f"""
+            SELECT DISTINCT
+                tc.table_name,
+                kcu.column_name,
+                ccu.table_name AS foreign_table_name,
+                ccu.column_name AS foreign_column_name,
+                isc.data_type AS foreign_data_type
+            FROM
+                information_schema.table_constraints AS tc
+                JOIN information_schema.key_column_usage AS kcu
+                ON tc.constraint_name = kcu.constraint_name
+                AND tc.table_schema = kcu.table_schema
+                JOIN information_schema.constraint_column_usage AS ccu
+                ON ccu.constraint_name = tc.constraint_name
+                AND ccu.table_schema = tc.table_schema
+                LEFT JOIN information_schema.columns as isc
+                ON isc.column_name = ccu.column_name
+                AND isc.table_name = ccu.table_name
+                AND isc.table_schema = ccu.table_schema
+            WHERE tc.constraint_type = 'FOREIGN KEY'
+            AND ccu.table_name LIKE 'lu_%%'
+            AND {where('tc.')};
+            """,
+            eng
+        )
+
+        return columns, pkeys, fkeys
+
+    def _ensure(self, tablename):
+        # Load a table that is not in the catalog yet (for example a table that does not follow the naming conventions)
+        if tablename in self._tablenames():
+            return
+        with self._lock:
+            if tablename in self._tablenames():
+                return
+            escaped = str(tablename).replace("'", "''")
+            columns, pkeys, fkeys = self._load(self._eng, lambda alias: f"{alias}table_name = '{escaped}'")
+            self._columns = concat([self._columns, columns], ignore_index = True)
+            self._pkeys = concat([self._pkeys, pkeys], ignore_index = True)
+            self._fkeys = concat([self._fkeys, fkeys], ignore_index = True)
+            if columns.empty:
+                self._missing.add(tablename)
+
+    def _tablenames(self):
+        return set(self._columns.table_name.unique()).union(self._missing)
+
+    def tables(self, prefixes = None):
+        '''the tables in the catalog, optionally only the ones starting with one of the prefixes'''
+        tables = sorted(self._columns.table_name.unique())
+        if prefixes is not None:
+            tables = [t for t in tables if t.startswith(tuple(prefixes))]
+        return tables
+
+    def all_columns(self):
+        '''column information of every table in the catalog'''
+        return self._columns.copy()
+
+    def columns(self, tablename):
+        '''column information of the table, one row per column - a copy, so callers can modify it'''
+        self._ensure(tablename)
+        return self._columns[self._columns.table_name == tablename].reset_index(drop = True).copy()
+
+    def column_names(self, tablename):
+        return self.columns(tablename).column_name.tolist()
+
+    def primary_key(self, tablename):
+        self._ensure(tablename)
+        return self._pkeys[self._pkeys.table_name == tablename].column_name.tolist()
+
+    def foreign_keys(self, tablename):
+        '''the lookup list foreign keys of the table - column_name, foreign_table_name, foreign_column_name, foreign_data_type'''
+        self._ensure(tablename)
+        return self._fkeys[self._fkeys.table_name == tablename].drop('table_name', axis = 1).reset_index(drop = True).copy()
+
+
+
+# The catalogs are kept per database url, since the app and the query blueprint do not always point at the same database
+_catalogs = dict()
+_catalogs_lock = Lock()
+
+
+def get_catalog(eng):
+    ttl = DEFAULT_TTL
+    toxsummary_tablename = None
+    if has_app_context():
+        ttl = float(current_app.config.get('SCHEMA_CACHE_TTL', DEFAULT_TTL))
+        toxsummary_tablename = current_app.config.get("TOXSUMMARY_TABLENAME")
+
+    key = str(eng.url)
+    def stale(catalog):
+        return (catalog is None) or (time.time() - catalog.loaded_at > ttl) or (catalog.loaded_at < invalidated_at())
+
+    catalog = _catalogs.get(key)
+    if stale(catalog):
+        with _catalogs_lock:
+            catalog = _catalogs.get(key)
+            if stale(catalog):
+                print("Loading schema catalog")
+                catalog = SchemaCatalog(eng, toxsummary_tablename)
+                _catalogs[key] = catalog
+
+    # tables outside of the catalog get loaded with the engine of whoever asks for them
+    catalog._eng = eng
+    return catalog
+
+
+def invalidate_catalog(eng = None):
+    '''clears the cached catalog of that database, or all of them if eng is None'''
+    with _catalogs_lock:
+        if eng is None:
+            _catalogs.clear()
+            # let the other processes know too
+            os.makedirs(os.path.dirname(INVALIDATED_MARKER), exist_ok = True)
+            with open(INVALIDATED_MARKER, 'w') as f:
+                f.write(str(time.time()))
+        else:
+            _catalogs.pop(str(eng.url), None)
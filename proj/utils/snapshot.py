@@ -0,0 +1,171 @@
+import os, json
+from hashlib import sha256
+from pandas import read_pickle
+
+# The snapshot is the canonical copy of the submission's data, as it was checked
+# It is written once in the upload routine (after preprocessing), and read back by the final submit routine
+#   this way we do not have to write the data back to excel and re-parse it just to be sure the checked data and the loaded data are the same
+
+# NOTE pickle is used rather than parquet on purpose.
+#   Before core checks run, a column may hold a mix of types (numbers and strings in a numeric column, for example)
+#   Those values are exactly what the datatype checks need to see, and parquet/arrow can not store a mixed object column as is
+#   The dataframes are also only ever read back by this application, in the same environment that wrote them
+
+SNAPSHOT_DIRNAME = 'snapshot'
+MANIFEST_FILENAME = 'manifest.json'
+
+# The load snapshot is the data the way final submit loads it - timestamps converted, lowercase columns, warnings column tacked on
+# It is written at the end of the upload routine when there are no errors, so /load only has to verify it and copy it to the database
+# The files go in the same directory (prefixed with load_), so a new upload, which clears out the snapshot, clears these out too
+LOAD_MANIFEST_FILENAME = 'load_manifest.json'
+
+
+def snapshot_dir(submission_dir):
+    return os.path.join(submission_dir, SNAPSHOT_DIRNAME)
+
+
+def file_hash(path):
+    h = sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def read_manifest(submission_dir):
+    manifest_path = os.path.join(snapshot_dir(submission_dir), MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return {"tables": []}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def write_snapshot(all_dfs, submission_dir, replace = True):
+    '''
+    Writes one file per table into the snapshot directory of the submission along with a manifest
+    The manifest records the row count, columns, dtypes and a sha256 content hash of each table
+    If replace is False, the tables get added to the existing snapshot (for the analysis tables that are created by custom checks)
+    '''
+    outdir = snapshot_dir(submission_dir)
+    os.makedirs(outdir, exist_ok = True)
+
+    manifest = read_manifest(submission_dir) if not replace else {"tables": []}
+
+    # start fresh if we are replacing, so a re-upload does not leave behind tables from the last upload
+    if replace:
+        for f in os.listdir(outdir):
+            os.remove(os.path.join(outdir, f))
+
+    entries = {t.get('table'): t for t in manifest.get('tables')}
+    for tblname, df in all_dfs.items():
+        filename = f"{tblname}.pkl"
+        path = os.path.join(outdir, filename)
+        df.to_pickle(path)
+
+        entries[tblname] = {
+            "table"    : tblname,
+            "filename" : filename,
+            "rows"     : len(df),
+            "columns"  : [str(c) for c in df.columns],
+            "dtypes"   : [str(t) for t in df.dtypes],
+            "sha256"   : file_hash(path)
+        }
+
+    manifest = {"tables": list(entries.values())}
+    with open(os.path.join(outdir, MANIFEST_FILENAME), 'w') as f:
+        json.dump(manifest, f)
+
+    return manifest
+
+
+def read_snapshot(submission_dir, tables = None, verify = True):
+    '''
+    Reads the snapshot back into a dictionary of dataframes, keyed by table name, in the order they were written
+    If verify is True, the content hash of each file is checked against the manifest before it is read
+    '''
+    manifest = read_manifest(submission_dir)
+    assert len(manifest.get('tables')) > 0, f"No snapshot found in {submission_dir}"
+
+    all_dfs = dict()
+    for entry in manifest.get('tables'):
+        if (tables is not None) and (entry.get('table') not in tables):
+            continue
+
+        path = os.path.join(snapshot_dir(submission_dir), entry.get('filename'))
+        if verify:
+            assert file_hash(path) == entry.get('sha256'), \
+                f"Snapshot of {entry.get('table')} does not match the hash in the manifest - it was modified after it was checked"
+
+        df = read_pickle(path)
+        assert len(df) == entry.get('rows'), f"Snapshot of {entry.get('table')} has {len(df)} rows but the manifest says {entry.get('rows')}"
+        all_dfs[entry.get('table')] = df
+
+    return all_dfs
+
+
+def read_load_manifest(submission_dir):
+    manifest_path = os.path.join(snapshot_dir(submission_dir), LOAD_MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def write_load_snapshot(all_dfs, submission_dir, order):
+    '''
+    Writes the load ready tables in the order they get loaded, and the load manifest
+    Each table records the hash of the snapshot it was made from, so /load can tell if it is out of date
+    '''
+    outdir = snapshot_dir(submission_dir)
+    source = {t.get('table'): t.get('sha256') for t in read_manifest(submission_dir).get('tables')}
+
+    entries = []
+    for tblname in order:
+        df = all_dfs[tblname]
+        filename = f"load_{tblname}.pkl"
+        path = os.path.join(outdir, filename)
+        df.to_pickle(path)
+
+        entries.append({
+            "table"    : tblname,
+            "filename" : filename,
+            "rows"     : len(df),
+            "columns"  : [str(c) for c in df.columns],
+            "sha256"   : file_hash(path),
+            "source"   : source.get(tblname)
+        })
+
+    manifest = {"order": list(order), "tables": entries}
+    with open(os.path.join(outdir, LOAD_MANIFEST_FILENAME), 'w') as f:
+        json.dump(manifest, f)
+
+    return manifest
+
+
+def read_load_snapshot(submission_dir):
+    '''
+    Reads the load ready tables back, in the order they get loaded, or gives back None if there is no load snapshot,
+    or it was not made from the snapshot that is there now
+    The content hash and row count of each table get checked against the load manifest
+    '''
+    manifest = read_load_manifest(submission_dir)
+    if manifest is None:
+        return None
+
+    source = {t.get('table'): t.get('sha256') for t in read_manifest(submission_dir).get('tables')}
+    if (set(manifest.get('order')) != set(source.keys())) or \
+        any(entry.get('source') != source.get(entry.get('table')) for entry in manifest.get('tables')):
+        print("The load snapshot was not made from the current snapshot")
+        return None
+
+    all_dfs = dict()
+    for entry in manifest.get('tables'):
+        path = os.path.join(snapshot_dir(submission_dir), entry.get('filename'))
+        assert file_hash(path) == entry.get('sha256'), \
+            f"Load snapshot of {entry.get('table')} does not match the hash in the manifest - it was modified after it was checked"
+
+        df = read_pickle(path)
+        assert len(df) == entry.get('rows'), f"Load snapshot of {entry.get('table')} has {len(df)} rows but the manifest says {entry.get('rows')}"
+        all_dfs[entry.get('table')] = df
+
+    return all_dfs
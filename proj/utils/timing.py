@@ -0,0 +1,120 @@
+import os, json, time, tracemalloc
+from glob import glob
+from contextlib import contextmanager
+from flask import g, has_app_context, current_app
+
+# Timing spans
+# Wrap a stage of the pipeline in a span and it records wall time, cpu time, row counts and (optionally) peak memory
+#   with span("match"):
+#       match_dataset, match_report, all_dfs = match(all_dfs)
+# The spans of a check job are collected in g.spans, and written to timings.json in the submission directory (next to errors.json)
+# The admin route /timings aggregates those files across submissions
+# If there is no app context, or spans were not started with start_spans, the code inside the span still runs - nothing gets recorded
+
+TIMINGS_FILENAME = 'timings.json'
+
+
+def start_spans():
+    g.spans = []
+    g.span_stack = []
+
+    # tracemalloc slows everything down quite a bit, so it is only turned on if the app is configured for it
+    # Also note that it traces the whole process, so if two jobs run at once, the peak memory of one will include the other
+    if str(current_app.config.get('TRACE_MEMORY')) == 'True' and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+@contextmanager
+def span(name, table = None, rows = None, **tags):
+    if not has_app_context() or g.get('spans') is None:
+        # still give back a record, so code that sets the row count inside the span does not have to check
+        yield dict()
+        return
+
+    stack = g.span_stack
+    tracing = tracemalloc.is_tracing()
+
+    # tracemalloc only keeps one peak for the whole process, so it gets reset at the start of each span
+    # Before resetting it, hand the peak so far to the enclosing span so it does not lose it
+    if tracing:
+        if len(stack) > 0:
+            stack[-1]['peak'] = max(stack[-1]['peak'], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+
+    record = {
+        "name"    : name,
+        "table"   : table,
+        "rows"    : rows,
+        "depth"   : len(stack),
+        "started" : time.time(),
+        **tags
+    }
+    frame = {"peak": 0}
+    stack.append(frame)
+
+    wall_start = time.perf_counter()
+    # The pipeline runs in a thread of the check job pool, so we want the cpu time of this thread, not the whole process
+    cpu_start = time.thread_time()
+    try:
+        yield record
+    finally:
+        record['wall'] = round(time.perf_counter() - wall_start, 4)
+        record['cpu'] = round(time.thread_time() - cpu_start, 4)
+
+        stack.pop()
+        if tracing:
+            peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+            record['peak_mb'] = round(peak / 1024 / 1024, 2)
+            if len(stack) > 0:
+                stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+        else:
+            record['peak_mb'] = None
+
+        g.spans.append(record)
+
+
+def add_span(name, wall, cpu, table = None, rows = None, **tags):
+    '''
+    records a span that was timed somewhere else - the custom check scheduler times the checks in its own threads,
+    which do not have the g of the check job (see custom/registry.py)
+    It goes in as a child of the span that is open right now
+    '''
+    if not has_app_context() or g.get('spans') is None:
+        return
+    g.spans.append({
+        "name"    : name,
+        "table"   : table,
+        "rows"    : rows,
+        "depth"   : len(g.span_stack),
+        "started" : time.time() - wall,
+        **tags,
+        "wall"    : round(wall, 4),
+        "cpu"     : round(cpu, 4),
+        "peak_mb" : None
+    })
+
+
+def write_timings(submission_dir, **info):
+    '''writes the spans collected so far to timings.json in the submission directory, along with whatever info is passed (submissionid, datatype etc)'''
+    if not has_app_context() or g.get('spans') is None:
+        return
+    with open(os.path.join(submission_dir, TIMINGS_FILENAME), 'w') as f:
+        json.dump({**info, "spans": g.spans}, f, default = str)
+
+
+def read_timings(files_dir):
+    '''reads the timings.json files of all submissions in the files directory, one record per span'''
+    records = []
+    for path in glob(os.path.join(files_dir, '*', TIMINGS_FILENAME)):
+        try:
+            with open(path, 'r') as f:
+                timings = json.load(f)
+        except Exception as e:
+            print(f"Unable to read {path}")
+            print(e)
+            continue
+
+        info = {k: v for k, v in timings.items() if k != 'spans'}
+        records.extend([{**info, **s} for s in timings.get('spans', [])])
+
+    return records
@@ -0,0 +1,10 @@
+import os, sys, types
+
+# proj/__init__.py builds the whole app - it reads the config, connects to the database and registers every blueprint
+# The tests only need the modules, so proj gets registered as a plain package and its __init__.py does not run
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if 'proj' not in sys.modules:
+    proj = types.ModuleType('proj')
+    proj.__path__ = [os.path.join(ROOT, 'proj')]
+    sys.modules['proj'] = proj
@@ -0,0 +1,96 @@
+import csv
+from io import StringIO
+import numpy as np
+import pandas as pd
+import pytest
+from pandas import isnull
+
+from proj.utils.db import copy_csv, copy_value, sde_function
+
+
+# to_geodb used to write every value into one INSERT statement, and now it sends them through COPY (see utils/db.py)
+# There is no database here, so both ends get worked out the way postgres would see them
+#   - the INSERT: NULL, a quoted string (with '' for a quote, and %% for a % since the statement went through the driver), or an sde function
+#   - COPY: csv, where an empty value is NULL (FORCE_NULL), and a line that is just \. would end the data
+
+def old_literal(val):
+    # how the old to_geodb wrote a value into the INSERT statement
+    return (
+        'NULL'
+        if ( (str(val).strip() == '') or (isnull(val)) )
+        else str(val).strip()
+        if ( ("sde.next_" in str(val)) )
+        else "'{}'".format(str(val).strip().replace("'","''"))
+    ).replace("%", "%%")
+
+
+def insert_value(literal):
+    # what postgres got from the old INSERT statement
+    literal = literal.replace("%%", "%")
+    if literal == 'NULL':
+        return None
+    if literal.startswith("'"):
+        return literal[1:-1].replace("''", "'")
+    return ('function', literal)
+
+
+def copy_rows(df, columns):
+    buffer = copy_csv(df, columns)
+    text = buffer.getvalue()
+    assert '\\.' not in text.split('\n'), "a line with just \\. would end the COPY"
+    return [[v if v != '' else None for v in row] for row in csv.reader(StringIO(text, newline = ''))]
+
+
+VALUES = pd.Series([
+    None, np.nan, pd.NaT, '', '   ', 'plain', '  padded  ', "O'Brien", "''", '"quoted"', '50% recovery', '%%', '100%',
+    'a,b', 'line\nbreak', 'cr\rhere', '\\.', '\\N', 'NULL', 'tab\there', 'ünïcödé',
+    0, -1, 8001, 1.5, 8001.0, -0.0, 1e20, True, False, np.int64(3), np.float64(2.25),
+    pd.Timestamp('2023-07-01'), pd.Timestamp('2023-07-01 08:30:15.5'),
+], dtype = object)
+
+
+def expected_values(series):
+    out = []
+    for val in series:
+        v = insert_value(old_literal(val))
+        assert not isinstance(v, tuple)
+        out.append(v)
+    return out
+
+
+def test_copy_matches_insert_values():
+    df = pd.DataFrame({"value": VALUES, "other": VALUES[::-1].values})
+    rows = copy_rows(df, ["value", "other"])
+    assert [r[0] for r in rows] == expected_values(df['value'])
+    assert [r[1] for r in rows] == expected_values(df['other'])
+
+
+def test_copy_matches_insert_values_one_column():
+    # one column is where \. could be a line on its own
+    df = pd.DataFrame({"value": VALUES})
+    rows = copy_rows(df, ["value"])
+    assert [r[0] for r in rows] == expected_values(df['value'])
+
+
+def test_copy_value_typed_columns():
+    df = pd.DataFrame({
+        "result"     : [1.5, np.nan, 8001.0, -88.0],
+        "replicate"  : pd.Series([1, None, 3, 4], dtype = 'Int64'),
+        "sampledate" : pd.to_datetime(['2023-07-01', None, '2023-07-02 13:45:00', '2023-09-30']),
+        "flag"       : [True, False, True, False],
+    })
+    for col in df.columns:
+        assert [copy_value(v) for v in df[col].tolist()] == expected_values(df[col])
+
+
+def test_sde_function_columns():
+    objectid = pd.Series(["sde.next_rowid('sde','tbl_chemresults')"] * 3, name = 'objectid')
+    globalid = pd.Series([" sde.next_globalid() "] * 3, name = 'globalid')
+    # the INSERT called the function for each row, the INSERT ... SELECT does too
+    assert sde_function(objectid) == insert_value(old_literal(objectid[0]))[1]
+    assert sde_function(globalid) == insert_value(old_literal(globalid[0]))[1]
+
+    assert sde_function(pd.Series(['B23-12000', 'sde.next_globalid()'])) is None
+    assert sde_function(pd.Series([1, 2, 3])) is None
+    with pytest.raises(AssertionError):
+        sde_function(pd.Series(['sde.next_globalid()', 'something else'], name = 'globalid'))
@@ -0,0 +1,144 @@
+import datetime
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+from flask import Flask, g
+
+# importing proj.custom imports every dataset module, and those need the geometry and stats packages
+for package in ('arcgis', 'shapely', 'pyproj', 'scipy'):
+    pytest.importorskip(package)
+
+from proj.custom.functions import checkData
+from proj.custom.infauna_reid_custom import infauna_reid
+
+
+# infauna_reid used to be one function that ran its checks one after the other, now each check is registered on its own (see registry.py)
+# This is the old function (minus the prints), to make sure run_registered gives back exactly what it did
+
+def old_infauna_reid(all_dfs, eng):
+    errs = []
+    warnings = []
+
+    infaunalabundance_reid = all_dfs['tbl_infaunalabundance_reid']
+    infaunalabundance_reid = infaunalabundance_reid.assign(tmp_row = infaunalabundance_reid.index)
+    infaunalabundance_reid['sampletime'] = infaunalabundance_reid['sampletime'].astype(str)
+
+    time_format = re.compile(r'\d{2}:\d{2}:\d{2}')
+    badrows = infaunalabundance_reid[~infaunalabundance_reid.sampletime.str.match(time_format)].tmp_row.tolist()
+    errs = [*errs, checkData(
+        dataframe = infaunalabundance_reid, tablename = 'tbl_infaunalabundance_reid', badrows = badrows, badcolumn = "sampletime",
+        error_type = "Logic Error", is_core_error = False, error_message = "SampleTime is not in correct format. Please use the format hh:mm:ss."
+    )]
+
+    grab_event_sql = "SELECT stationid, sampledate, benthicinfauna FROM tbl_grabevent WHERE benthicinfauna = 'Yes' ;"
+    grab_infauna_records = eng.execute(grab_event_sql)
+    gdf = pd.DataFrame(grab_infauna_records.fetchall())
+    gdf.columns = grab_infauna_records.keys()
+    badrows = infaunalabundance_reid[
+        ~((infaunalabundance_reid.stationid.isin(gdf.stationid.tolist())) &
+        (infaunalabundance_reid.sampledate.isin(gdf.sampledate.tolist())))
+    ].tmp_row.tolist()
+    errs = [*errs, checkData(
+        dataframe = infaunalabundance_reid, tablename = 'tbl_infaunalabundance_reid', badrows = badrows, badcolumn = "stationid",
+        error_type = "Logic Error", is_core_error = False, error_message = "There is no corresponding Sediment Grab Event record (Based on StationID and SampleDate)."
+    )]
+
+    badrows = infaunalabundance_reid[
+        (infaunalabundance_reid.taxon == 'NoOrganismsPresent')&(infaunalabundance_reid.abundance != 0)
+    ].tmp_row.tolist()
+    errs = [*errs, checkData(
+        dataframe = infaunalabundance_reid, tablename = 'tbl_infaunalabundance_reid', badrows = badrows, badcolumn = "abundance",
+        error_type = "Undefined Error", is_core_error = False, error_message = "If Taxon = NoOrganismsPresent, Then abundance should equal 0."
+    )]
+
+    badrows = infaunalabundance_reid[(infaunalabundance_reid.abundance < 1)].tmp_row.tolist()
+    errs = [*errs, checkData(
+        dataframe = infaunalabundance_reid, tablename = 'tbl_infaunalabundance_reid', badrows = badrows, badcolumn = "abundance",
+        error_type = "Undefined Error", is_core_error = False, error_message = "Abundance should be 1 or greater."
+    )]
+
+    return {'errors': errs, 'warnings': warnings}
+
+
+# what eng.execute gives back for the tbl_grabevent query
+class FakeResult:
+    def __init__(self, rows, keys):
+        self.rows, self._keys = rows, keys
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def keys(self):
+        return self._keys
+
+
+class FakeEngine:
+    def __init__(self):
+        self.queries = []
+
+    def execute(self, sql):
+        self.queries.append(sql)
+        assert 'tbl_grabevent' in sql
+        return FakeResult(
+            [('B23-10001', pd.Timestamp('2023-07-10'), 'Yes'), ('B23-10002', pd.Timestamp('2023-07-11'), 'Yes')],
+            ['stationid', 'sampledate', 'benthicinfauna']
+        )
+
+
+def submission():
+    df = pd.DataFrame({
+        "stationid"  : ['B23-10001', 'B23-10001', 'B23-10002', 'B23-10003', 'B23-10002', 'B23-10001'],
+        "sampledate" : pd.to_datetime(['2023-07-10', '2023-07-10', '2023-07-11', '2023-07-11', '2023-07-12', '2023-07-10']),
+        "sampletime" : ['08:30:00', '8:30', datetime.time(9, 15), '09:15:00', None, '10:00:00'],
+        "taxon"      : ['Capitella', 'NoOrganismsPresent', 'NoOrganismsPresent', 'Capitella', 'Capitella', 'Capitella'],
+        "abundance"  : [3, 0, 2, -88, 1, 0],
+    })
+    # the rows that get flagged come from the index
+    df.index = df.index + 2
+    return {"tbl_infaunalabundance_reid": df}
+
+
+@pytest.fixture
+def app():
+    app = Flask('test_custom_registry')
+    app.secret_key = 'test'
+    app.datasets = {"infauna_reid": {"tables": ["tbl_infaunalabundance_reid"]}}
+    return app
+
+
+def run(app, all_dfs, workers):
+    app.config['CUSTOM_CHECK_WORKERS'] = workers
+    with app.test_request_context():
+        g.eng = FakeEngine()
+        result = infauna_reid(all_dfs)
+        return result, g.eng.queries
+
+
+@pytest.mark.parametrize("workers", [0, 4])
+def test_infauna_reid_matches_old_function(app, workers):
+    all_dfs = submission()
+    expected = old_infauna_reid(submission(), FakeEngine())
+    assert all(len(e) > 0 for e in expected['errors'])
+
+    result, queries = run(app, all_dfs, workers)
+    assert result == expected
+    # the grab events are a shared input, so they are only queried once
+    assert len(queries) == 1
+    # and the submitted table was left alone
+    assert all_dfs['tbl_infaunalabundance_reid'].equals(submission()['tbl_infaunalabundance_reid'])
+
+
+@pytest.mark.parametrize("workers", [0, 4])
+def test_missing_column_skips_the_check(app, workers):
+    # the old function fell over when a column was missing, now just the checks that need it are skipped
+    all_dfs = submission()
+    all_dfs['tbl_infaunalabundance_reid'] = all_dfs['tbl_infaunalabundance_reid'].drop(columns = ['taxon'])
+    with pytest.raises(AttributeError):
+        old_infauna_reid(all_dfs, FakeEngine())
+
+    expected = old_infauna_reid(submission(), FakeEngine())['errors']
+    result, _ = run(app, all_dfs, workers)
+    # everything but the NoOrganismsPresent check
+    assert result == {'errors': expected[:2] + expected[3:], 'warnings': []}
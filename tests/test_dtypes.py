@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from proj.core.functions import convert_dtype, invalid_dtype_mask, checkData
+from proj.core.metadata import checkDataTypes
+
+
+# checkDataTypes used to apply convert_dtype to every value, now it flags a whole column at a time with invalid_dtype_mask
+# These make sure it still flags exactly the same values
+
+SERIES = {
+    "float64"         : pd.Series([1.0, 2.5, np.nan, -3.0, 1e16, 1e20, 0.0, -0.5]),
+    "integral float64": pd.Series([8001.0, 8002.0, -1.0, 0.0]),
+    "int64"           : pd.Series([1, -2, 3, 12345678901234], dtype = 'int64'),
+    "Int64"           : pd.Series([1, None, 3], dtype = 'Int64'),
+    "bool"            : pd.Series([True, False, True]),
+    "datetime64"      : pd.to_datetime(pd.Series(["2023-07-01", "2023-07-02 13:45:10.5", None])),
+    "float32"         : pd.Series([1.0, 2.5, np.nan], dtype = 'float32'),
+    "object"          : pd.Series([
+        "1", "1.0", "1.00", "-2", "+3", "1.5", " 3 ", "3 ", "1_000", "abc", "", "1e5", "1E-2", ".5", "5.", "-", "--1",
+        "inf", "-inf", "nan", "NaN", "Infinity", "١٢٣",
+        None, np.nan, pd.NaT,
+        0, 7, -7, np.int64(4), np.int32(5),
+        1.0, 2.5, -3.0, np.float64(6.0), np.float64(6.5), 1e16, 1e20, float('inf'), float('nan'),
+        True, False, np.bool_(True),
+        pd.Timestamp("2023-07-01"), pd.Timestamp("2023-07-01 08:30:00"),
+        "2023-07-01", "2023-7-1", "2023-07-01 08:30:00", "2023-07-01 8:30:00", "2023-07-01 08:30:00.123", "2023-07-01T08:30:00",
+        "7/1/2023", "2023-07-01 08:30", "January 8 00:00:00 1999",
+        [1], {"a": 1}
+    ], dtype = object),
+}
+
+DTYPES = [int, float, pd.Timestamp, str, None]
+
+
+def reference_mask(series, t):
+    # what checkDataTypes used to do
+    return series.apply(lambda x: not convert_dtype.__wrapped__(t, x)).astype(bool)
+
+
+@pytest.mark.parametrize("name", SERIES.keys())
+@pytest.mark.parametrize("t", DTYPES, ids = lambda t: getattr(t, '__name__', str(t)))
+def test_invalid_dtype_mask_matches_convert_dtype(name, t):
+    series = SERIES[name]
+    expected = reference_mask(series, t)
+    result = invalid_dtype_mask(series, t)
+    assert result.index.equals(series.index)
+    mismatched = [repr(v) for v, r, e in zip(series, result, expected) if bool(r) != bool(e)]
+    assert mismatched == []
+
+
+def test_invalid_dtype_mask_non_unique_index():
+    series = SERIES['object'].copy()
+    series.index = [0] * len(series)
+    for t in DTYPES:
+        assert invalid_dtype_mask(series, t).tolist() == reference_mask(series.reset_index(drop = True), t).tolist()
+
+
+# checkDataTypes as it was, with the system fields passed in instead of read from current_app
+def reference_checkDataTypes(dataframe, tablename, meta, system_fields):
+    ret = []
+    for col in dataframe.columns:
+        if col not in system_fields:
+            dtype = meta.iloc[meta[meta.column_name == col].index, meta.columns.get_loc("dtype")].values[0]
+            human_dtype = meta.iloc[meta[meta.column_name == col].index, meta.columns.get_loc("data_type")].values[0]
+            ret.append(
+                checkData(
+                    dataframe = dataframe,
+                    tablename = tablename,
+                    badrows = dataframe[dataframe[col].apply(lambda x: not convert_dtype(dtype, x))].index.tolist(),
+                    badcolumn = col,
+                    error_type = "Invalid Datatype",
+                    is_core_error = True,
+                    error_message = f'''The value here is not valid for the datatype "{human_dtype}"'''
+                )
+            )
+    return ret
+
+
+@pytest.mark.parametrize("index", [None, "shifted", "duplicated"])
+def test_checkDataTypes_matches_old_version(index):
+    # the lru_cache on convert_dtype could not take lists and dicts, so the old version crashed on those
+    values = SERIES['object'][SERIES['object'].map(lambda x: not isinstance(x, (list, dict)))].reset_index(drop = True)
+    n = len(values)
+    df = pd.DataFrame({
+        "stationid"  : values.astype(str),
+        "replicate"  : values,
+        "result"     : values,
+        "sampledate" : values,
+        "depth"      : np.linspace(0, 10, n),
+        "abundance"  : np.arange(n) * 1.5,
+        "objectid"   : values,
+    })
+    if index == "shifted":
+        df.index = df.index + 5
+    elif index == "duplicated":
+        df.index = [i // 2 for i in range(n)]
+
+    meta = pd.DataFrame({
+        "column_name" : ["stationid", "replicate", "result", "sampledate", "depth", "abundance", "objectid"],
+        "dtype"       : [str, int, float, pd.Timestamp, float, int, int],
+        "data_type"   : ["character varying", "integer", "numeric", "timestamp without time zone", "numeric", "integer", "integer"],
+    })
+    system_fields = ["objectid"]
+
+    expected = reference_checkDataTypes(df, "tbl_test", meta, system_fields)
+    result = checkDataTypes(df, "tbl_test", None, meta, context = {"system_fields": system_fields})
+    assert result == expected
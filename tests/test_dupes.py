@@ -0,0 +1,141 @@
+import csv
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from proj.core import dupes
+
+
+# existing_keys copies the keys of the submission into a temp table (COPY, csv) and joins it with the table in the database
+# There is no database here, so the cursor below reads the COPY data the way postgres would (an empty value is NULL with FORCE_NULL)
+# and answers the join from the keys that are "already in the table"
+
+KEYS = ['stationid', 'sampleid', 'replicate']
+
+CATALOG = pd.DataFrame({
+    "column_name" : ['stationid', 'sampleid', 'replicate', 'result'],
+    "udt_name"    : ['varchar', 'varchar', 'int4', 'numeric'],
+})
+
+
+def parse_copy(buffer):
+    text = buffer.read()
+    assert '\\.' not in text.split('\n'), "a line with just \\. would end the COPY"
+    for line in text.split('\n'):
+        # postgres only allows a carriage return inside a quoted value
+        if '\r' in line:
+            assert line.startswith('"'), "unquoted carriage return"
+    return [[v if v != '' else None for v in row] for row in csv.reader(StringIO(text, newline = ''))]
+
+
+class FakeCursor:
+    def __init__(self, existing, fail_copy = False):
+        self.existing = existing
+        self.fail_copy = fail_copy
+        self.rows = []
+        self.result = []
+
+    def execute(self, sql):
+        if 'SELECT t.checker_rownum' in sql:
+            self.result = [(int(r[0]),) for r in self.rows if tuple(r[1:]) in self.existing]
+
+    def copy_expert(self, sql, buffer):
+        assert 'FORCE_NULL' in sql
+        if self.fail_copy:
+            raise Exception('invalid input syntax for type integer')
+        self.rows = parse_copy(buffer)
+
+    def fetchall(self):
+        return self.result
+
+
+class FakeConnection:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def cursor(self):
+        return self._cursor
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeEngine:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def raw_connection(self):
+        return FakeConnection(self._cursor)
+
+
+class FakeCatalog:
+    def columns(self, tablename):
+        return CATALOG
+
+
+@pytest.fixture(autouse = True)
+def catalog(monkeypatch):
+    monkeypatch.setattr(dupes, 'get_catalog', lambda eng: FakeCatalog())
+
+
+def submission():
+    return pd.DataFrame({
+        "stationid" : ['B23-12000', 'line\r\nbreak', 'cr\ronly', 'a,b', 'say "hi"', "O'Brien", '\\.', ' padded ', None],
+        "sampleid"  : ['S1', 'S2', 'S3', 'S4', 'S5', 'S6', 'S7', 'S8', 'S9'],
+        "replicate" : [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0, 8.0, np.nan],
+        "result"    : np.arange(9) * 1.5,
+    }, index = np.arange(9) + 10)
+
+
+def test_keys_csv_round_trip():
+    keys = pd.DataFrame({
+        "checker_rownum" : range(6),
+        "stationid"      : ['line\nbreak', 'cr\rhere', 'a,b', 'say "hi"', None, '\\.'],
+        "replicate"      : pd.Series([1, 2, None, 4, 5, 6], dtype = 'Int64'),
+    })
+    rows = parse_copy(dupes.keys_csv(keys))
+    assert rows == [
+        ['0', 'line\nbreak', '1'],
+        ['1', 'cr\rhere', '2'],
+        ['2', 'a,b', None],
+        ['3', 'say "hi"', '4'],
+        ['4', None, '5'],
+        ['5', '\\.', '6'],
+    ]
+
+
+def test_existing_keys_with_special_characters():
+    existing = {
+        ('line\r\nbreak', 'S2', '2'),
+        ('cr\ronly', 'S3', '3'),
+        ('a,b', 'S4', '4'),
+        ('say "hi"', 'S5', '5'),
+        ('padded', 'S8', '8'),
+        ('B23-12000', 'S1', '2'),
+    }
+    cursor = FakeCursor(existing)
+    positions = dupes.existing_keys(submission(), 'tbl_test', KEYS, FakeEngine(cursor))
+    # the values get stripped like they always did, so ' padded ' is a duplicate of 'padded'
+    assert positions == [1, 2, 3, 4, 7]
+
+
+def test_failed_copy_falls_back_to_the_table_keys(monkeypatch):
+    # a failed COPY used to count as no duplicates
+    current = pd.DataFrame({
+        "stationid" : ['cr\ronly', 'a,b', 'B23-99999'],
+        "sampleid"  : ['S3', 'S4', 'S1'],
+        "replicate" : [3, 4, 1],
+    })
+    monkeypatch.setattr(dupes, 'read_sql', lambda sql, eng: current.copy())
+    positions = dupes.existing_keys(submission().iloc[:8], 'tbl_test', KEYS, FakeEngine(FakeCursor(set(), fail_copy = True)))
+    assert positions == [2, 3]
+
+
+def test_fallback_with_nothing_in_the_table(monkeypatch):
+    monkeypatch.setattr(dupes, 'read_sql', lambda sql, eng: pd.DataFrame(columns = KEYS))
+    assert dupes.existing_keys(submission(), 'tbl_test', KEYS, FakeEngine(FakeCursor(set(), fail_copy = True))) == []
@@ -0,0 +1,172 @@
+import os, shutil
+from math import floor
+
+import numpy as np
+import pandas as pd
+import pytest
+from flask import Flask, session
+from openpyxl import load_workbook
+from openpyxl.comments import Comment
+from openpyxl.styles import PatternFill
+
+from proj.utils.excel import mark_workbook
+
+
+# mark_workbook used to copy the excel file, load it into openpyxl and set the fill and comment of each flagged cell
+# Now it writes the marked file in one pass with xlsxwriter. This is the old one, to compare the two files cell by cell
+# (benchmarks/mark_workbook.py uses it too)
+
+def old_mark_workbook(all_dfs, excel_path, errs, warnings):
+    orig_filename = excel_path.rsplit('/', 1)[-1]
+    filename = orig_filename.rsplit('.',1)[0]
+    ext = orig_filename.rsplit('.',1)[-1]
+    marked_path = os.path.join(session.get('submission_dir'), f"{filename}-marked.{ext}")
+    shutil.copy(excel_path, marked_path)
+
+    errs = [e for e in errs if len(e) > 0]
+
+    errs_cells = dict()
+    for table in set([e.get('table') for e in errs]):
+        errs_cells[table] = [
+            {'row_index': r, 'column_index': all_dfs[table].columns.get_loc(str(col).strip().lower()), 'message': e.get('error_message')}
+            for e in errs for col in e.get('columns').split(',') for r in e.get('rows') if e.get('table') == table
+        ]
+
+    warnings_cells = dict()
+    for table in set([w.get('table') for w in warnings]):
+        warnings_cells[table] = [
+            {'row_index': r, 'column_index': all_dfs[table].columns.get_loc(str(col).strip().lower()), 'message': f"{w.get('error_message')} (Warning)"}
+            for w in warnings for col in w.get('columns').split(',') for r in w.get('rows') if w.get('table') == table
+        ]
+
+    redFill = PatternFill(start_color='FF8585', end_color='FF8585', fill_type='solid')
+    yellowFill = PatternFill(start_color='00FFFF00', end_color='00FFFF00', fill_type='solid')
+
+    def coordinate(coord):
+        colindex = coord.get('column_index')
+        return f"{chr(65 +  (floor(colindex/26) - 1)  ) if colindex >= 26 else ''}{chr(65 + (colindex % 26))}{int(coord.get('row_index'))}"
+
+    wb = load_workbook(marked_path)
+    for sheet in wb.sheetnames:
+        for coord in warnings_cells.get(sheet) or []:
+            wb[sheet][coordinate(coord)].fill = yellowFill
+            wb[sheet][coordinate(coord)].comment = Comment(coord.get('message'), "Checker")
+        for coord in errs_cells.get(sheet) or []:
+            wb[sheet][coordinate(coord)].fill = redFill
+            wb[sheet][coordinate(coord)].comment = Comment(coord.get('message'), "Checker")
+    wb.save(marked_path)
+    return marked_path
+
+
+def make_submission(path, n = 40, offset = 0):
+    '''the excel file the way the upload routine writes it, plus an analysis tab that a custom check appended'''
+    all_dfs = {
+        "tbl_chemresults": pd.DataFrame({
+            "stationid"  : [f"B23-{12000 + i}" for i in range(n)],
+            "sampledate" : pd.Timestamp('2023-07-01') + pd.to_timedelta(np.arange(n) % 5, unit = 'D'),
+            "result"     : np.where(np.arange(n) % 7 == 0, np.nan, np.arange(n) * 1.25),
+            "qualifier"  : [None if i % 3 else '=' for i in range(n)],
+            "units"      : ['ng/g dw'] * n,
+            "comments"   : ['=1+1', 'http://example.org', 'plain'] * (n // 3) + ['x'] * (n % 3),
+        }),
+        "tbl_grabevent": pd.DataFrame({
+            "stationid" : ['B23-12000', 'B23-12001'],
+            "depth"     : [10, 20],
+        }),
+    }
+    with pd.ExcelWriter(path, engine = 'xlsxwriter') as writer:
+        for tbl, df in all_dfs.items():
+            df.to_excel(writer, sheet_name = tbl, startrow = offset, index = False)
+    with pd.ExcelWriter(path, engine = 'openpyxl', mode = 'a') as writer:
+        pd.DataFrame({"analyte": ['Lead', 'Copper'], "mean": [1.5, 2.25], "n": [3, 4]}) \
+            .to_excel(writer, sheet_name = 'tox_summary_results', index = False)
+    return all_dfs
+
+
+def flags(offset, n = 40):
+    # rows are excel row numbers, like the errors that come out of the checks (correct_row_offset)
+    rows = [i + offset + 2 for i in range(n)]
+    errs = [
+        {"table": "tbl_chemresults", "rows": rows[::4], "columns": "result", "error_message": "bad result"},
+        {"table": "tbl_chemresults", "rows": rows[:10], "columns": "qualifier,units", "error_message": "missing qualifier"},
+        {},
+        {"table": "tbl_grabevent", "rows": [offset + 3], "columns": "depth", "error_message": "too deep"},
+    ]
+    warnings = [
+        {"table": "tbl_chemresults", "rows": rows[5:15], "columns": "result", "error_message": "high result"},
+        {"table": "tbl_chemresults", "rows": rows[-3:], "columns": "comments", "error_message": "check the comment"},
+    ]
+    return errs, warnings
+
+
+def read_cells(path):
+    '''{(sheet, coordinate): (value, fill color, comment)} of every cell with something in it'''
+    cells = dict()
+    wb = load_workbook(path)
+    for ws in wb:
+        for row in ws.iter_rows():
+            for c in row:
+                fill = c.fill.fgColor.rgb[-6:] if c.fill is not None and c.fill.fill_type == 'solid' else None
+                comment = c.comment.text if c.comment is not None else None
+                if (c.value is None) and (fill is None) and (comment is None):
+                    continue
+                cells[(ws.title, c.coordinate)] = (c.value, fill, comment)
+    return cells
+
+
+@pytest.fixture
+def request_context(tmp_path):
+    app = Flask('mark_workbook_test')
+    app.secret_key = 'test'
+    with app.test_request_context():
+        yield tmp_path
+
+
+@pytest.mark.parametrize("offset", [0, 1])
+def test_marks_match_old_version(request_context, offset):
+    tmp_path = request_context
+    excel_path = str(tmp_path / 'submission.xlsx')
+    all_dfs = make_submission(excel_path, offset = offset)
+    errs, warnings = flags(offset)
+
+    os.makedirs(tmp_path / 'old')
+    session['submission_dir'] = str(tmp_path / 'old')
+    old = read_cells(old_mark_workbook(all_dfs, excel_path, errs, warnings))
+
+    os.makedirs(tmp_path / 'new')
+    session['submission_dir'] = str(tmp_path / 'new')
+    new = read_cells(mark_workbook(all_dfs, excel_path, errs, warnings, startrow = offset))
+
+    assert new.keys() == old.keys()
+    for key in old.keys():
+        old_value, old_fill, old_comment = old[key]
+        new_value, new_fill, new_comment = new[key]
+        assert new_value == old_value, key
+        assert new_fill == old_fill, key
+        if old_comment is None:
+            assert new_comment is None, key
+        else:
+            # the old one kept the last message written to the cell (the errors went on after the warnings),
+            # the new one puts all the messages of the cell in the comment, errors first
+            assert old_comment in new_comment.split('\n'), key
+            if new_fill == 'FF8585':
+                assert not new_comment.split('\n')[0].endswith('(Warning)'), key
+
+    # the marked sheets and the analysis tab that gets passed through
+    assert any(k[0] == 'tbl_chemresults' and v[1] == 'FF8585' for k, v in new.items())
+    assert any(k[0] == 'tbl_chemresults' and v[1] == 'FFFF00' for k, v in new.items())
+    assert any(k[0] == 'tbl_grabevent' and v[1] == 'FF8585' for k, v in new.items())
+    assert [v for k, v in new.items() if k[0] == 'tox_summary_results'] == [v for k, v in old.items() if k[0] == 'tox_summary_results']
+    assert all(v[1] is None for k, v in new.items() if k[0] == 'tox_summary_results')
+
+
+def test_cell_with_error_and_warning(request_context):
+    tmp_path = request_context
+    excel_path = str(tmp_path / 'submission.xlsx')
+    all_dfs = make_submission(excel_path)
+    errs = [{"table": "tbl_chemresults", "rows": [7], "columns": "result", "error_message": "bad result"}]
+    warnings = [{"table": "tbl_chemresults", "rows": [7], "columns": "result", "error_message": "high result"}]
+
+    session['submission_dir'] = str(tmp_path)
+    cells = read_cells(mark_workbook(all_dfs, excel_path, errs, warnings))
+    assert cells[('tbl_chemresults', 'C7')][1:] == ('FF8585', "bad result\nhigh result (Warning)")
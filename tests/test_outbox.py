@@ -0,0 +1,191 @@
+import os, json, time, smtplib
+from email import message_from_string
+
+import pytest
+
+from proj.utils import outbox
+
+
+# The outbox gets tested against a stand in for smtplib.SMTP (aiosmtpd is not one of the dependencies)
+# FakeSMTP keeps every message it accepts, and can be told to turn messages down, drop the connection, or not connect at all
+
+class FakeSMTP:
+    delivered = []
+    connections = 0
+    # what goes wrong, in order, one item per message sent (None means it goes through)
+    failures = []
+    refuse_connection = False
+
+    def __init__(self, server, timeout = None):
+        if FakeSMTP.refuse_connection:
+            raise ConnectionRefusedError(f"connection to {server} refused")
+        FakeSMTP.connections += 1
+        self.server = server
+
+    def sendmail(self, send_from, send_to, msg):
+        failure = FakeSMTP.failures.pop(0) if FakeSMTP.failures else None
+        if failure is not None:
+            raise failure
+        FakeSMTP.delivered.append({"server": self.server, "from": send_from, "to": send_to, "message": message_from_string(msg)})
+
+    def quit(self):
+        pass
+
+
+@pytest.fixture
+def smtp(monkeypatch):
+    FakeSMTP.delivered = []
+    FakeSMTP.connections = 0
+    FakeSMTP.failures = []
+    FakeSMTP.refuse_connection = False
+    monkeypatch.setattr(outbox.smtplib, 'SMTP', FakeSMTP)
+    return FakeSMTP
+
+
+@pytest.fixture
+def outbox_dir(tmp_path):
+    return str(tmp_path / '.outbox')
+
+
+def listdir(outbox_dir, state):
+    path = os.path.join(outbox_dir, state)
+    return sorted(os.listdir(path)) if os.path.isdir(path) else []
+
+
+def read(outbox_dir, state, messageid):
+    return outbox.read_message(os.path.join(outbox_dir, state, messageid))
+
+
+def make_due(outbox_dir):
+    # instead of waiting out the backoff
+    for messageid in listdir(outbox_dir, 'pending'):
+        messagedir = os.path.join(outbox_dir, 'pending', messageid)
+        message = outbox.read_message(messagedir)
+        message['next_attempt'] = 0
+        outbox.write_message(messagedir, message)
+
+
+def test_enqueue_and_deliver(smtp, outbox_dir, tmp_path):
+    attachment = tmp_path / 'submission.xlsx'
+    attachment.write_bytes(b'not really an excel file')
+
+    messageid = outbox.enqueue('admin@checker.sccwrp.org', ['someone@sccwrp.org'], 'Successful Data Load', 'it loaded', filename = str(attachment), outbox_dir = outbox_dir)
+    assert listdir(outbox_dir, 'pending') == [messageid]
+    # the attachment gets its own copy, since the next upload can overwrite the original
+    assert os.path.exists(os.path.join(outbox_dir, 'pending', messageid, 'submission.xlsx'))
+    attachment.unlink()
+
+    assert outbox.deliver_due(outbox_dir = outbox_dir) == 1
+    assert listdir(outbox_dir, 'pending') == []
+    assert listdir(outbox_dir, 'sending') == []
+
+    [sent] = smtp.delivered
+    assert sent['to'] == ['someone@sccwrp.org']
+    assert sent['message']['Subject'] == 'Successful Data Load'
+    parts = sent['message'].get_payload()
+    assert parts[0].get_payload() == 'it loaded'
+    assert parts[1].get_payload(decode = True) == b'not really an excel file'
+    assert 'submission.xlsx' in parts[1]['Content-Disposition']
+
+
+def test_missing_attachment_still_sends(smtp, outbox_dir):
+    outbox.enqueue('a@sccwrp.org', ['b@sccwrp.org'], 'no file', 'body', filename = '/does/not/exist.xlsx', outbox_dir = outbox_dir)
+    assert outbox.deliver_due(outbox_dir = outbox_dir) == 1
+    assert len(smtp.delivered[0]['message'].get_payload()) == 1
+
+
+def test_batches_share_a_connection(smtp, outbox_dir, monkeypatch):
+    monkeypatch.setattr(outbox, 'BATCH_SIZE', 2)
+    for i in range(5):
+        outbox.enqueue('a@sccwrp.org', ['b@sccwrp.org'], f'message {i}', 'body', outbox_dir = outbox_dir)
+
+    assert outbox.deliver_due(outbox_dir = outbox_dir) == 5
+    # oldest first, one connection per batch of 2
+    assert [d['message']['Subject'] for d in smtp.delivered] == [f'message {i}' for i in range(5)]
+    assert smtp.connections == 3
+
+
+def test_transient_failure_is_retried_with_backoff(smtp, outbox_dir):
+    messageid = outbox.enqueue('a@sccwrp.org', ['b@sccwrp.org'], 'retry me', 'body', outbox_dir = outbox_dir)
+
+    smtp.failures = [smtplib.SMTPDataError(451, b'try again later')]
+    before = time.time()
+    assert outbox.deliver_due(outbox_dir = outbox_dir) == 0
+
+    message = read(outbox_dir, 'pending', messageid)
+    assert message['attempts'] == 1
+    assert len(message['errors']) == 1
+    assert before + outbox.BACKOFF <= message['next_attempt'] <= time.time() + outbox.BACKOFF
+
+    # not due yet, so the next pass leaves it alone
+    assert outbox.deliver_due(outbox_dir = outbox_dir) == 0
+    assert smtp.delivered == []
+
+    # the wait doubles after each attempt
+    make_due(outbox_dir)
+    smtp.refuse_connection = True
+    before = time.time()
+    assert outbox.deliver_due(outbox_dir = outbox_dir) == 0
+    message = read(outbox_dir, 'pending', messageid)
+    assert message['attempts'] == 2
+    assert message['next_attempt'] >= before + 2 * outbox.BACKOFF
+
+    make_due(outbox_dir)
+    smtp.refuse_connection = False
+    assert outbox.deliver_due(outbox_dir = outbox_dir) == 1
+    assert [d['message']['Subject'] for d in smtp.delivered] == ['retry me']
+    assert listdir(outbox_dir, 'pending') == []
+
+
+def test_disconnect_puts_the_rest_of_the_batch_back(smtp, outbox_dir):
+    ids = [outbox.enqueue('a@sccwrp.org', ['b@sccwrp.org'], f'message {i}', 'body', outbox_dir = outbox_dir) for i in range(3)]
+    smtp.failures = [None, smtplib.SMTPServerDisconnected('gone')]
+
+    assert outbox.deliver_due(outbox_dir = outbox_dir) == 1
+    assert listdir(outbox_dir, 'pending') == sorted(ids[1:])
+    assert all(read(outbox_dir, 'pending', m)['attempts'] == 1 for m in ids[1:])
+
+
+def test_exhausted_retries_end_up_failed(smtp, outbox_dir, monkeypatch):
+    monkeypatch.setattr(outbox, 'MAX_ATTEMPTS', 3)
+    messageid = outbox.enqueue('a@sccwrp.org', ['b@sccwrp.org'], 'never going to make it', 'body', outbox_dir = outbox_dir)
+
+    for attempt in range(3):
+        smtp.failures = [smtplib.SMTPRecipientsRefused({'b@sccwrp.org': (550, b'no such user')})]
+        make_due(outbox_dir)
+        assert outbox.deliver_due(outbox_dir = outbox_dir) == 0
+
+    assert listdir(outbox_dir, 'pending') == []
+    assert listdir(outbox_dir, 'failed') == [messageid]
+    message = read(outbox_dir, 'failed', messageid)
+    assert message['attempts'] == 3
+    assert len(message['errors']) == 3
+
+    # a failed message does not get tried again
+    assert outbox.deliver_due(outbox_dir = outbox_dir) == 0
+    assert outbox.outbox_stats(outbox_dir = outbox_dir) == {"pending": 0, "sending": 0, "failed": 1}
+
+
+def test_abandoned_messages_go_back_to_pending(smtp, outbox_dir):
+    messageid = outbox.enqueue('a@sccwrp.org', ['b@sccwrp.org'], 'abandoned', 'body', outbox_dir = outbox_dir)
+    [claimed] = outbox.claim_due(outbox_dir = outbox_dir)
+
+    # a process that is still alive keeps its messages
+    outbox.recover_abandoned(outbox_dir = outbox_dir)
+    assert listdir(outbox_dir, 'pending') == []
+
+    # pretend the process that claimed it died
+    os.rename(claimed, os.path.join(outbox_dir, 'sending', f"999999999-{messageid}"))
+    outbox.recover_abandoned(outbox_dir = outbox_dir)
+    assert listdir(outbox_dir, 'pending') == [messageid]
+    assert outbox.deliver_due(outbox_dir = outbox_dir) == 1
+
+
+def test_sender_thread_delivers(smtp, outbox_dir):
+    outbox.start_sender(outbox_dir = outbox_dir)
+    outbox.enqueue('a@sccwrp.org', ['b@sccwrp.org'], 'from the thread', 'body', outbox_dir = outbox_dir)
+
+    deadline = time.time() + 10
+    while (len(smtp.delivered) == 0) and (time.time() < deadline):
+        time.sleep(0.05)
+    assert [d['message']['Subject'] for d in smtp.delivered] == ['from the thread']
@@ -0,0 +1,41 @@
+import pandas as pd
+import pytest
+
+from proj.core import pool
+from proj.core.pool import SharedTable, read_shared
+
+
+@pytest.fixture
+def tables():
+    pool._shared_cache.clear()
+    made = []
+    yield made
+    for table in made:
+        table.unlink()
+    pool._shared_cache.clear()
+
+
+def test_read_shared_unpickles_once_per_table(tables):
+    df = pd.DataFrame({"stationid": ["B23-1", "B23-2"], "result": [1.5, None]})
+    table = SharedTable(dataframe = df, shapes = {"result": [1, 2]})
+    tables.append(table)
+
+    first = read_shared(table.block)
+    assert first['dataframe'].equals(df)
+    assert first['shapes'] == {"result": [1, 2]}
+    # the next check on the same table in this worker gets the same frame, not another unpickled copy
+    assert read_shared(table.block) is first
+
+
+def test_read_shared_keeps_the_last_few_tables(tables, monkeypatch):
+    monkeypatch.setattr(pool, 'SHARED_CACHE_SIZE', 2)
+    for i in range(3):
+        tables.append(SharedTable(dataframe = pd.DataFrame({"x": [i]})))
+
+    a, b, c = [read_shared(t.block) for t in tables]
+    assert list(pool._shared_cache.keys()) == [tables[1].block, tables[2].block]
+    assert read_shared(tables[1].block) is b
+    # the first one got dropped, so it is read out of the block again
+    again = read_shared(tables[0].block)
+    assert again is not a and again['dataframe'].equals(a['dataframe'])
+    assert list(pool._shared_cache.keys()) == [tables[1].block, tables[0].block]
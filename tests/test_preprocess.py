@@ -0,0 +1,160 @@
+import numpy as np
+import pandas as pd
+import pytest
+from flask import Flask, g
+
+from proj import preprocess
+
+
+# strip_whitespace, hardcoded_fixes and rename_test_stations used to go value by value (apply, and apply with axis = 1)
+# These are the old versions, with the database parts swapped out, to make sure the column at a time versions give back the same data
+
+TEST_EMAIL = 'test@sccwrp.org'
+SYSTEM_FIELDS = ['objectid', 'globalid']
+
+CATALOG = pd.DataFrame([
+    ('tbl_chemresults', 'stationid', 'varchar'),
+    ('tbl_chemresults', 'sampletype', 'varchar'),
+    ('tbl_chemresults', 'units', 'varchar'),
+    ('tbl_chemresults', 'analytename', 'varchar'),
+    ('tbl_chemresults', 'result', 'numeric'),
+    ('tbl_chemresults', 'sampledate', 'varchar'),
+    ('tbl_chemresults', 'fieldrep', 'varchar'),
+    ('tbl_chemresults', 'login_email', 'varchar'),
+    ('tbl_chemresults', 'objectid', 'varchar'),
+    ('tbl_grabevent', 'stationid', 'varchar'),
+    ('tbl_grabevent', 'test_stationid', 'varchar'),
+    ('tbl_grabevent', 'comments', 'varchar'),
+    ('tbl_grabevent', 'stationwaterdepth', 'numeric'),
+], columns = ['table_name', 'column_name', 'udt_name'])
+
+TEST_STATIONS = pd.DataFrame({
+    "stationid"      : ['B23-12000', 'B23-12321', 'B23-12177'],
+    "test_stationid" : ['B23-TEST1', 'B23-TEST2', 'B23-TEST3'],
+})
+
+
+class FakeCatalog:
+    def columns(self, table_name):
+        return CATALOG[CATALOG.table_name == table_name].reset_index(drop = True)
+
+
+def make_dfs():
+    return {
+        "tbl_chemresults": pd.DataFrame({
+            "stationid"   : ['B23-12000 ', ' B23-12321', 'B23-99999', None, np.nan, 'B23-12177'],
+            "sampletype"  : ['Result', 'Reference - SRM 1944', 'Result', None, 'Matrix spike', 'Lab blank'],
+            "units"       : ['ug/kg dw', 'ug/kg dw', ' ug/kg ww ', None, np.nan, 'mg/kg dw'],
+            "analytename" : ['Lead', '  Copper  ', '\tZinc\n', 'Mercury', '', 'PCB 18'],
+            "result"      : [1.5, 2.0, np.nan, -88.0, 0.0, 3.25],
+            "sampledate"  : pd.to_datetime(['2023-07-01', '2023-07-02', '2023-07-02', None, '2023-08-01', '2023-08-02']),
+            "fieldrep"    : [1.0, 2.0, np.nan, 1.0, 1.0, 2.0],
+            "login_email" : [' x@y.org '] * 6,
+            "objectid"    : [' 1 ', ' 2 ', ' 3 ', ' 4 ', ' 5 ', ' 6 '],
+        }),
+        "tbl_grabevent": pd.DataFrame({
+            "stationid"         : ['B23-12000', 'B23-12044', ' B23-12177 ', 'B23-12321'],
+            "test_stationid"    : ['B23-12000', None, 'B23-12177', 'B23-TEST2'],
+            "comments"          : ['  fine ', None, 'B23-12000', 7],
+            "stationwaterdepth" : [10.5, 20.0, np.nan, 3.0],
+        }, index = [3, 4, 5, 7]),
+    }
+
+
+def old_strip_whitespace(all_dfs):
+    for table_name in all_dfs.keys():
+        meta = CATALOG[
+            (CATALOG.table_name == table_name)
+            & (~CATALOG.column_name.str.startswith('login_'))
+            & (~CATALOG.column_name.isin(SYSTEM_FIELDS))
+        ]
+        table_df = all_dfs[table_name]
+        all_varchar_cols = meta[meta['udt_name'] == 'varchar'].column_name.values
+        table_df[all_varchar_cols] = table_df[all_varchar_cols].apply(
+            lambda col: col.apply(lambda x: str(x).strip() if not pd.isnull(x) else x)
+        )
+        all_dfs[table_name] = table_df
+    return all_dfs
+
+
+def old_hardcoded_fixes(all_dfs):
+    if 'tbl_chemresults' in all_dfs.keys():
+        all_dfs['tbl_chemresults']['units'] = all_dfs['tbl_chemresults'] \
+            .apply(
+                lambda row: str(row.units).replace('ug/kg ww','ng/g ww').replace('ug/kg dw','ng/g dw') if not ('Reference' in str(row.sampletype)) else row.units,
+                axis = 1
+            )
+    return all_dfs
+
+
+def old_rename_test_stations(all_dfs, login_email):
+    test_station_renaming_key = pd.Series(TEST_STATIONS.test_stationid.values, index = TEST_STATIONS.stationid).to_dict()
+    if login_email == TEST_EMAIL:
+        for dfname, df in all_dfs.items():
+            all_dfs[dfname] = df.replace(test_station_renaming_key)
+    return all_dfs
+
+
+@pytest.fixture
+def app_context(monkeypatch):
+    app = Flask('preprocess_test')
+    app.system_fields = SYSTEM_FIELDS
+    app.config['TESTING_EMAIL_ADDRESS'] = TEST_EMAIL
+    monkeypatch.setattr(preprocess, 'get_catalog', lambda eng: FakeCatalog())
+    monkeypatch.setattr(preprocess.pd, 'read_sql', lambda sql, eng: TEST_STATIONS.copy())
+    with app.app_context():
+        g.eng = None
+        yield app
+
+
+def assert_same(new, old):
+    assert new.keys() == old.keys()
+    for tbl in old.keys():
+        pd.testing.assert_frame_equal(new[tbl], old[tbl], check_dtype = False)
+        # same python types too, not just values that compare equal
+        for col in old[tbl].columns:
+            assert new[tbl][col].map(type).tolist() == old[tbl][col].map(type).tolist(), f"{tbl}.{col}"
+
+
+def test_strip_whitespace_matches_old_version(app_context):
+    new, old = make_dfs(), make_dfs()
+    changed = preprocess.strip_whitespace(new)
+    old = old_strip_whitespace(old)
+    assert_same(new, old)
+    assert changed > 0
+
+
+def test_hardcoded_fixes_matches_old_version(app_context):
+    new, old = make_dfs(), make_dfs()
+    changed = preprocess.hardcoded_fixes(new)
+    old = old_hardcoded_fixes(old)
+    assert_same(new, old)
+    assert changed > 0
+
+
+def test_stripped_then_fixed_matches_old_version(app_context):
+    new, old = make_dfs(), make_dfs()
+    preprocess.strip_whitespace(new)
+    preprocess.hardcoded_fixes(new)
+    old = old_hardcoded_fixes(old_strip_whitespace(old))
+    assert_same(new, old)
+
+
+@pytest.mark.parametrize("login_email", [TEST_EMAIL, 'someone@else.org', None])
+def test_rename_test_stations_matches_old_version(app_context, login_email):
+    # the old version renamed the station ids in every column, the new one only in the station id columns
+    # so the comments column, which has a station id in it, is left out of the comparison
+    new, old = make_dfs(), make_dfs()
+    preprocess.rename_test_stations(new, login_email)
+    old = old_rename_test_stations(old, login_email)
+    new['tbl_grabevent'] = new['tbl_grabevent'].drop(columns = 'comments')
+    old['tbl_grabevent'] = old['tbl_grabevent'].drop(columns = 'comments')
+    assert_same(new, old)
+
+
+def test_rename_test_stations_leaves_other_columns(app_context):
+    dfs = make_dfs()
+    changed = preprocess.rename_test_stations(dfs, TEST_EMAIL)
+    assert dfs['tbl_grabevent'].comments.tolist()[2] == 'B23-12000'
+    assert dfs['tbl_grabevent'].stationid.tolist()[0] == 'B23-TEST1'
+    assert changed == 5
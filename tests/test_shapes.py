@@ -0,0 +1,192 @@
+import re
+from math import log10
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from proj.core.functions import numeric_shape, _float_shape, text_length
+from proj.core.metadata import column_shapes, checkPrecision, checkScale, checkLength
+
+
+# checkPrecision and checkScale used to call check_precision and check_scale on every value, checkLength called check_length
+# now the shape of a column is worked out once (numeric_shape, column_shapes) and the checks read it
+# These are the old functions as they were (minus the lru_cache), and the tests make sure the shapes flag exactly what they did
+
+def check_precision(x, precision):
+    try:
+        int(x)
+    except Exception as e:
+        return True
+    if pd.isnull(precision):
+        return True
+    try:
+        if not isinstance(x, (int, float)):
+            x = float(str(x))
+    except Exception as e:
+        return True
+    x = abs(x)
+    if 0 < x < 1:
+        return True
+    left = int(log10(x)) + 1 if x > 0 else 1
+    if 'e-' in str(x):
+        powerof10 = int(str(x).split('e-')[-1])
+        rightdigits = re.search(r"\.(\d+)", str(x).split('e-')[0])
+        if rightdigits:
+            rightdigits = rightdigits.groups()[0]
+            right = powerof10 + len(rightdigits)
+        else:
+            right = 0
+    else:
+        frac_part = abs(int(re.sub(r"\d*\.", "", str(x)))) if ('.' in str(x)) and ('e' not in str(x)) else 0
+        if frac_part > 0:
+            while (frac_part % 10 == 0):
+                frac_part = int(frac_part / 10)
+        right = len(str(frac_part)) if frac_part > 0 else 0
+    return True if left + right <= precision else False
+
+
+def check_scale(x, scale):
+    try:
+        int(x)
+    except Exception as e:
+        return True
+    if pd.isnull(scale):
+        return True
+    try:
+        if not isinstance(x, (int, float)):
+            x = float(str(x))
+    except Exception as e:
+        return True
+    x = abs(x)
+    if 'e-' in str(x):
+        powerof10 = int(str(x).split('e-')[-1])
+        rightdigits = re.search(r"\.(\d+)", str(x).split('e-')[0])
+        if rightdigits:
+            rightdigits = rightdigits.groups()[0]
+            right = powerof10 + len(rightdigits)
+        else:
+            right = 0
+    else:
+        frac_part = abs(int(re.sub(r"\d*\.", "", str(x)))) if ('.' in str(x)) and ('e' not in str(x)) else 0
+        if frac_part > 0:
+            while (frac_part % 10 == 0):
+                frac_part = int(frac_part / 10)
+        right = len(str(frac_part)) if frac_part > 0 else 0
+    return True if right <= scale else False
+
+
+def check_length(x, maxlength):
+    if pd.isnull(maxlength):
+        return True
+    return True if len(str(x)) <= int(maxlength) else False
+
+
+FLOATS = [
+    0.0, 1.0, -1.0, 0.5, -0.5, 0.05, 0.1, 12.5, -12.5, 123.456, -123.456, 99.99, 100.0, 1234567.891,
+    1e-7, -1e-7, 7.23e-05, -7.23e-05, 1.5e-10, 0.0001234, 1e15, 1e16, -1e16, 1e20, -1e20, 1.5e300,
+    3.141592653589793, 2.0 / 3, 1 / 3 * 1e6, np.nan, np.inf, -np.inf
+]
+INTS = [0, 1, -1, 7, -7, 10, 99, 100, -100, 12345, 2 ** 31, -(2 ** 31), 10 ** 15, 10 ** 17 - 1, -(10 ** 15)]
+
+SERIES = {
+    "float64"         : pd.Series(FLOATS),
+    "integral float64": pd.Series([8001.0, -8002.0, 0.0, 1e20, np.nan]),
+    "int64"           : pd.Series(INTS, dtype = 'int64'),
+    "bool"            : pd.Series([True, False, True]),
+    "numeric strings" : pd.Series([
+        "1", "-1", "+3", "007", "-0", "12345", "-12345678901234", "123456789012345678", "1.5", "-0.05", "1e5", "1E-7",
+        " 3 ", "3 ", "1_000", "abc", "", "nan", "inf", "١٢٣"
+    ], dtype = object),
+    "object"          : pd.Series(
+        FLOATS + INTS + [
+            10 ** 20, -(10 ** 20), 10 ** 400, np.int64(-42), np.float64(-0.125), np.float64(1e-7), np.float64(1e20),
+            True, False, np.bool_(True), None, pd.NaT, pd.Timestamp("2023-07-01"),
+            "1", "-1", "12345", "1.5", "-12", " 7", "1_000", "abc", ""
+        ],
+        dtype = object
+    ),
+}
+
+PRECISIONS = [1, 2, 3, 5, 8, 10, 15, 20, 25]
+SCALES = [0, 1, 2, 3, 5, 7, 10, 15]
+
+
+@pytest.mark.parametrize("name", SERIES.keys())
+def test_numeric_shape_matches_old_checks(name):
+    series = SERIES[name]
+    shape = numeric_shape(series)
+    assert shape.index.equals(series.index)
+
+    for prec in PRECISIONS:
+        flagged = (shape.checked & ~shape.fraction & (shape.left + shape.right > prec)).tolist()
+        expected = [not check_precision(x, prec) for x in series]
+        assert [repr(x) for x, f, e in zip(series, flagged, expected) if f != e] == [], f"precision {prec}"
+
+    for scale in SCALES:
+        flagged = (shape.checked & (shape.right > scale)).tolist()
+        expected = [not check_scale(x, scale) for x in series]
+        assert [repr(x) for x, f, e in zip(series, flagged, expected) if f != e] == [], f"scale {scale}"
+
+
+def test_float_shape():
+    shape = _float_shape(np.array([-123.456, 7.23e-05, 1e-7, 1e20, 0.5, 42.0, np.nan]))
+    assert shape.checked.tolist() == [True, True, True, True, True, True, False]
+    assert shape.fraction.tolist() == [False, True, True, False, True, False, False]
+    assert shape.left.tolist()[:6] == [3, 1, 1, 21, 1, 2]
+    # 7.23e-05 is .0000723, 7 places
+    # 1e-07 counts as 0, since the old check_scale only counted when there was a decimal point before the e
+    assert shape.right.tolist()[:6] == [3, 7, 0, 0, 1, 0]
+
+
+def test_numeric_shape_non_unique_index():
+    series = SERIES['object'].copy()
+    series.index = [3] * len(series)
+    shape = numeric_shape(series)
+    assert shape.index.equals(series.index)
+    assert shape.reset_index(drop = True).equals(numeric_shape(series.reset_index(drop = True)))
+
+
+def test_checks_with_column_shapes_match_old_checks():
+    values = SERIES['object']
+    n = len(values)
+    df = pd.DataFrame({
+        "result"    : values,
+        "depth"     : pd.Series(FLOATS * 3)[:n].values,
+        "stationid" : values.astype(str),
+        "comments"  : [None if i % 5 == 0 else "x" * i for i in range(n)],
+        "objectid"  : values,
+    })
+    df.index = df.index * 2 + 1
+    meta = pd.DataFrame({
+        "column_name"              : ["result", "depth", "stationid", "comments", "objectid"],
+        "udt_name"                 : ["numeric", "numeric", "varchar", "varchar", "numeric"],
+        "numeric_precision"        : [8, 5, None, None, 3],
+        "numeric_scale"            : [3, 2, None, None, 0],
+        "character_maximum_length" : [None, None, 12, 20, None],
+    })
+    context = {"system_fields": ["objectid"]}
+    shapes = column_shapes(df, meta, context['system_fields'])
+    assert set(shapes.keys()) == {"result", "depth", "stationid", "comments"}
+
+    def rows(ret, col):
+        return [r.get('rows', []) for r in ret if r.get('columns', col) == col]
+
+    for col, prec, scale in (("result", 8, 3), ("depth", 5, 2)):
+        expected = df[df[col].apply(lambda x: not check_precision(x, prec))].index.tolist()
+        # with the shapes handed in by core, and without them like when a custom check calls it
+        for kwargs in ({"shapes": shapes}, {}):
+            ret = checkPrecision(df, "tbl_test", None, meta, context = context, **kwargs)
+            assert sorted(sum(rows(ret, col), [])) == expected
+
+        expected = df[df[col].apply(lambda x: not check_scale(x, scale))].index.tolist()
+        for kwargs in ({"shapes": shapes}, {}):
+            ret = checkScale(df, "tbl_test", None, meta, context = context, **kwargs)
+            assert sorted(sum(rows(ret, col), [])) == expected
+
+    for col, maxlen in (("stationid", 12), ("comments", 20)):
+        # check_length went through str(x), so the old check counted None as 4 characters, text_length leaves nulls alone
+        expected = df[df[col].apply(lambda x: (not pd.isnull(x)) and not check_length(x, maxlen))].index.tolist()
+        for kwargs in ({"shapes": shapes}, {}):
+            ret = checkLength(df, "tbl_test", None, meta, context = context, **kwargs)
+            assert sorted(sum(rows(ret, col), [])) == expected
@@ -0,0 +1,75 @@
+import datetime
+import numpy as np
+import pandas as pd
+
+from proj.utils.excel import excel_str, round_trip_strings
+
+
+# The upload routine used to write all_dfs to the excel file, and read it back in with the string converters (read_excel with converters = str)
+# Now it converts the string columns in memory with round_trip_strings, which has to give back the same thing
+# (except for text starting with =, which xlsxwriter wrote as a formula, and came back as its result. Now it stays the text that was submitted)
+
+def convert_in_memory(df, columns = None):
+    return round_trip_strings(df.copy(), list(df.columns) if columns is None else columns)
+
+
+def round_trip(df, path, columns = None):
+    with pd.ExcelWriter(path, engine = 'xlsxwriter') as writer:
+        df.to_excel(writer, sheet_name = 'tbl_test', index = False)
+    return pd.read_excel(
+        path,
+        sheet_name = 'tbl_test',
+        converters = {col: str for col in (df.columns if columns is None else columns)},
+        keep_default_na = False,
+        na_values = ['']
+    )
+
+
+def same_values(a, b):
+    a, b = a.astype(object), b.astype(object)
+    return a.where(a.notnull(), None).tolist() == b.where(b.notnull(), None).tolist()
+
+
+def test_excel_str_matches_round_trip(tmp_path):
+    df = pd.DataFrame({
+        "stationid"  : [8001.0, 8002.0, np.nan, 8004.0],
+        "depth"      : [1.5, 0.1 + 0.2, 1e20, -3.0],
+        "replicate"  : np.array([1, 2, 3, 12345678901234567], dtype = 'int64'),
+        "comments"   : ["none", "  padded ", "with, a comma", None],
+        "mixed"      : [1, "A", 2.0, 2.25],
+        "sampledate" : pd.to_datetime(["2023-07-01", "2023-07-02 13:45:10", None, "2023-09-30"]),
+        "dateonly"   : [datetime.date(2023, 7, 1), None, datetime.date(2023, 8, 1), datetime.date(2023, 9, 1)],
+        "sampletime" : [datetime.time(8, 30), datetime.time(23, 59, 59), None, datetime.time(0, 0)],
+        "flag"       : [True, False, True, False],
+    })
+
+    expected = round_trip(df, tmp_path / 'roundtrip.xlsx')
+    converted = convert_in_memory(df)
+
+    for col in df.columns:
+        assert converted[col].where(converted[col].notnull(), None).tolist() == expected[col].where(expected[col].notnull(), None).tolist(), col
+
+
+def test_integral_floats_lose_the_decimal():
+    assert excel_str(8001.0) == '8001'
+    assert excel_str(np.float64(8001.0)) == '8001'
+    assert excel_str(np.int64(8001)) == '8001'
+    assert excel_str(8001.5) == '8001.5'
+
+
+def test_empty_strings_become_null(tmp_path):
+    # strip_whitespace leaves '' where a cell only had spaces in it, and the round trip made those NULL
+    df = pd.DataFrame({
+        "comments"  : ['x', '', ' ', None],
+        "stationid" : ['', 'B23-12000', '\t', ''],
+        "result"    : ['', 1.5, 'abc', None],
+        "depth"     : [1.0, 2.0, np.nan, 4.0],
+    })
+    columns = ['comments', 'stationid']
+
+    expected = round_trip(df, tmp_path / 'roundtrip.xlsx', columns = columns)
+    converted = convert_in_memory(df, columns)
+
+    assert converted['comments'].where(converted['comments'].notnull(), None).tolist() == ['x', None, ' ', None]
+    for col in df.columns:
+        assert same_values(converted[col], expected[col]), col